@@ -31,6 +31,7 @@ import bpy.types
 
 from .io_mesh_3mf.import_3mf import Import3MF
 from .io_mesh_3mf.export_3mf import Export3MF
+from .io_mesh_3mf.preserved_files import cleanup_preserved_files
 
 
 def menu_import(self, context):
@@ -60,10 +61,12 @@ def register():
 
     bpy.types.TOPBAR_MT_file_import.append(menu_import)
     bpy.types.TOPBAR_MT_file_export.append(menu_export)
+    bpy.app.handlers.load_post.append(cleanup_preserved_files)
 
 
 def unregister():
     """Unregister all classes and menu items."""
+    bpy.app.handlers.load_post.remove(cleanup_preserved_files)
     bpy.types.TOPBAR_MT_file_import.remove(menu_import)
     bpy.types.TOPBAR_MT_file_export.remove(menu_export)
 
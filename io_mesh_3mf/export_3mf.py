@@ -10,26 +10,49 @@
 
 # <pep8 compliant>
 
-import base64  # To decode files that must be preserved.
 import bpy  # The Blender API.
 import bpy.props  # To define metadata properties for the operator.
 import bpy.types  # This class is an operator in Blender, and to find meshes in the scene.
 import bpy_extras.io_utils  # Helper functions to export meshes more easily.
 import bpy_extras.node_shader_utils  # Converting material colors to sRGB.
-import collections  # Counter, to find the most common material of an object.
+import collections  # For namedtuple.
+import concurrent.futures  # To format the mesh data while the rest of the document gets compressed and written.
+import hashlib  # To recognise objects with identical geometry.
 import itertools
 import logging  # To debug and log progress.
 import mathutils  # For the transformation matrices.
-import xml.etree.ElementTree  # To write XML documents with the 3D model data.
+import numpy  # To get the mesh data from Blender all at once, and process it as arrays.
+import os  # To remove the archive if the export is cancelled.
+import re  # To strip trailing zeros from formatted coordinates.
+import threading  # To write the archive in the background.
+import time  # To date the 3D model in the archive.
 import zipfile  # To write zip archives, the shell of the 3MF file.
 
 from .annotations import Annotations  # To store file annotations
 from .constants import *
 from .metadata import Metadata  # To store metadata from the Blender scene into the 3MF file.
+from .parallel_deflate import ParallelDeflate  # To compress the 3D model on multiple threads.
+from .preserved_files import PreservedFiles  # To write files that must be preserved.
 from .unit_conversions import blender_to_metre, threemf_to_metre
+from .xml_writer import XMLWriter  # To write the 3D model data as a stream.
+from .zipfile_compat import replace_compressor  # To compress the 3D model with our own compressor.
 
 log = logging.getLogger(__name__)
 
+# A build item to write to the document after all of the resources.
+BuildItem = collections.namedtuple("BuildItem", ["objectid", "transformation", "metadata"])
+
+VERTICES_PER_BLOCK = 16384  # Number of vertices to format at once. Bigger blocks are faster, but take more memory.
+TRIANGLES_PER_BLOCK = 16384  # Number of triangles to format at once.
+TRAILING_ZEROS = re.compile(r'(\.[0-9]*?)0+"')  # Zeros after the radix, at the end of an attribute value.
+BUILTIN_FACE_ATTRIBUTES = {"sharp_face", "freestyle_face"}  # Boolean face attributes of Blender that aren't sets.
+COMPRESSION_LEVELS = {  # The deflate level of each compression preset, or None to store the 3D model uncompressed.
+    'STORED': None,
+    'FAST': 1,
+    'BALANCED': 6,
+    'MAX': 9
+}
+
 
 class Export3MF(bpy.types.Operator, bpy_extras.io_utils.ExportHelper):
     """
@@ -61,12 +84,32 @@ class Export3MF(bpy.types.Operator, bpy_extras.io_utils.ExportHelper):
         name="Apply Modifiers",
         description="Apply the modifiers before saving.",
         default=True)
+    use_instances: bpy.props.BoolProperty(
+        name="Export Instances",
+        description="Export what is instanced by geometry nodes, particles and collection instances too, writing each "
+                    "instanced mesh only once. Every instance is written as a separate build item.",
+        default=False)
     coordinate_precision: bpy.props.IntProperty(
         name="Precision",
         description="The number of decimal digits to use in coordinates in the file.",
         default=4,
         min=0,
         max=12)
+    compression: bpy.props.EnumProperty(
+        name="Compression",
+        description="How much to compress the 3D model. Stronger compression gives smaller files, but takes longer.",
+        items=[
+            ('STORED', "Stored", "Don't compress the 3D model. The fastest, but the file gets several times larger."),
+            ('FAST', "Fast", "Compress the 3D model quickly, giving a somewhat larger file."),
+            ('BALANCED', "Balanced", "Compress the 3D model nearly as small as possible, in a fraction of the time."),
+            ('MAX', "Maximum", "Compress the 3D model as small as possible.")
+        ],
+        default='MAX')
+    use_background: bpy.props.BoolProperty(
+        name="Export in Background",
+        description="Take a snapshot of the scene, and write the file while Blender can still be used. Press Escape "
+                    "to cancel.",
+        default=False)
 
     def execute(self, context):
         """
@@ -81,6 +124,8 @@ class Export3MF(bpy.types.Operator, bpy_extras.io_utils.ExportHelper):
         self.num_written = 0
         self.material_resource_id = -1
         self.material_name_to_index = {}
+        self.mesh_resources = {}  # Resource IDs of the meshes written so far, by their geometry, to write each once.
+        self.collection_resources = {}  # Resource IDs of the instanced collections written so far.
 
         archive = self.create_archive(self.filepath)
         if archive is None:
@@ -93,33 +138,152 @@ class Export3MF(bpy.types.Operator, bpy_extras.io_utils.ExportHelper):
 
         global_scale = self.unit_scale(context)
 
-        # Due to an open bug in Python 3.7 (Blender's version) we need to prefix all elements with the namespace.
-        # Bug: https://bugs.python.org/issue17088
-        # Workaround: https://stackoverflow.com/questions/4997848/4999510#4999510
-        root = xml.etree.ElementTree.Element(f"{{{MODEL_NAMESPACE}}}model")
+        # The document is written to the archive while it is being generated, so it never needs to be in memory.
+        # The main thread gets the data from Blender, while the threads of the executor format it. Formatting holds the
+        # interpreter lock, so this doesn't format on multiple cores, but it overlaps with compressing and writing.
+        # In the background, the main thread only takes a snapshot of the data. Nothing gets written until the writer is
+        # closed then.
+        self.executor = concurrent.futures.ThreadPoolExecutor()
+        model_stream = self.open_model(archive)
         # Declare Triangle Sets extension namespace per spec §2.3.1 and §4.1.5
-        root.attrib[f"xmlns:t"] = TRIANGLESETS_NAMESPACE
+        namespaces = {"": MODEL_NAMESPACE, "t": TRIANGLESETS_NAMESPACE}
+        self.writer = XMLWriter(model_stream, namespaces, self.executor, buffered=self.use_background)
+        try:
+            self.write_model(context, self.writer, blender_objects, global_scale)
+        except BaseException:
+            self.abort(archive, model_stream, self.filepath)
+            raise
+
+        if not self.use_background:
+            return self.finish(archive, model_stream, self.filepath)
+
+        self.status = {'CANCELLED'}  # Until the thread reports otherwise.
+        self.thread = threading.Thread(
+            target=self.finish_in_background,
+            args=(archive, model_stream, self.filepath),
+            name="3MF export")
+        self.thread.start()
+        window_manager = context.window_manager
+        self.timer = window_manager.event_timer_add(0.1, window=context.window)
+        window_manager.progress_begin(0, 100)
+        window_manager.modal_handler_add(self)
+        return {'RUNNING_MODAL'}
+
+    def modal(self, context, event):
+        """
+        Follows the progress of an export in the background, until it is done.
+        :param context: The Blender context.
+        :param event: The event that Blender got.
+        :return: A set of status flags to indicate whether the export is still running, or whether the write succeeded
+        or not.
+        """
+        if event.type == 'ESC':
+            self.writer.cancel()
+            return {'RUNNING_MODAL'}
+        if self.thread.is_alive():
+            context.window_manager.progress_update(round(self.writer.progress() * 100))
+            return {'PASS_THROUGH'}
+
+        context.window_manager.event_timer_remove(self.timer)
+        context.window_manager.progress_end()
+        if self.status == {'FINISHED'}:
+            self.report({'INFO'}, f"Exported {self.num_written} objects to 3MF archive {self.filepath}.")
+        return self.status
+
+    def write_model(self, context, writer, blender_objects, global_scale):
+        """
+        Generates the 3D model document.
+        :param context: The Blender context.
+        :param writer: The writer to write the 3D model document with.
+        :param blender_objects: The Blender objects to export.
+        :param global_scale: A scaling factor to apply to all objects to convert the units.
+        """
+        writer.start(f"{{{MODEL_NAMESPACE}}}model")
 
         scene_metadata = Metadata()
         scene_metadata.retrieve(bpy.context.scene)
-        self.write_metadata(root, scene_metadata)
+        self.write_metadata(writer, scene_metadata)
+
+        # All resources must be written before the build items that refer to them.
+        writer.start(f"{{{MODEL_NAMESPACE}}}resources")
+        if self.use_instances:
+            # Instanced objects may not be in the scene themselves, so get their materials from the instances too.
+            dependency_graph = context.evaluated_depsgraph_get()
+            instanced_objects = (instance.object for instance in dependency_graph.object_instances)
+            self.material_name_to_index = self.write_materials(writer, instanced_objects)
+            build_items = self.write_instances(writer, dependency_graph, global_scale)
+        else:
+            self.material_name_to_index = self.write_materials(writer, self.with_instanced_objects(blender_objects))
+            build_items = self.write_objects(writer, blender_objects, global_scale)
+        writer.end(f"{{{MODEL_NAMESPACE}}}resources")
+        self.write_build(writer, build_items)
+
+        writer.end(f"{{{MODEL_NAMESPACE}}}model")
 
-        resources_element = xml.etree.ElementTree.SubElement(root, f"{{{MODEL_NAMESPACE}}}resources")
-        self.material_name_to_index = self.write_materials(resources_element, blender_objects)
-        self.write_objects(root, resources_element, blender_objects, global_scale)
+    def finish(self, archive, model_stream, filepath):
+        """
+        Writes the rest of the 3D model to the archive, and completes the archive.
 
-        document = xml.etree.ElementTree.ElementTree(root)
-        with archive.open(MODEL_LOCATION, 'w', force_zip64=True) as f:
-            document.write(f, xml_declaration=True, encoding='UTF-8', default_namespace=MODEL_NAMESPACE)
+        In the background, this is executed on a different thread than the main thread. It may not access any Blender
+        data then.
+        :param archive: The archive that is being written.
+        :param model_stream: The stream of the 3D model in the archive.
+        :param filepath: The path that the archive is written to.
+        :return: A set of status flags to indicate whether the write succeeded or not.
+        """
         try:
+            try:
+                self.writer.close()
+            finally:
+                self.executor.shutdown(cancel_futures=True)
+            model_stream.close()
             archive.close()
+        except concurrent.futures.CancelledError:
+            self.abort(archive, model_stream, filepath)
+            log.info(f"Cancelled exporting to 3MF archive {filepath}.")
+            return {'CANCELLED'}
         except EnvironmentError as e:
+            self.abort(archive, model_stream, filepath)
             log.error(f"Unable to complete writing to 3MF archive: {e}")
             return {'CANCELLED'}
+        except BaseException:
+            self.abort(archive, model_stream, filepath)
+            raise
 
-        log.info(f"Exported {self.num_written} objects to 3MF archive {self.filepath}.")
+        log.info(f"Exported {self.num_written} objects to 3MF archive {filepath}.")
         return {'FINISHED'}
 
+    def abort(self, archive, model_stream, filepath):
+        """
+        Stops writing the archive after it failed or got cancelled, and removes the incomplete file.
+
+        Everything that was opened to write the archive gets closed, including the threads that format and compress the
+        3D model. This doesn't raise any errors of its own, so that the original error can be reported.
+        :param archive: The archive that is being written.
+        :param model_stream: The stream of the 3D model in the archive.
+        :param filepath: The path that the archive is written to.
+        """
+        self.writer.cancel()  # Don't wait for the rest of the document to be formatted.
+        self.executor.shutdown(cancel_futures=True)
+        for close in (self.writer.close, model_stream.close, archive.close):
+            try:
+                close()
+            except Exception as e:  # Already failing. Close the rest regardless.
+                log.debug(f"Error while closing the incomplete 3MF archive: {e}")
+        try:
+            os.remove(filepath)
+        except EnvironmentError as e:
+            log.warning(f"Unable to remove the incomplete 3MF archive {filepath}: {e}")
+
+    def finish_in_background(self, archive, model_stream, filepath):
+        """
+        Completes the archive on a background thread, and stores the result for the modal operator to report.
+        :param archive: The archive that is being written.
+        :param model_stream: The stream of the 3D model in the archive.
+        :param filepath: The path that the archive is written to.
+        """
+        self.status = self.finish(archive, model_stream, filepath)
+
     # The rest of the functions are in order of when they are called.
 
     def create_archive(self, filepath):
@@ -145,24 +309,47 @@ class Export3MF(bpy.types.Operator, bpy_extras.io_utils.ExportHelper):
 
         return archive
 
+    def open_model(self, archive):
+        """
+        Adds the 3D model file to the archive, to write it as a stream.
+
+        The 3D model is typically by far the biggest file in the archive. Unless it is stored uncompressed, it gets
+        compressed on multiple threads, while the document is still being written.
+        :param archive: The archive to add the file to.
+        :return: A binary stream to write the 3D model to. It must be closed before anything else is written to the
+        archive.
+        """
+        level = COMPRESSION_LEVELS[self.compression]
+        info = zipfile.ZipInfo(MODEL_LOCATION, date_time=time.localtime(time.time())[:6])
+        info.compress_type = zipfile.ZIP_STORED if level is None else zipfile.ZIP_DEFLATED
+        stream = archive.open(info, 'w', force_zip64=True)  # The model may exceed 4GB. Can't know in advance.
+        if level is not None:
+            # If the compressor can't be swapped for our own, the model is still compressed, just on a single thread.
+            replace_compressor(stream, lambda: ParallelDeflate(level))
+        return stream
+
     def must_preserve(self, archive):
         """
         Write files that must be preserved to the archive.
 
-        These files were stored in the Blender scene in a hidden location.
+        These files were stored in the user data directory of this extension, and the Blender scene refers to them from
+        a hidden location. Their compressed data is copied from the original archive as it is, without compressing it
+        again. If their contents are no longer stored, for instance because the .blend file was made on a different
+        computer, the user is warned that they are missing from the archive.
         :param archive: The archive to write files to.
         """
-        for textfile in bpy.data.texts:
-            filename = textfile.name
-            if not filename.startswith(".3mf_preserved/"):
-                continue  # Unrelated file. Not ours to read.
-            contents = textfile.as_string()
-            if contents == conflicting_mustpreserve_contents:
-                continue  # This file was in conflict. Don't preserve any copy of it then.
-            contents = base64.b85decode(contents.encode("UTF-8"))
-            filename = filename[len(".3mf_preserved/"):]
-            with archive.open(filename, 'w') as f:
-                f.write(contents)
+        try:
+            storage = PreservedFiles()
+        except (EnvironmentError, ValueError) as e:
+            log.warning(f"Unable to access the preserved files: {e}")
+            self.report({'WARNING'}, "The files that must be preserved can't be accessed, so they are not exported.")
+            return
+        missing = storage.write(archive)
+        if missing:
+            self.report(
+                {'WARNING'},
+                f"The contents of {len(missing)} files that must be preserved are no longer available on this "
+                f"computer, so they are not exported: {', '.join(missing)}")
 
     def unit_scale(self, context):
         """
@@ -184,7 +371,7 @@ class Export3MF(bpy.types.Operator, bpy_extras.io_utils.ExportHelper):
 
         return scale
 
-    def write_materials(self, resources_element, blender_objects):
+    def write_materials(self, writer, blender_objects):
         """
         Write the materials on the specified blender objects to a 3MF document.
 
@@ -195,7 +382,7 @@ class Export3MF(bpy.types.Operator, bpy_extras.io_utils.ExportHelper):
         mapping, the objects and triangles can write down an index referring to the list of <base> tags.
 
         Since the <base> material can only hold a color, we'll write the diffuse color of the material to the file.
-        :param resources_element: A <resources> node from a 3MF document.
+        :param writer: The writer of the 3MF document, while it is in the <resources> element.
         :param blender_objects: A list of Blender objects that may have materials which we need to write to the
         document.
         :return: A mapping from material name to the index of that material in the <basematerials> tag.
@@ -203,12 +390,14 @@ class Export3MF(bpy.types.Operator, bpy_extras.io_utils.ExportHelper):
         name_to_index = {}  # The output list, mapping from material name to indexes in the <basematerials> tag.
         next_index = 0
 
-        # Create an element lazily. We don't want to create an element if there are no materials to write.
-        basematerials_element = None
+        # Start the element lazily. We don't want to write an element if there are no materials to write.
+        basematerials_started = False
 
         for blender_object in blender_objects:
             for material_slot in blender_object.material_slots:
                 material = material_slot.material
+                if material is None:  # Empty material slot. Its triangles are written without material.
+                    continue
 
                 material_name = material.name
                 if material_name in name_to_index:  # Already have this material through another object.
@@ -227,85 +416,182 @@ class Export3MF(bpy.types.Operator, bpy_extras.io_utils.ExportHelper):
                     alpha = min(255, round(alpha * 255))
                     color_hex = "#%0.2X%0.2X%0.2X%0.2X" % (red, green, blue, alpha)
 
-                if basematerials_element is None:
+                if not basematerials_started:
                     self.material_resource_id = str(self.next_resource_id)
                     self.next_resource_id += 1
-                    basematerials_element = xml.etree.ElementTree.SubElement(
-                        resources_element,
-                        f"{{{MODEL_NAMESPACE}}}basematerials", attrib={
-                            f"{{{MODEL_NAMESPACE}}}id": self.material_resource_id
-                        })
-                xml.etree.ElementTree.SubElement(basematerials_element, f"{{{MODEL_NAMESPACE}}}base", attrib={
+                    writer.start(f"{{{MODEL_NAMESPACE}}}basematerials", attrib={
+                        f"{{{MODEL_NAMESPACE}}}id": self.material_resource_id
+                    })
+                    basematerials_started = True
+                writer.element(f"{{{MODEL_NAMESPACE}}}base", attrib={
                     f"{{{MODEL_NAMESPACE}}}name": material_name,
                     f"{{{MODEL_NAMESPACE}}}displaycolor": color_hex
                 })
                 name_to_index[material_name] = next_index
                 next_index += 1
 
+        if basematerials_started:
+            writer.end(f"{{{MODEL_NAMESPACE}}}basematerials")
         return name_to_index
 
-    def write_objects(self, root, resources_element, blender_objects, global_scale):
+    def write_objects(self, writer, blender_objects, global_scale):
         """
-        Writes a group of objects into the 3MF archive.
-        :param root: An XML root element to write the objects into.
-        :param resources_element: An XML element to write resources into.
-        :param blender_objects: A list of Blender objects that need to be written to that XML element.
+        Writes the resources of a group of objects into the 3MF document.
+
+        The build items can only be written after all resources, so they are returned instead, to be written later with
+        `write_build`.
+        :param writer: The writer of the 3MF document, while it is in the <resources> element.
+        :param blender_objects: A list of Blender objects that need to be written to the document.
         :param global_scale: A scaling factor to apply to all objects to convert the units.
+        :return: A list of `BuildItem`s, one for each object that was written.
         """
         transformation = mathutils.Matrix.Scale(global_scale, 4)
 
-        build_element = xml.etree.ElementTree.SubElement(root, f"{{{MODEL_NAMESPACE}}}build")
+        build_items = []
         for blender_object in blender_objects:
             if blender_object.parent is not None:
                 continue  # Only write objects that have no parent, since we'll get the child objects recursively.
             if blender_object.type not in {'MESH', 'EMPTY'}:
                 continue
 
-            objectid, mesh_transformation = self.write_object_resource(resources_element, blender_object)
+            objectid, mesh_transformation = self.write_object_resource(writer, blender_object)
 
-            item_element = xml.etree.ElementTree.SubElement(build_element, f"{{{MODEL_NAMESPACE}}}item")
             self.num_written += 1
-            item_element.attrib[f"{{{MODEL_NAMESPACE}}}objectid"] = str(objectid)
-            mesh_transformation = transformation @ mesh_transformation
-            if mesh_transformation != mathutils.Matrix.Identity(4):
-                item_element.attrib[f"{{{MODEL_NAMESPACE}}}transform"] =\
-                    self.format_transformation(mesh_transformation)
+            metadata = Metadata()
+            metadata.retrieve(blender_object)
+            build_items.append(BuildItem(
+                objectid=objectid,
+                transformation=transformation @ mesh_transformation,
+                metadata=metadata))
+        return build_items
+
+    def write_instances(self, writer, dependency_graph, global_scale):
+        """
+        Writes the resources of everything that is visible in the evaluated scene into the 3MF document.
+
+        Unlike `write_objects`, this includes the instances that geometry nodes, particle systems and collection
+        instances create. Each instanced mesh is written once, and every instance becomes a build item that refers to it
+        with its own transformation. The hierarchy of the objects is not preserved. Each object is built at its place in
+        the world.
+        :param writer: The writer of the 3MF document, while it is in the <resources> element.
+        :param dependency_graph: The evaluated dependency graph of the scene, to get the instances from.
+        :param global_scale: A scaling factor to apply to all objects to convert the units.
+        :return: A list of `BuildItem`s, one for each instance that was written.
+        """
+        transformation = mathutils.Matrix.Scale(global_scale, 4)
+
+        # The resource ID of each instanced mesh, by the mesh and the materials it gets from its object.
+        # Most instances share these, so this prevents having to get the same mesh from Blender for each of them.
+        instanced_resources = {}
+        build_items = []
+        for instance in dependency_graph.object_instances:
+            blender_object = instance.object  # Only valid while iterating. Don't store this.
+            if blender_object.type != 'MESH':
+                continue
+            if not instance.is_instance and not instance.show_self:
+                continue  # The object only instances other objects. It is not visible itself.
+            if self.use_selection:
+                instancer = instance.parent if instance.is_instance else blender_object
+                if not instancer.original.select_get():
+                    continue
 
             metadata = Metadata()
             metadata.retrieve(blender_object)
+            resource_key = (
+                blender_object.data.as_pointer(),
+                tuple(slot.material.name if slot.material else None for slot in blender_object.material_slots),
+                metadata["3mf:object_type"].value if "3mf:object_type" in metadata else None)
+            if resource_key in instanced_resources:
+                objectid = instanced_resources[resource_key]
+            else:
+                try:
+                    mesh = blender_object.to_mesh()
+                except RuntimeError:  # Object.to_mesh() is not guaranteed to return Optional[Mesh], apparently.
+                    mesh = None
+                if mesh is None or len(mesh.vertices) == 0:
+                    instanced_resources[resource_key] = None
+                    continue
+                mesh.calc_loop_triangles()
+                object_attrib = {}
+                object_metadata = Metadata()
+                object_metadata.retrieve(blender_object)
+                if "3mf:object_type" in object_metadata:
+                    object_type = object_metadata["3mf:object_type"].value
+                    if object_type != "model" and object_type != "other":  # We're not allowed to refer to "other".
+                        object_attrib[f"{{{MODEL_NAMESPACE}}}type"] = object_type
+                    del object_metadata["3mf:object_type"]
+                if "3mf:partnumber" in object_metadata:
+                    del object_metadata["3mf:partnumber"]  # Written on the build items instead, since it may differ.
+                objectid = self.write_mesh_object(writer, blender_object, mesh, object_attrib, object_metadata)
+                instanced_resources[resource_key] = objectid
+            if objectid is None:
+                continue  # This mesh is empty.
+
+            self.num_written += 1
+            if "3mf:object_type" in metadata:
+                del metadata["3mf:object_type"]
+            build_items.append(BuildItem(
+                objectid=objectid,
+                transformation=transformation @ instance.matrix_world,
+                metadata=metadata))
+        return build_items
+
+    def write_build(self, writer, build_items):
+        """
+        Writes the <build> element of the 3MF document.
+        :param writer: The writer of the 3MF document, after the <resources> element.
+        :param build_items: The `BuildItem`s to write into the build.
+        """
+        writer.start(f"{{{MODEL_NAMESPACE}}}build")
+        for build_item in build_items:
+            item_attrib = {f"{{{MODEL_NAMESPACE}}}objectid": str(build_item.objectid)}
+            if build_item.transformation != mathutils.Matrix.Identity(4):
+                item_attrib[f"{{{MODEL_NAMESPACE}}}transform"] = self.format_transformation(build_item.transformation)
+
+            metadata = build_item.metadata
             if "3mf:partnumber" in metadata:
-                item_element.attrib[f"{{{MODEL_NAMESPACE}}}partnumber"] = metadata["3mf:partnumber"].value
+                item_attrib[f"{{{MODEL_NAMESPACE}}}partnumber"] = metadata["3mf:partnumber"].value
                 del metadata["3mf:partnumber"]
             if metadata:
-                metadatagroup_element = xml.etree.ElementTree.SubElement(
-                    item_element,
-                    f"{{{MODEL_NAMESPACE}}}metadatagroup")
-                self.write_metadata(metadatagroup_element, metadata)
-
-    def write_object_resource(self, resources_element, blender_object):
+                writer.start(f"{{{MODEL_NAMESPACE}}}item", item_attrib)
+                writer.start(f"{{{MODEL_NAMESPACE}}}metadatagroup")
+                self.write_metadata(writer, metadata)
+                writer.end(f"{{{MODEL_NAMESPACE}}}metadatagroup")
+                writer.end(f"{{{MODEL_NAMESPACE}}}item")
+            else:
+                writer.element(f"{{{MODEL_NAMESPACE}}}item", item_attrib)
+        writer.end(f"{{{MODEL_NAMESPACE}}}build")
+
+    def write_object_resource(self, writer, blender_object, is_component=False):
         """
         Write a single Blender object and all of its children to the resources of a 3MF document.
 
         If the object contains a mesh it'll get written to the document as an object with a mesh resource. If the object
         contains children it'll get written to the document as an object with components. If the object contains both,
         two objects will be written; one with the mesh and another with the components. The mesh then gets added as a
-        component of the object with components.
-        :param resources_element: The <resources> element of the 3MF document to write into.
-        :param blender_object: A Blender object to write to that XML element.
-        :return: A tuple, containing the object ID of the newly written resource and a transformation matrix that this
-        resource must be saved with.
+        component of the object with components. Meshes that were already written for another object are not written
+        again, but referred to.
+
+        An empty that instances a collection, like the sub-assemblies that are used in multiple places get imported, is
+        written as an object with a component that refers to the objects of that collection. See
+        `write_collection_resource`.
+
+        Resources may only refer to resources that were written before them, so the children are written first.
+        :param writer: The writer of the 3MF document, while it is in the <resources> element.
+        :param blender_object: A Blender object to write to the document.
+        :param is_component: Whether the object is a component of another object, rather than getting a build item of
+        its own.
+        :return: A tuple, containing the object ID of the resource and a transformation matrix that this resource must
+        be saved with.
         """
-        new_resource_id = self.next_resource_id
-        self.next_resource_id += 1
-        object_element = xml.etree.ElementTree.SubElement(resources_element, f"{{{MODEL_NAMESPACE}}}object")
-        object_element.attrib[f"{{{MODEL_NAMESPACE}}}id"] = str(new_resource_id)
+        object_attrib = {}  # The ID is added when the object is written, after its children got theirs.
 
         metadata = Metadata()
         metadata.retrieve(blender_object)
         if "3mf:object_type" in metadata:
             object_type = metadata["3mf:object_type"].value
             if object_type != "model":  # Only write if not the default.
-                object_element.attrib[f"{{{MODEL_NAMESPACE}}}type"] = object_type
+                object_attrib[f"{{{MODEL_NAMESPACE}}}type"] = object_type
             del metadata["3mf:object_type"]
 
         if blender_object.mode == 'EDIT':
@@ -313,26 +599,32 @@ class Export3MF(bpy.types.Operator, bpy_extras.io_utils.ExportHelper):
         mesh_transformation = blender_object.matrix_world
 
         child_objects = blender_object.children
-        if child_objects:  # Only write the <components> tag if there are actually components.
-            components_element = xml.etree.ElementTree.SubElement(
-                object_element,
-                f"{{{MODEL_NAMESPACE}}}components")
-            for child in blender_object.children:
-                if child.type != 'MESH':
-                    continue
-                # Recursively write children to the resources.
-                child_id, child_transformation = self.write_object_resource(resources_element, child)
-                # Use pseudo-inverse for safety, but the epsilon then doesn't matter since it'll get multiplied by 0
-                # later anyway then.
-                child_transformation = mesh_transformation.inverted_safe() @ child_transformation
-                component_element = xml.etree.ElementTree.SubElement(
-                    components_element,
-                    f"{{{MODEL_NAMESPACE}}}component")
+        component_attribs = []  # Only write the <components> tag if there are actually components.
+        for child in child_objects:
+            if child.type != 'MESH' and self.instanced_collection(child) is None:
+                continue
+            # Recursively write children to the resources.
+            child_id, child_transformation = self.write_object_resource(writer, child, is_component=True)
+            # Use pseudo-inverse for safety, but the epsilon then doesn't matter since it'll get multiplied by 0
+            # later anyway then.
+            child_transformation = mesh_transformation.inverted_safe() @ child_transformation
+            self.num_written += 1
+            component_attrib = {f"{{{MODEL_NAMESPACE}}}objectid": str(child_id)}
+            if child_transformation != mathutils.Matrix.Identity(4):
+                component_attrib[f"{{{MODEL_NAMESPACE}}}transform"] = self.format_transformation(child_transformation)
+            component_attribs.append(component_attrib)
+
+        collection = self.instanced_collection(blender_object)
+        if collection is not None:
+            collection_id = self.write_collection_resource(writer, collection)
+            if collection_id is not None:
                 self.num_written += 1
-                component_element.attrib[f"{{{MODEL_NAMESPACE}}}objectid"] = str(child_id)
-                if child_transformation != mathutils.Matrix.Identity(4):
-                    component_element.attrib[f"{{{MODEL_NAMESPACE}}}transform"] =\
-                        self.format_transformation(child_transformation)
+                component_attrib = {f"{{{MODEL_NAMESPACE}}}objectid": str(collection_id)}
+                # The instance offset of the collection is placed at the origin of the empty.
+                offset = mathutils.Matrix.Translation([-coordinate for coordinate in collection.instance_offset])
+                if offset != mathutils.Matrix.Identity(4):
+                    component_attrib[f"{{{MODEL_NAMESPACE}}}transform"] = self.format_transformation(offset)
+                component_attribs.append(component_attrib)
 
         # In the tail recursion, get the vertex data.
         # This is necessary because we may need to apply the mesh modifiers, which causes these objects to lose their
@@ -344,96 +636,229 @@ class Export3MF(bpy.types.Operator, bpy_extras.io_utils.ExportHelper):
         try:
             mesh = blender_object.to_mesh()
         except RuntimeError:  # Object.to_mesh() is not guaranteed to return Optional[Mesh], apparently.
-            return new_resource_id, mesh_transformation
-        if mesh is None:
-            return new_resource_id, mesh_transformation
-
-        # Need to convert this to triangles-only, because 3MF doesn't support faces with more than 3 vertices.
-        mesh.calc_loop_triangles()
+            mesh = None
 
-        if len(mesh.vertices) > 0:  # Only write a <mesh> tag if there is mesh data.
+        if mesh is not None:
+            # Need to convert this to triangles-only, because 3MF doesn't support faces with more than 3 vertices.
+            mesh.calc_loop_triangles()
+        if mesh is not None and len(mesh.vertices) > 0:  # Only write a <mesh> tag if there is mesh data.
             # If this object already contains components, we can't also store a mesh. So create a new object and use
             # that object as another component.
             if child_objects:
-                mesh_id = self.next_resource_id
-                self.next_resource_id += 1
-                mesh_object_element = xml.etree.ElementTree.SubElement(
-                    resources_element,
-                    f"{{{MODEL_NAMESPACE}}}object")
-                mesh_object_element.attrib[f"{{{MODEL_NAMESPACE}}}id"] = str(mesh_id)
-                component_element = xml.etree.ElementTree.SubElement(
-                    components_element,
-                    f"{{{MODEL_NAMESPACE}}}component")
-                self.num_written += 1
-                component_element.attrib[f"{{{MODEL_NAMESPACE}}}objectid"] = str(mesh_id)
+                mesh_object_attrib = {}
             else:  # No components, then we can write directly into this object resource.
-                mesh_object_element = object_element
-            mesh_element = xml.etree.ElementTree.SubElement(mesh_object_element, f"{{{MODEL_NAMESPACE}}}mesh")
-
-            # Find the most common material for this mesh, for maximum compression.
-            material_indices = [triangle.material_index for triangle in mesh.loop_triangles]
-            # If there are no triangles, we provide 0 as index, but it'll not get read by write_triangles either then.
-            most_common_material_list_index = 0
-
-            if material_indices and blender_object.material_slots:
-                counter = collections.Counter(material_indices)
-                # most_common_material_object_index is an index from the MeshLoopTriangle, referring to the list of
-                # materials attached to the Blender object.
-                most_common_material_object_index = counter.most_common(1)[0][0]
-                most_common_material = blender_object.material_slots[most_common_material_object_index].material
-                # most_common_material_list_index is an index referring to our own list of materials that we put in the
-                # resources.
-                most_common_material_list_index = self.material_name_to_index[most_common_material.name]
-                # We always only write one group of materials. The resource ID was determined when it was written.
-                object_element.attrib[f"{{{MODEL_NAMESPACE}}}pid"] = str(self.material_resource_id)
-                object_element.attrib[f"{{{MODEL_NAMESPACE}}}pindex"] = str(most_common_material_list_index)
-
-            self.write_vertices(mesh_element, mesh.vertices)
-            self.write_triangles(
-                mesh_element,
-                mesh.loop_triangles,
-                most_common_material_list_index,
-                blender_object.material_slots)
-
-            # Write triangle sets (v1.3.0 feature) if the mesh has multiple materials
-            if len(blender_object.material_slots) > 1:
-                self.write_trianglesets(mesh_element, mesh.loop_triangles, blender_object.material_slots)
+                mesh_object_attrib = object_attrib
 
             # If the object has metadata, write that to a metadata object.
             if "3mf:partnumber" in metadata:
-                mesh_object_element.attrib[f"{{{MODEL_NAMESPACE}}}partnumber"] =\
-                    metadata["3mf:partnumber"].value
+                mesh_object_attrib[f"{{{MODEL_NAMESPACE}}}partnumber"] = metadata["3mf:partnumber"].value
                 del metadata["3mf:partnumber"]
-            if "3mf:object_type" in metadata:
-                object_type = metadata["3mf:object_type"].value
-                if object_type != "model" and object_type != "other":
-                    # Only write if not the default.
-                    # Don't write "other" object types since we're not allowed to refer to them. Pretend they are normal
-                    # models.
-                    mesh_object_element.attrib[f"{{{MODEL_NAMESPACE}}}type"] = object_type
-                del metadata["3mf:object_type"]
-            if metadata:
-                metadatagroup_element = xml.etree.ElementTree.SubElement(
-                    object_element,
-                    f"{{{MODEL_NAMESPACE}}}metadatagroup")
-                self.write_metadata(metadatagroup_element, metadata)
+
+            if child_objects:
+                num_meshes = len(self.mesh_resources)
+                mesh_id = self.write_mesh_object(
+                    writer, blender_object, mesh, mesh_object_attrib, None, is_component=True)
+                if len(self.mesh_resources) > num_meshes:  # Not a mesh that was already written for another object.
+                    self.num_written += 1
+                component_attribs.append({f"{{{MODEL_NAMESPACE}}}objectid": str(mesh_id)})
+            else:
+                mesh_id = self.write_mesh_object(
+                    writer, blender_object, mesh, mesh_object_attrib, metadata, is_component)
+                return mesh_id, mesh_transformation
+        else:
+            metadata = None  # Only objects with mesh data get their metadata written.
+
+        new_resource_id = self.next_resource_id
+        self.next_resource_id += 1
+        writer.start(f"{{{MODEL_NAMESPACE}}}object", {
+            f"{{{MODEL_NAMESPACE}}}id": str(new_resource_id),
+            **object_attrib
+        })
+        self.write_object_metadata(writer, metadata)
+        if component_attribs:
+            writer.start(f"{{{MODEL_NAMESPACE}}}components")
+            for component_attrib in component_attribs:
+                writer.element(f"{{{MODEL_NAMESPACE}}}component", component_attrib)
+            writer.end(f"{{{MODEL_NAMESPACE}}}components")
+        writer.end(f"{{{MODEL_NAMESPACE}}}object")
 
         return new_resource_id, mesh_transformation
 
-    def write_metadata(self, node, metadata):
+    def instanced_collection(self, blender_object):
+        """
+        Get the collection that a Blender object instances, if any.
+        :param blender_object: A Blender object.
+        :return: The collection that the object instances, or `None` if it doesn't instance a collection.
+        """
+        if blender_object.type != 'EMPTY' or blender_object.instance_type != 'COLLECTION':
+            return None
+        return blender_object.instance_collection
+
+    def with_instanced_objects(self, blender_objects):
+        """
+        Adds the objects in the collections that the given objects instance, since those get written along with them.
+        :param blender_objects: A list of Blender objects.
+        :return: A list of those objects, followed by the objects in the collections that they instance, recursively.
+        """
+        result = list(blender_objects)
+        visited = set()
+        for blender_object in result:  # Objects get added while iterating, to find collections instanced by those.
+            collection = self.instanced_collection(blender_object)
+            if collection is not None and collection not in visited:
+                visited.add(collection)
+                result.extend(collection.all_objects)
+        return result
+
+    def write_collection_resource(self, writer, collection):
+        """
+        Write the objects in an instanced collection to the resources of a 3MF document, as one object with components.
+
+        Each collection is written only once, no matter how often it is instanced. The objects in it are written as
+        components at their place relative to the origin of the collection. Their children are written along with them.
+        :param writer: The writer of the 3MF document, while it is in the <resources> element.
+        :param collection: The collection to write.
+        :return: The object ID of the resource, or `None` if there is nothing in the collection to write.
+        """
+        if collection in self.collection_resources:
+            return self.collection_resources[collection]
+        self.collection_resources[collection] = None  # While writing it, instances of itself can't refer to it.
+
+        collection_objects = set(collection.all_objects)
+        component_attribs = []
+        for blender_object in collection.all_objects:
+            if blender_object.parent is not None and blender_object.parent in collection_objects:
+                continue  # Written along with its parent.
+            if blender_object.type not in {'MESH', 'EMPTY'}:
+                continue
+            objectid, transformation = self.write_object_resource(writer, blender_object, is_component=True)
+            self.num_written += 1
+            component_attrib = {f"{{{MODEL_NAMESPACE}}}objectid": str(objectid)}
+            if transformation != mathutils.Matrix.Identity(4):
+                component_attrib[f"{{{MODEL_NAMESPACE}}}transform"] = self.format_transformation(transformation)
+            component_attribs.append(component_attrib)
+        if not component_attribs:
+            return None
+
+        resource_id = self.next_resource_id
+        self.next_resource_id += 1
+        writer.start(f"{{{MODEL_NAMESPACE}}}object", {f"{{{MODEL_NAMESPACE}}}id": str(resource_id)})
+        writer.start(f"{{{MODEL_NAMESPACE}}}components")
+        for component_attrib in component_attribs:
+            writer.element(f"{{{MODEL_NAMESPACE}}}component", component_attrib)
+        writer.end(f"{{{MODEL_NAMESPACE}}}components")
+        writer.end(f"{{{MODEL_NAMESPACE}}}object")
+        self.collection_resources[collection] = resource_id
+        return resource_id
+
+    def write_mesh_object(self, writer, blender_object, mesh, object_attrib, metadata, is_component=False):
+        """
+        Write an object resource containing the mesh of a Blender object.
+
+        If a mesh was already written for an earlier object with identical geometry and materials, such as a linked
+        duplicate, that resource is used again instead of writing the mesh another time. The metadata of the resource
+        is then the metadata of the first object. Build items carry the metadata of their own object too, so objects
+        that get a build item share resources regardless of their metadata. Components can't carry metadata, so objects
+        that are components only share resources with objects that have the same metadata.
+        :param writer: The writer of the 3MF document, while it is in the <resources> element.
+        :param blender_object: The Blender object that the mesh belongs to, which holds its material slots.
+        :param mesh: The mesh to write, with its loop triangles calculated.
+        :param object_attrib: The attributes to write on the <object> element, except its ID.
+        :param metadata: The metadata to write in the object, if any.
+        :param is_component: Whether the object is a component of another object, rather than getting a build item of
+        its own.
+        :return: The object ID of the resource containing the mesh.
+        """
+        # Get the geometry all at once. The material indices of the triangles refer to the material slots of the
+        # Blender object. Convert them to indices referring to our own list of materials in the resources.
+        coordinates = numpy.empty((len(mesh.vertices), 3), dtype=numpy.float32)
+        mesh.vertices.foreach_get("co", coordinates.ravel())
+        triangles = mesh.loop_triangles
+        triangle_vertices = numpy.empty((len(triangles), 3), dtype=numpy.int32)
+        triangles.foreach_get("vertices", triangle_vertices.ravel())
+        slot_indices = numpy.empty(len(triangles), dtype=numpy.int32)
+        triangles.foreach_get("material_index", slot_indices)
+        material_indices = self.material_list_indices(slot_indices, blender_object.material_slots)
+        attribute_sets = self.attribute_trianglesets(mesh)
+
+        # Find the most common material for this mesh, for maximum compression.
+        # If there are no triangles, we provide 0 as index, but it'll not get read by write_triangles either then.
+        object_attrib = dict(object_attrib)
+        most_common_material_list_index = 0
+        triangle_materials = material_indices[material_indices >= 0]
+        if len(triangle_materials) > 0:
+            most_common_material_list_index = int(numpy.bincount(triangle_materials).argmax())
+            # We always only write one group of materials. The resource ID was determined when it was written.
+            object_attrib[f"{{{MODEL_NAMESPACE}}}pid"] = str(self.material_resource_id)
+            object_attrib[f"{{{MODEL_NAMESPACE}}}pindex"] = str(most_common_material_list_index)
+
+        required_metadata = (metadata or Metadata()) if is_component else None
+        geometry_key = self.geometry_key(
+            coordinates, triangle_vertices, material_indices, attribute_sets, object_attrib, required_metadata)
+        if geometry_key in self.mesh_resources:  # Identical to a mesh we wrote before. Refer to that one.
+            return self.mesh_resources[geometry_key]
+        mesh_id = self.next_resource_id
+        self.next_resource_id += 1
+        self.mesh_resources[geometry_key] = mesh_id
+
+        writer.start(f"{{{MODEL_NAMESPACE}}}object", {f"{{{MODEL_NAMESPACE}}}id": str(mesh_id), **object_attrib})
+        self.write_object_metadata(writer, metadata)
+        writer.start(f"{{{MODEL_NAMESPACE}}}mesh")
+        self.write_vertices(writer, coordinates)
+        self.write_triangles(writer, triangle_vertices, material_indices, most_common_material_list_index)
+
+        self.write_trianglesets(writer, slot_indices, blender_object.material_slots, attribute_sets)
+        writer.end(f"{{{MODEL_NAMESPACE}}}mesh")
+        writer.end(f"{{{MODEL_NAMESPACE}}}object")
+        return mesh_id
+
+    def geometry_key(self, coordinates, triangle_vertices, material_indices, attribute_sets, object_attrib, metadata):
         """
-        Writes metadata from a metadata storage into an XML node.
-        :param node: The node to add <metadata> tags to.
-        :param metadata: The collection of metadata to write to that node.
+        Summarise everything that gets written in a mesh object resource, to find objects that would be identical.
+        :param coordinates: An array of the coordinates of each vertex.
+        :param triangle_vertices: An array of the three vertex indices of each triangle.
+        :param material_indices: An array of the index in our list of materials of each triangle.
+        :param attribute_sets: The triangle sets stored as attributes of the mesh, as given by `attribute_trianglesets`.
+        :param object_attrib: The attributes of the <object> element, except its ID.
+        :param metadata: The metadata that the object must have, or `None` if it may have the metadata of any object.
+        :return: A hashable key, which is equal for meshes that are written the same way.
+        """
+        geometry_hash = hashlib.sha256()
+        for array in (coordinates, triangle_vertices, material_indices):
+            geometry_hash.update(array.tobytes())
+        for name, triangle_indices in attribute_sets:
+            geometry_hash.update(name.encode("UTF-8") + b"\0" + triangle_indices.tobytes())
+        if metadata is None:
+            metadata_key = None
+        else:
+            metadata_key = tuple(
+                (entry.name, entry.preserve, entry.datatype, entry.value) for entry in metadata.values())
+        return (len(coordinates), len(triangle_vertices), geometry_hash.digest(), tuple(object_attrib.items()),
+                metadata_key)
+
+    def write_object_metadata(self, writer, metadata):
+        """
+        Writes the <metadatagroup> of an object, if it has any metadata.
+        :param writer: The writer of the 3MF document, while it is in the <object> element.
+        :param metadata: The collection of metadata of the object.
+        """
+        if metadata:
+            writer.start(f"{{{MODEL_NAMESPACE}}}metadatagroup")
+            self.write_metadata(writer, metadata)
+            writer.end(f"{{{MODEL_NAMESPACE}}}metadatagroup")
+
+    def write_metadata(self, writer, metadata):
+        """
+        Writes metadata from a metadata storage into the element that the document is in.
+        :param writer: The writer of the 3MF document, while it is in the element to add <metadata> tags to.
+        :param metadata: The collection of metadata to write to that element.
         """
         for metadata_entry in metadata.values():
-            metadata_node = xml.etree.ElementTree.SubElement(node, f"{{{MODEL_NAMESPACE}}}metadata")
-            metadata_node.attrib[f"{{{MODEL_NAMESPACE}}}name"] = metadata_entry.name
+            metadata_attrib = {f"{{{MODEL_NAMESPACE}}}name": metadata_entry.name}
             if metadata_entry.preserve:
-                metadata_node.attrib[f"{{{MODEL_NAMESPACE}}}preserve"] = "1"
+                metadata_attrib[f"{{{MODEL_NAMESPACE}}}preserve"] = "1"
             if metadata_entry.datatype:
-                metadata_node.attrib[f"{{{MODEL_NAMESPACE}}}type"] = metadata_entry.datatype
-            metadata_node.text = metadata_entry.value
+                metadata_attrib[f"{{{MODEL_NAMESPACE}}}type"] = metadata_entry.datatype
+            writer.element(f"{{{MODEL_NAMESPACE}}}metadata", metadata_attrib, metadata_entry.value)
 
     def format_transformation(self, transformation):
         """
@@ -451,108 +876,266 @@ class Export3MF(bpy.types.Operator, bpy_extras.io_utils.ExportHelper):
             result += self.format_number(cell, 6)  # Never use scientific notation!
         return result
 
-    def write_vertices(self, mesh_element, vertices):
+    def write_vertices(self, writer, coordinates):
         """
-        Writes a list of vertices into the specified mesh element.
+        Writes a list of vertices into the mesh element that the document is in.
 
         This then becomes a resource that can be used in a build.
-        :param mesh_element: The <mesh> element of the 3MF document.
-        :param vertices: A list of Blender vertices to add.
+        The coordinates are formatted in big blocks of <vertex> elements with a single string formatting operation,
+        formatting the same way as `format_number`. The blocks are formatted on the threads of the writer.
+        :param writer: The writer of the 3MF document, while it is in the <mesh> element.
+        :param coordinates: An array of the coordinates of each vertex, as retrieved from Blender.
         """
-        vertices_element = xml.etree.ElementTree.SubElement(mesh_element, f"{{{MODEL_NAMESPACE}}}vertices")
+        writer.start(f"{{{MODEL_NAMESPACE}}}vertices")
+
+        coordinates = coordinates.ravel()
+
+        # Precompute the names, as written in the document, and the format of a whole <vertex> element.
+        vertex_name = writer.qualified_name(f"{{{MODEL_NAMESPACE}}}vertex")
+        x_name = writer.qualified_name(f"{{{MODEL_NAMESPACE}}}x")
+        y_name = writer.qualified_name(f"{{{MODEL_NAMESPACE}}}y")
+        z_name = writer.qualified_name(f"{{{MODEL_NAMESPACE}}}z")
+        number_format = f"%.{self.coordinate_precision}f"
+        vertex_format = f"<{vertex_name} {x_name}=\"{number_format}\" {y_name}=\"{number_format}\" " \
+            f"{z_name}=\"{number_format}\" />"
+
+        for start in range(0, len(coordinates), VERTICES_PER_BLOCK * 3):
+            block = coordinates[start:start + VERTICES_PER_BLOCK * 3]
+            writer.defer(self.format_vertices, vertex_format, block, self.coordinate_precision)
 
-        # Precompute some names for better performance.
-        vertex_name = f"{{{MODEL_NAMESPACE}}}vertex"
-        x_name = f"{{{MODEL_NAMESPACE}}}x"
-        y_name = f"{{{MODEL_NAMESPACE}}}y"
-        z_name = f"{{{MODEL_NAMESPACE}}}z"
+        writer.end(f"{{{MODEL_NAMESPACE}}}vertices")
 
-        for vertex in vertices:  # Create the <vertex> elements.
-            vertex_element = xml.etree.ElementTree.SubElement(vertices_element, vertex_name)
-            vertex_element.attrib[x_name] = self.format_number(vertex.co[0], self.coordinate_precision)
-            vertex_element.attrib[y_name] = self.format_number(vertex.co[1], self.coordinate_precision)
-            vertex_element.attrib[z_name] = self.format_number(vertex.co[2], self.coordinate_precision)
+    def format_vertices(self, vertex_format, coordinates, precision):
+        """
+        Formats a block of vertices.
+
+        This doesn't access any Blender data, so that it may be executed on any thread.
+        :param vertex_format: The format of a single <vertex> element, with a placeholder for each coordinate.
+        :param coordinates: A flat array of the coordinates of the vertices.
+        :param precision: The number of decimals that the format has for each coordinate.
+        :return: The serialized <vertex> elements.
+        """
+        serialized = (vertex_format * (len(coordinates) // 3)) % tuple(coordinates.tolist())
+        if precision > 0:  # Strip trailing zeros, and then the radix if nothing remains after it.
+            serialized = TRAILING_ZEROS.sub(r'\1"', serialized).replace('."', '"')
+        return serialized
 
-    def write_triangles(self, mesh_element, triangles, object_material_list_index, material_slots):
+    def material_list_indices(self, slot_indices, material_slots):
+        """
+        Convert the material indices of triangles in Blender to indices in our list of materials in the resources.
+
+        The material indices in Blender refer to the material slots of the object. Our list of materials is in the
+        <basematerials> element, which holds the materials of all objects.
+        :param slot_indices: An array of the material slot index of each triangle.
+        :param material_slots: The material slots of the object that the triangles belong to.
+        :return: An array with the index in our list of materials of each triangle, or -1 if the triangle has no
+        material.
         """
-        Writes a list of triangles into the specified mesh element.
+        # One extra entry at the end, for triangles that refer to slots that don't exist.
+        slot_to_list_index = numpy.full(len(material_slots) + 1, -1, dtype=numpy.int32)
+        for slot_index, material_slot in enumerate(material_slots):
+            if material_slot.material is not None:
+                slot_to_list_index[slot_index] = self.material_name_to_index[material_slot.material.name]
+        slot_indices = numpy.where(
+            (slot_indices >= 0) & (slot_indices < len(material_slots)),
+            slot_indices,
+            len(material_slots))
+        return slot_to_list_index[slot_indices]
+
+    def write_triangles(self, writer, vertices, material_indices, object_material_list_index):
+        """
+        Writes a list of triangles into the mesh element that the document is in.
 
         This then becomes a resource that can be used in a build.
-        :param mesh_element: The <mesh> element of the 3MF document.
-        :param triangles: A list of triangles. Each list is a list of indices to the list of vertices.
+
+        The triangles are formatted in big blocks of <triangle> elements with a single string formatting operation. The
+        blocks are formatted on the threads of the writer.
+        :param writer: The writer of the 3MF document, while it is in the <mesh> element.
+        :param vertices: An array of the three vertex indices of each triangle.
+        :param material_indices: An array of the index in our list of materials of each triangle, or -1 if the triangle
+        has no material.
         :param object_material_list_index: The index of the material that the object was written with to which these
         triangles belong. If the triangle has a different index, we need to write the index with the triangle.
-        :param material_slots: List of materials belonging to the object for which we write triangles. These are
-        necessary to interpret the material indices stored in the MeshLoopTriangles.
         """
-        triangles_element = xml.etree.ElementTree.SubElement(mesh_element, f"{{{MODEL_NAMESPACE}}}triangles")
-
-        # Precompute some names for better performance.
-        triangle_name = f"{{{MODEL_NAMESPACE}}}triangle"
-        v1_name = f"{{{MODEL_NAMESPACE}}}v1"
-        v2_name = f"{{{MODEL_NAMESPACE}}}v2"
-        v3_name = f"{{{MODEL_NAMESPACE}}}v3"
-        p1_name = f"{{{MODEL_NAMESPACE}}}p1"
-
-        for triangle in triangles:
-            triangle_element = xml.etree.ElementTree.SubElement(triangles_element, triangle_name)
-            triangle_element.attrib[v1_name] = str(triangle.vertices[0])
-            triangle_element.attrib[v2_name] = str(triangle.vertices[1])
-            triangle_element.attrib[v3_name] = str(triangle.vertices[2])
+        writer.start(f"{{{MODEL_NAMESPACE}}}triangles")
+
+        # Precompute the names, as written in the document, and the format of whole <triangle> elements.
+        triangle_name = writer.qualified_name(f"{{{MODEL_NAMESPACE}}}triangle")
+        v1_name = writer.qualified_name(f"{{{MODEL_NAMESPACE}}}v1")
+        v2_name = writer.qualified_name(f"{{{MODEL_NAMESPACE}}}v2")
+        v3_name = writer.qualified_name(f"{{{MODEL_NAMESPACE}}}v3")
+        p1_name = writer.qualified_name(f"{{{MODEL_NAMESPACE}}}p1")
+        triangle_format = f"<{triangle_name} {v1_name}=\"%d\" {v2_name}=\"%d\" {v3_name}=\"%d\" />"
+        material_triangle_format = f"<{triangle_name} {v1_name}=\"%d\" {v2_name}=\"%d\" {v3_name}=\"%d\" " \
+            f"{p1_name}=\"%d\" />"
+
+        # Triangles with a different material than the object must override it here, with a p1 attribute.
+        has_p1 = (material_indices >= 0) & (material_indices != object_material_list_index)
+
+        for start in range(0, len(vertices), TRIANGLES_PER_BLOCK):
+            writer.defer(
+                self.format_triangles,
+                triangle_format,
+                material_triangle_format,
+                vertices[start:start + TRIANGLES_PER_BLOCK],
+                material_indices[start:start + TRIANGLES_PER_BLOCK],
+                has_p1[start:start + TRIANGLES_PER_BLOCK])
+
+        writer.end(f"{{{MODEL_NAMESPACE}}}triangles")
+
+    def format_triangles(self, triangle_format, material_triangle_format, vertices, material_indices, has_p1):
+        """
+        Formats a block of triangles.
+
+        This doesn't access any Blender data, so that it may be executed on any thread.
+        :param triangle_format: The format of a <triangle> element, with a placeholder for each vertex index.
+        :param material_triangle_format: The format of a <triangle> element with a p1 attribute, with a placeholder for
+        each vertex index and one for the material index.
+        :param vertices: An array of the three vertex indices of each triangle.
+        :param material_indices: An array of the index in our list of materials of each triangle.
+        :param has_p1: An array indicating for each triangle whether it needs a p1 attribute.
+        :return: The serialized <triangle> elements.
+        """
+        if not has_p1.any():
+            return (triangle_format * len(vertices)) % tuple(vertices.ravel().tolist())
+        # Put the p1 in a 4th column, and leave it out of the triangles that don't have it.
+        values = numpy.empty((len(vertices), 4), dtype=numpy.int64)
+        values[:, :3] = vertices
+        values[:, 3] = material_indices
+        written = numpy.ones((len(vertices), 4), dtype=bool)
+        written[:, 3] = has_p1
+        block_format = "".join(numpy.where(has_p1, material_triangle_format, triangle_format).tolist())
+        return block_format % tuple(values[written].tolist())
+
+    def attribute_trianglesets(self, mesh):
+        """
+        Finds the triangle sets that are stored in a mesh as boolean face attributes, the way they are imported.
 
-            if triangle.material_index < len(material_slots):
-                # Convert to index in our global list.
-                material_index = self.material_name_to_index[material_slots[triangle.material_index].material.name]
-                if material_index != object_material_list_index:
-                    # Not equal to the index that our parent object was written with, so we must override it here.
-                    triangle_element.attrib[p1_name] = str(material_index)
+        Each face of the mesh may consist of multiple triangles. All of those triangles are in the set if the face is.
+        Attributes that Blender uses internally, or for its own purposes such as flat shading, are not triangle sets.
+        :param mesh: The mesh to find the triangle sets in, with its loop triangles calculated.
+        :return: A list of tuples with the name of each attribute and the sorted array of the triangles in the set.
+        Sets without triangles are left out.
+        """
+        result = []
+        polygon_indices = None  # The face of each triangle. Only retrieved if the mesh has any sets.
+        for attribute in mesh.attributes:
+            if attribute.data_type != 'BOOLEAN' or attribute.domain != 'FACE':
+                continue
+            if attribute.is_internal or attribute.name in BUILTIN_FACE_ATTRIBUTES:
+                continue
+            if polygon_indices is None:
+                polygon_indices = numpy.empty(len(mesh.loop_triangles), dtype=numpy.int32)
+                mesh.loop_triangles.foreach_get("polygon_index", polygon_indices)
+            in_set = numpy.empty(len(mesh.polygons), dtype=bool)
+            attribute.data.foreach_get("value", in_set)
+            triangle_indices = numpy.flatnonzero(in_set[polygon_indices])
+            if len(triangle_indices) > 0:
+                result.append((attribute.name, triangle_indices))
+        return result
 
-    def write_trianglesets(self, mesh_element, triangles, material_slots):
+    def write_trianglesets(self, writer, slot_indices, material_slots, attribute_sets=()):
         """
-        Writes triangle sets into the specified mesh element (v1.3.0 feature).
+        Writes triangle sets into the mesh element that the document is in (v1.3.0 feature).
 
         Triangle sets are non-geometric groupings for organizational purposes per 3MF spec §4.1.5.1.
-        They do not affect geometry or material assignments. We export them grouped by material
-        for organizational purposes, but consumers may ignore this information.
-        :param mesh_element: The <mesh> element of the 3MF document.
-        :param triangles: A list of triangles (MeshLoopTriangles).
+        They do not affect geometry or material assignments. The sets that are stored as boolean face attributes of the
+        mesh are written with the name of the attribute as name and identifier. If the mesh has multiple materials, we
+        also export sets grouped by material for organizational purposes, but consumers may ignore this information.
+        :param writer: The writer of the 3MF document, while it is in the <mesh> element.
+        :param slot_indices: An array of the material slot index of each triangle.
         :param material_slots: List of materials belonging to the object.
+        :param attribute_sets: The triangle sets stored as attributes of the mesh, as given by `attribute_trianglesets`.
         """
-        # Group triangles by material for organizational purposes
+        # The triangle sets to write, each with its name, its identifier and the sorted array of its triangles.
+        trianglesets = [(name, name, triangle_indices) for name, triangle_indices in attribute_sets]
+
+        # Group triangles by material for organizational purposes, in order of the first triangle with each material.
         material_to_triangles = {}
-        for tri_idx, triangle in enumerate(triangles):
-            mat_idx = triangle.material_index
-            if mat_idx < len(material_slots) and material_slots[mat_idx].material:
-                material_name = material_slots[mat_idx].material.name
-                if material_name not in material_to_triangles:
-                    material_to_triangles[material_name] = []
-                material_to_triangles[material_name].append(tri_idx)
-
-        # Only write trianglesets if we have multiple material groups
+        if len(material_slots) > 1:
+            used_slots, first_triangles = numpy.unique(slot_indices, return_index=True)
+            for mat_idx in used_slots[numpy.argsort(first_triangles)].tolist():
+                if 0 <= mat_idx < len(material_slots) and material_slots[mat_idx].material:
+                    material_name = material_slots[mat_idx].material.name
+                    if material_name not in material_to_triangles:
+                        material_to_triangles[material_name] = numpy.flatnonzero(slot_indices == mat_idx)
+                    else:  # Multiple slots with the same material.
+                        material_to_triangles[material_name] = numpy.union1d(
+                            material_to_triangles[material_name],
+                            numpy.flatnonzero(slot_indices == mat_idx))
+
+        # Only write sets by material if we have multiple material groups
         if len(material_to_triangles) > 1:
-            # Triangle Sets MUST use the Triangle Sets extension namespace per spec §4.1.5 and Appendix C.3
-            trianglesets_element = xml.etree.ElementTree.SubElement(
-                mesh_element,
-                f"{{{TRIANGLESETS_NAMESPACE}}}trianglesets")
-
-            # Precompute names for performance
-            triangleset_name = f"{{{TRIANGLESETS_NAMESPACE}}}triangleset"
-            ref_name = f"{{{TRIANGLESETS_NAMESPACE}}}ref"
-
+            # Sets that were imported by material are already in the attributes. Don't write them twice.
+            attribute_triangles = {triangle_indices.tobytes() for _, triangle_indices in attribute_sets}
+            used_identifiers = {name for name, _ in attribute_sets}
             set_index = 0
             for material_name, triangle_indices in material_to_triangles.items():
-                triangleset_element = xml.etree.ElementTree.SubElement(
-                    trianglesets_element,
-                    triangleset_name)
-                # Both name and identifier are REQUIRED per spec §4.1.5.1 and XSD schema
-                triangleset_element.attrib["name"] = material_name
-                triangleset_element.attrib["identifier"] = f"ts_{set_index}"
+                if triangle_indices.tobytes() in attribute_triangles:
+                    continue
+                while f"ts_{set_index}" in used_identifiers:  # Identifiers must be unique within the mesh.
+                    set_index += 1
+                trianglesets.append((material_name, f"ts_{set_index}", triangle_indices))
                 set_index += 1
 
-                # Write each triangle index as a separate <ref> element per spec §4.1.5.2
-                for tri_idx in triangle_indices:
-                    ref_element = xml.etree.ElementTree.SubElement(triangleset_element, ref_name)
-                    ref_element.attrib["index"] = str(tri_idx)
+        if not trianglesets:
+            return
+        # Triangle Sets MUST use the Triangle Sets extension namespace per spec §4.1.5 and Appendix C.3
+        writer.start(f"{{{TRIANGLESETS_NAMESPACE}}}trianglesets")
+
+        # Precompute names for performance
+        triangleset_name = f"{{{TRIANGLESETS_NAMESPACE}}}triangleset"
+        ref_name = writer.qualified_name(f"{{{TRIANGLESETS_NAMESPACE}}}ref")
+        refrange_name = writer.qualified_name(f"{{{TRIANGLESETS_NAMESPACE}}}refrange")
+        index_name = writer.qualified_name("index")
+        start_name = writer.qualified_name("startindex")
+        end_name = writer.qualified_name("endindex")
+        ref_format = f"<{ref_name} {index_name}=\"%d\" />"
+        refrange_format = f"<{refrange_name} {start_name}=\"%d\" {end_name}=\"%d\" />"
+
+        for name, identifier, triangle_indices in trianglesets:
+            # Both name and identifier are REQUIRED per spec §4.1.5.1 and XSD schema
+            writer.start(triangleset_name, {
+                "name": name,
+                "identifier": identifier
+            })
+
+            # Write each run of consecutive triangles as one <refrange> element, and isolated triangles as <ref>
+            # elements per spec §4.1.5.2. The triangle indices are sorted, so a run ends wherever the next index
+            # is not one higher.
+            run_breaks = numpy.flatnonzero(numpy.diff(triangle_indices) != 1) + 1
+            run_starts = triangle_indices[numpy.concatenate(([0], run_breaks))]
+            run_ends = triangle_indices[numpy.concatenate((run_breaks - 1, [len(triangle_indices) - 1]))]
+            for start in range(0, len(run_starts), TRIANGLES_PER_BLOCK):
+                end = start + TRIANGLES_PER_BLOCK
+                writer.defer(self.format_refs, ref_format, refrange_format, run_starts[start:end],
+                             run_ends[start:end])
+            writer.end(triangleset_name)
+        writer.end(f"{{{TRIANGLESETS_NAMESPACE}}}trianglesets")
+
+    def format_refs(self, ref_format, refrange_format, run_starts, run_ends):
+        """
+        Formats a block of references to runs of consecutive triangles in a triangle set.
+
+        Runs of a single triangle are written as <ref> elements, longer runs as <refrange> elements.
+
+        This doesn't access any Blender data, so that it may be executed on any thread.
+        :param ref_format: The format of a single <ref> element, with a placeholder for the triangle index.
+        :param refrange_format: The format of a single <refrange> element, with placeholders for the first and last
+        triangle index of the run.
+        :param run_starts: An array of the index of the first triangle of each run.
+        :param run_ends: An array of the index of the last triangle of each run.
+        :return: The serialized <ref> and <refrange> elements.
+        """
+        is_range = run_starts != run_ends
+        if not is_range.any():  # Fast path for the common case of scattered triangles.
+            return (ref_format * len(run_starts)) % tuple(run_starts.tolist())
+        # Put the end of the run in a 2nd column, and leave it out of the runs of a single triangle.
+        values = numpy.stack((run_starts, run_ends), axis=1)
+        written = numpy.ones((len(run_starts), 2), dtype=bool)
+        written[:, 1] = is_range
+        block_format = "".join(numpy.where(is_range, refrange_format, ref_format).tolist())
+        return block_format % tuple(values[written].tolist())
 
     def format_number(self, number, decimals):
         """
@@ -564,7 +1147,7 @@ class Export3MF(bpy.types.Operator, bpy_extras.io_utils.ExportHelper):
         :param decimals: The maximum number of places after the radix to write.
         :return: A string representing that number.
         """
-        formatted = ("{:." + str(decimals) + "f}").format(number).rstrip("0").rstrip(".")
-        if formatted == "":
-            return "0"
+        formatted = ("{:." + str(decimals) + "f}").format(number)
+        if "." in formatted:  # Without decimals, the zeros are in the integer part. Those must stay.
+            formatted = formatted.rstrip("0").rstrip(".")
         return formatted
@@ -10,7 +10,6 @@
 
 # <pep8 compliant>
 
-import base64  # To encode MustPreserve files in the Blender scene.
 import bpy  # The Blender API.
 import bpy.ops  # To adjust the camera to fit models.
 import bpy.props  # To define metadata properties for the operator.
@@ -18,155 +17,120 @@ import bpy.types  # This class is an operator in Blender.
 import bpy_extras.io_utils  # Helper functions to import meshes more easily.
 import bpy_extras.node_shader_utils  # Getting correct color spaces for materials.
 import logging  # To debug and log progress.
-import collections  # For namedtuple.
+import collections  # For namedtuple, a queue of archives that are being read, and counting references to resources.
+import concurrent.futures  # To read multiple archives at the same time.
+import contextlib  # To close archives when we're done with them.
 import mathutils  # For the transformation matrices.
+import numpy  # To construct meshes from large arrays of data at once.
 import os.path  # To take file paths relative to the selected directory.
-import re  # To find files in the archive based on the content types.
+import re  # To find blocks of vertices and triangles in the 3dmodel.model file.
 import xml.etree.ElementTree  # To parse the 3dmodel.model file.
 import zipfile  # To read the 3MF files which are secretly zip archives.
 
 from .annotations import Annotations, ContentType, Relationship  # To use annotations to decide on what to import.
 from .constants import *
 from .metadata import MetadataEntry, Metadata  # To store and serialize metadata.
+from .preserved_files import PreservedFiles  # To store files that must be preserved.
 from .unit_conversions import blender_to_metre, threemf_to_metre  # To convert to Blender's units.
 
 log = logging.getLogger(__name__)
 
+MAX_NAME_LENGTH = 63  # Maximum number of bytes in the name of a data block in Blender.
+
 ResourceObject = collections.namedtuple("ResourceObject", [
     "vertices",
     "triangles",
     "materials",
+    "material_indices",
     "components",
     "metadata",
-    "trianglesets"])
+    "trianglesets",
+    "name"], defaults=[None])
 Component = collections.namedtuple("Component", ["resource_object", "transformation"])
+ContentTypeTable = collections.namedtuple("ContentTypeTable", ["overrides", "extensions"])
 ResourceMaterial = collections.namedtuple("ResourceMaterial", ["name", "color"])
-TriangleSet = collections.namedtuple("TriangleSet", ["name", "identifier", "triangle_indices"])
+TriangleSet = collections.namedtuple("TriangleSet", ["name", "identifier", "ranges", "refs"])
+ScannedTriangles = collections.namedtuple("ScannedTriangles", ["vertices", "pids", "pid_index", "p1"])
+ArchiveFile = collections.namedtuple("ArchiveFile", ["archive", "name"])
+ModelDocument = collections.namedtuple("ModelDocument", ["root", "resource_objects", "resource_materials"])
 
 
-class Import3MF(bpy.types.Operator, bpy_extras.io_utils.ImportHelper):
-    """
-    Operator that imports a 3MF file into Blender.
+class ModelReader:
     """
+    Reads out the contents of 3MF archives, without touching the Blender scene.
 
-    # Metadata.
-    bl_idname = "import_mesh.threemf"
-    bl_label = "Import 3MF"
-    bl_description = "Load a 3MF scene"
-    bl_options = {'UNDO'}
-    filename_ext = ".3mf"
+    Since this doesn't use the Blender API, several archives can be read at the same time on different threads, each
+    with their own instance of this class. The import operator then builds the scene from the results.
 
-    # Options for the user.
-    filter_glob: bpy.props.StringProperty(default="*.3mf", options={'HIDDEN'})
-    files: bpy.props.CollectionProperty(name="File Path", type=bpy.types.OperatorFileListElement)
-    directory: bpy.props.StringProperty(subtype='DIR_PATH')
-    global_scale: bpy.props.FloatProperty(name="Scale", default=1.0, soft_min=0.001, soft_max=1000.0, min=1e-6, max=1e6)
+    The resources of the document that is being read are stored in the `resource_objects` and `resource_materials`
+    fields.
+    """
 
-    def execute(self, context):
+    def __init__(self):
         """
-        The main routine that reads out the 3MF file.
-
-        This function serves as a high-level overview of the steps involved to read the 3MF file.
-        :param context: The Blender context.
-        :return: A set of status flags to indicate whether the operation succeeded or not.
+        Creates a reader that hasn't read anything yet.
         """
-        # Reset state.
         self.resource_objects = {}
         self.resource_materials = {}
-        self.resource_to_material = {}
-        self.num_loaded = 0
-        scene_metadata = Metadata()
-        # If there was already metadata in the scene, combine that with this file.
-        scene_metadata.retrieve(bpy.context.scene)
-        # Don't load the title from the old scene. If there is a title in the imported 3MF, use that.
-        # Else, we'll not override the scene title and it gets retained.
-        del scene_metadata["Title"]
-        annotations = Annotations()
-        annotations.retrieve()  # If there were already annotations in the scene, combine that with this file.
-
-        # Preparation of the input parameters.
-        paths = [os.path.join(self.directory, name.name) for name in self.files]
-        if not paths:
-            paths.append(self.filepath)
-
-        if bpy.ops.object.mode_set.poll():
-            bpy.ops.object.mode_set(mode='OBJECT')  # Switch to object mode to view the new file.
-        if bpy.ops.object.select_all.poll():
-            bpy.ops.object.select_all(action='DESELECT')  # Deselect other files.
-
-        for path in paths:
-            files_by_content_type = self.read_archive(path)  # Get the files from the archive.
-
-            # File metadata.
-            for rels_file in files_by_content_type.get(RELS_MIMETYPE, []):
-                annotations.add_rels(rels_file)
-            annotations.add_content_types(files_by_content_type)
-            self.must_preserve(files_by_content_type, annotations)
-
-            # Read the model data.
-            for model_file in files_by_content_type.get(MODEL_MIMETYPE, []):
-                try:
-                    document = xml.etree.ElementTree.ElementTree(file=model_file)
-                except xml.etree.ElementTree.ParseError as e:
-                    log.error(f"3MF document in {path} is malformed: {str(e)}")
-                    continue
-                if document is None:
-                    # This file is corrupt or we can't read it. There is no error code to communicate this to Blender
-                    # though.
-                    continue  # Leave the scene empty / skip this file.
-                root = document.getroot()
-                if not self.is_supported(root.attrib.get("requiredextensions", "")):
-                    log.warning(f"3MF document in {path} requires unknown extensions.")
-                    # Still continue processing even though the spec says not to. Our aim is to retrieve whatever
-                    # information we can.
-
-                scale_unit = self.unit_scale(context, root)
-                self.resource_objects = {}
-                self.resource_materials = {}
-                scene_metadata = self.read_metadata(root, scene_metadata)
-                self.read_materials(root)
-                self.read_objects(root)
-                self.build_items(root, scale_unit)
-
-        scene_metadata.store(bpy.context.scene)
-        annotations.store()
+        self.scanned_blocks = {}
 
-        # Zoom the camera to view the imported objects.
-        for area in bpy.context.screen.areas:
-            if area.type == 'VIEW_3D':
-                for region in area.regions:
-                    if region.type == 'WINDOW':
-                        try:
-                            # Since Blender 3.2:
-                            context = bpy.context.copy()
-                            context['area'] = area
-                            context['region'] = region
-                            context['edit_object'] = bpy.context.edit_object
-                            with bpy.context.temp_override(**context):
-                                bpy.ops.view3d.view_selected()
-                        except AttributeError:  # temp_override doesn't exist before Blender 3.2.
-                            # Before Blender 3.2:
-                            override = {'area': area, 'region': region, 'edit_object': bpy.context.edit_object}
-                            bpy.ops.view3d.view_selected(override)
-
-        log.info(f"Imported {self.num_loaded} objects from 3MF files.")
-
-        return {'FINISHED'}
+    def read_file(self, path):
+        """
+        Reads an archive and all of the 3D model documents in it.
 
-    # The rest of the functions are in order of when they are called.
+        This doesn't touch the Blender scene, so it's safe to call from a different thread than the main thread. The
+        archive is left open, so that the other files in it can still be read afterwards. It gets closed when the
+        returned `ExitStack` is closed.
+        :param path: The path to the archive to read.
+        :return: A tuple containing an `ExitStack` that closes the archive, the files in the archive by content type, as
+        given by `read_archive`, and a list of `ModelDocument`s for all of the 3D model documents in the archive that
+        could be read.
+        """
+        with contextlib.ExitStack() as stack:  # Closes the archive if reading the documents fails.
+            files_by_content_type = stack.enter_context(self.read_archive(path))  # Get the files from the archive.
+            documents = self.read_documents(files_by_content_type, path)
+            return stack.pop_all(), files_by_content_type, documents
 
+    def read_documents(self, files_by_content_type, path):
+        """
+        Reads all of the 3D model documents in an archive.
+        :param files_by_content_type: The files in the archive by content type, as given by `read_archive`.
+        :param path: The path to the archive, to report errors with.
+        :return: A list of `ModelDocument`s for all of the 3D model documents in the archive that could be read.
+        """
+        documents = []
+        for model_file in files_by_content_type.get(MODEL_MIMETYPE, []):
+            self.resource_objects = {}
+            self.resource_materials = {}
+            try:
+                with model_file.archive.open(model_file.name) as f:
+                    root = self.read_model(f)
+            except xml.etree.ElementTree.ParseError as e:
+                # This file is corrupt or we can't read it. There is no error code to communicate this to Blender
+                # though.
+                log.error(f"3MF document in {path} is malformed: {str(e)}")
+                continue  # Leave the scene empty / skip this file.
+            documents.append(ModelDocument(
+                root=root,
+                resource_objects=self.resource_objects,
+                resource_materials=self.resource_materials))
+        return documents
+
+    @contextlib.contextmanager
     def read_archive(self, path):
         """
-        Creates file streams from all the files in the archive.
+        Lists all the files in the archive.
 
         The results are sorted by their content types. Consumers of this data can pick the content types that they know
-        from the file and process those.
+        from the file and process those. The files are not opened yet. Consumers need to open the files that they need
+        themselves, and close them when they're done with them. The archive gets closed at the end of the context.
         :param path: The path to the archive to read.
-        :return: A dictionary with all of the resources in the archive by content type. The keys in this dictionary are
-        the different content types available in the file. The values in this dictionary are lists of input streams
-        referring to files in the archive.
+        :return: A context manager giving a dictionary with all of the resources in the archive by content type. The
+        keys in this dictionary are the different content types available in the file. The values in this dictionary
+        are lists of `ArchiveFile`s referring to files in the archive.
         """
         result = {}
+        archive = None
         try:
             archive = zipfile.ZipFile(path)
             content_types = self.read_content_types(archive)
@@ -174,30 +138,31 @@ class Import3MF(bpy.types.Operator, bpy_extras.io_utils.ImportHelper):
             for path, mime_type in mime_types.items():
                 if mime_type not in result:
                     result[mime_type] = []
-                # Zipfile can open an infinite number of streams at the same time. Don't worry about it.
-                result[mime_type].append(archive.open(path))
+                result[mime_type].append(ArchiveFile(archive=archive, name=path))
         except (zipfile.BadZipFile, EnvironmentError) as e:
             # File is corrupt, or the OS prevents us from reading it (doesn't exist, no permissions, etc.)
             log.error(f"Unable to read archive: {e}")
-            return result
-        return result
+
+        try:
+            yield result
+        finally:
+            if archive is not None:
+                archive.close()
 
     def read_content_types(self, archive):
         """
         Read the content types from a 3MF archive.
 
-        The output of this reading is a list of MIME types that are each mapped to a regular expression that matches on
-        the file paths within the archive that could contain this content type. This encodes both types of descriptors
-        for the content types that can occur in the content types document: Extensions and full paths.
-
-        The output is ordered in priority. Matches that should be evaluated first will be put in the front of the output
-        list.
+        The output of this reading is a table of MIME types, which encodes both types of descriptors for the content
+        types that can occur in the content types document: Full paths and extensions. The full paths are overrides,
+        which take priority over the extensions. If a path or extension is listed multiple times, the first one takes
+        priority.
         :param archive: The 3MF archive to read the contents from.
-        :return: A list of tuples, in order of importance, where the first element describes a regex of paths that
-        match, and the second element is the MIME type string of the content type.
+        :return: A `ContentTypeTable`. Its `overrides` map file paths in the archive to the MIME type string of their
+        content type. Its `extensions` map file extensions to their MIME type, in order of priority.
         """
         namespaces = {"ct": "http://schemas.openxmlformats.org/package/2006/content-types"}
-        result = []
+        result = ContentTypeTable(overrides={}, extensions={})
 
         try:
             with archive.open(CONTENT_TYPES_LOCATION) as f:
@@ -210,28 +175,28 @@ class Import3MF(bpy.types.Operator, bpy_extras.io_utils.ImportHelper):
                     root = None
 
                 if root is not None:
-                    # Overrides are more important than defaults, so put those in front.
                     for override_node in root.iterfind("ct:Override", namespaces):
                         if "PartName" not in override_node.attrib or "ContentType" not in override_node.attrib:
                             log.warning("[Content_Types].xml malformed: Override node without path or MIME type.")
                             continue  # Ignore the broken one.
-                        match_regex = re.compile(re.escape(override_node.attrib["PartName"]))
-                        result.append((match_regex, override_node.attrib["ContentType"]))
+                        # Part names are absolute, but the paths in the archive are not.
+                        path = override_node.attrib["PartName"].lstrip("/")
+                        result.overrides.setdefault(path, override_node.attrib["ContentType"])
 
                     for default_node in root.iterfind("ct:Default", namespaces):
                         if "Extension" not in default_node.attrib or "ContentType" not in default_node.attrib:
                             log.warning("[Content_Types].xml malformed: Default node without extension or MIME type.")
                             continue  # Ignore the broken one.
-                        match_regex = re.compile(r".*\." + re.escape(default_node.attrib["Extension"]))
-                        result.append((match_regex, default_node.attrib["ContentType"]))
+                        extension = default_node.attrib["Extension"]
+                        result.extensions.setdefault(extension, default_node.attrib["ContentType"])
         except KeyError:  # ZipFile reports that the content types file doesn't exist.
             log.warning(f"{CONTENT_TYPES_LOCATION} file missing!")
 
         # This parser should be robust to slightly broken files and retrieve what we can.
-        # In case the document is broken or missing, here we'll append the default ones for 3MF.
+        # In case the document is broken or missing, here we'll add the default ones for 3MF.
         # If the content types file was fine, this gets least priority so the actual data still wins.
-        result.append((re.compile(r".*\.rels"), RELS_MIMETYPE))
-        result.append((re.compile(r".*\.model"), MODEL_MIMETYPE))
+        result.extensions.setdefault("rels", RELS_MIMETYPE)
+        result.extensions.setdefault("model", MODEL_MIMETYPE)
 
         return result
 
@@ -242,75 +207,323 @@ class Import3MF(bpy.types.Operator, bpy_extras.io_utils.ImportHelper):
         The MIME types are obtained through the content types file from the archive. This content types file itself is
         not in the result though.
         :param archive: A 3MF archive with files to assign content types to.
-        :param content_types: The content types for files in that archive, in order of priority.
+        :param content_types: The `ContentTypeTable` for files in that archive.
         :return: A dictionary mapping all file paths in the archive to a content types. If the content type for a file
         is unknown, the content type will be an empty string.
         """
+        extension_priority = {extension: priority for priority, extension in enumerate(content_types.extensions)}
+
         result = {}
         for file_info in archive.filelist:
             file_path = file_info.filename
             if file_path == CONTENT_TYPES_LOCATION:  # Don't index this one.
                 continue
-            for pattern, content_type in content_types:  # Process in the correct order!
-                if pattern.fullmatch(file_path):
-                    result[file_path] = content_type
-                    break
-            else:  # None of the patterns matched.
+            if file_path in content_types.overrides:  # Overrides take priority over the extensions.
+                result[file_path] = content_types.overrides[file_path]
+                continue
+
+            # Extensions may contain periods themselves, so any part of the path after a period could be the extension.
+            # Usually there is just one, though.
+            parts = file_path.split(".")
+            candidates = [".".join(parts[start:]) for start in range(1, len(parts))]
+            candidates = [extension for extension in candidates if extension in content_types.extensions]
+            if candidates:
+                extension = min(candidates, key=extension_priority.get)
+                result[file_path] = content_types.extensions[extension]
+            else:  # None of the extensions matched.
                 result[file_path] = ""
 
         return result
 
-    def must_preserve(self, files_by_content_type, annotations):
+    def read_model(self, model_file):
         """
-        Preserves files that are marked with the 'MustPreserve' relationship and PrintTickets.
-
-        These files are saved in the Blender context as text files in a hidden folder. If the preserved files are in
-        conflict with previously loaded 3MF archives (same file path, different content) then they will not be
-        preserved.
+        Reads a 3dmodel.model document incrementally.
+
+        Rather than building the XML tree of the entire document before reading it out, the document is parsed as a
+        stream. Each <basematerials> and <object> resource gets read out as soon as its end tag is parsed, after which
+        it is removed from the tree again. This way the memory required to parse the document only depends on the size
+        of the largest resource, rather than the size of the whole document. Resources may only refer to resources that
+        were defined before them in the document, so everything they refer to is known by then.
+
+        The resources will be stored in `self.resource_materials` and `self.resource_objects`. The rest of the document,
+        such as the metadata and the build items, is small and will remain in the tree.
+        :param model_file: A file stream containing a 3dmodel.model document.
+        :return: The root element of the document, with all of its resources removed.
+        :raises xml.etree.ElementTree.ParseError: The document is not well-formed XML.
+        """
+        resources_tag = f"{{{MODEL_NAMESPACE}}}resources"
+        basematerials_tag = f"{{{MODEL_NAMESPACE}}}basematerials"
+        object_tag = f"{{{MODEL_NAMESPACE}}}object"
+
+        root = None
+        open_elements = []  # Stack of elements that were started but not yet ended, to know the parents of an element.
+        self.scanned_blocks = {}
+        for event, element in self.parse_model(model_file, open_elements):
+            if event == "start":
+                if root is None:
+                    root = element
+                open_elements.append(element)
+                continue
 
-        Archived files are stored in Base85 encoding to allow storing arbitrary files, even binary files. This sadly
-        means that the file size will increase by about 25%, and that the files are not human-readable any more when
-        opened in Blender, even if they were originally human-readable.
-        :param files_by_content_type: The files in this 3MF archive, by content type. They must be provided by content
-        type because that is how the ``read_archive`` function stores them, which is not ideal. But this function will
-        sort that out.
-        :param annotations: Collection of annotations gathered so far.
+            open_elements.pop()
+            if len(open_elements) != 2 or open_elements[-1].tag != resources_tag:
+                continue  # Only resources directly in the <resources> element of the root get read out on the fly.
+            if element.tag == basematerials_tag:
+                self.read_basematerials(element)
+            elif element.tag == object_tag:
+                self.read_object(element)
+            else:
+                continue  # Unknown resource type. Leave it in the tree.
+            open_elements[-1].remove(element)  # We're done with this resource. Free up its memory.
+
+        self.scanned_blocks = {}  # Blocks of objects that were not read, e.g. because they had no ID.
+        return root
+
+    def parse_model(self, model_file, open_elements):
         """
-        preserved_files = set()  # Find all files which must be preserved according to the annotations.
-        for target, its_annotations in annotations.annotations.items():
-            for annotation in its_annotations:
-                if type(annotation) is Relationship:
-                    if annotation.namespace in {
-                        "http://schemas.openxmlformats.org/package/2006/relationships/mustpreserve",
-                        "http://schemas.microsoft.com/3dmanufacturing/2013/01/printticket"
-                    }:
-                        preserved_files.add(target)
-                elif type(annotation) is ContentType:
-                    if annotation.mime_type == "application/vnd.ms-printing.printticket+xml":
-                        preserved_files.add(target)
+        Parses a 3dmodel.model document, producing the start and end events of its elements.
+
+        Most of a typical document consists of <vertex> and <triangle> elements. Creating an element in the XML tree for
+        each of those is slow. Instead, the raw bytes of each <vertices> and <triangles> block in a mesh are taken out
+        of the stream before they reach the XML parser, and are scanned into arrays all at once. The XML parser then
+        gets to see an empty <vertices/> or <triangles/> element in their place. The arrays are stored in
+        `self.scanned_blocks`, under the element of the XML tree that replaced them.
+
+        If a block can't be scanned this way, for instance because it is malformed or uses unusual syntax, it is given
+        to the XML parser unchanged. The elements in that block are then read out one by one.
+        :param model_file: A file stream containing a 3dmodel.model document.
+        :param open_elements: The stack of elements that were started but not yet ended, which the consumer of the
+        events keeps up to date. Blocks are only scanned if they are directly inside a <mesh> element.
+        :return: A generator of tuples of an event type ("start" or "end") and the element that it applies to.
+        :raises xml.etree.ElementTree.ParseError: The document is not well-formed XML.
+        """
+        chunk_size = 1024 * 1024  # How many bytes to read from the file at a time.
+        mesh_tag = f"{{{MODEL_NAMESPACE}}}mesh"
+        block_start = re.compile(rb"<(vertices|triangles)>")
+        scanners = {b"vertices": self.scan_vertices, b"triangles": self.scan_triangles}
+
+        parser = xml.etree.ElementTree.XMLPullParser(events=("start", "end"))
+        buffer = bytearray()  # Part of the file that was read, but not yet given to the parser.
+        block = None  # The start tag of the block that we are looking for the end of, if any.
+        search_start = 0  # Where in the buffer to continue looking for the end of that block.
+        at_end = False
+        while not at_end:
+            chunk = model_file.read(chunk_size)
+            at_end = not chunk
+            buffer += chunk
+            while True:
+                if block is None:  # Look for the start of the next block.
+                    match = block_start.search(buffer)
+                    if match is None:
+                        # Everything can be parsed, except the last few bytes which could be the start of a block.
+                        safe_length = len(buffer) if at_end else max(0, len(buffer) - len(b"<triangles>") + 1)
+                        parser.feed(bytes(buffer[:safe_length]))
+                        del buffer[:safe_length]
+                        break
+                    block = match.group(1)
+                    search_start = len(block) + 2
+                    parser.feed(bytes(buffer[:match.start()]))
+                    del buffer[:match.start()]
+                    yield from parser.read_events()  # Let the consumer track the elements up to this block.
+
+                end_tag = b"</" + block + b">"
+                block_end = buffer.find(end_tag, search_start)
+                if block_end < 0:
+                    if at_end:  # Block is never closed. Let the parser raise the error.
+                        parser.feed(bytes(buffer))
+                        del buffer[:]
+                        break
+                    search_start = max(search_start, len(buffer) - len(end_tag) + 1)
+                    break  # Read more of the file to find the end of the block.
+
+                scanned = None
+                if open_elements and open_elements[-1].tag == mesh_tag:
+                    scanned = scanners[block](bytes(buffer[len(block) + 2:block_end]))
+                if scanned is None:  # Not in a mesh, or couldn't be scanned. Parse the block normally.
+                    parser.feed(bytes(buffer[:block_end + len(end_tag)]))
+                else:
+                    parser.feed(b"<" + block + b"/>")
+                    for event, element in parser.read_events():
+                        if event == "start":
+                            self.scanned_blocks[element] = scanned
+                        yield event, element
+                del buffer[:block_end + len(end_tag)]
+                block = None
+                yield from parser.read_events()
+
+        parser.close()
+        yield from parser.read_events()
+
+    def scan_attributes(self, block, element_name):
+        """
+        Finds the attributes of a sequence of empty elements that all have the same name, directly in raw bytes.
+
+        This is a fast alternative to parsing the elements with an XML parser, which processes the whole block at once
+        with array operations rather than looking at the elements one by one. Only a subset of XML is supported: the
+        block may only contain elements written like `<name a="1" b="2"/>`, separated by whitespace. Anything else,
+        such as comments, entities, single quotes or elements with content, makes the scan fail.
+        :param block: The raw bytes of the contents of a block, between its start and end tags.
+        :param element_name: The name of the elements in the block.
+        :return: A tuple containing the number of elements in the block, and then three arrays with one entry for each
+        attribute in the block: The index of the element that the attribute is in, the name of the attribute and the
+        value of the attribute, as bytes. If the block couldn't be scanned, `None` is returned instead. Attributes that
+        occur twice in the same element are not detected here.
+        """
+        if b"'" in block or b"&" in block or b"<!" in block or b"<?" in block:
+            return None  # Quoting, entities, comments, CDATA and processing instructions are not supported.
+        data = numpy.frombuffer(block, dtype=numpy.uint8)
+        whitespace = (data == ord(" ")) | (data == ord("\n")) | (data == ord("\r")) | (data == ord("\t"))
+
+        # The elements, from their "<" up to and including their ">".
+        element_starts = numpy.flatnonzero(data == ord("<"))
+        element_ends = numpy.flatnonzero(data == ord(">"))
+        num_elements = len(element_starts)
+        name_end = element_starts + len(element_name) + 1
+        if len(element_ends) != num_elements or num_elements == 0:
+            return None
+        if numpy.any(element_ends[:-1] > element_starts[1:]) or numpy.any(name_end >= element_ends):
+            return None  # Elements overlap, or are too short to contain the element name.
+        if numpy.any(data[element_ends - 1] != ord("/")) or not numpy.all(whitespace[name_end]):
+            return None  # Not an empty element, or the element name doesn't end after the expected name.
+        name_offsets = numpy.arange(1, len(element_name) + 1)
+        element_name_data = numpy.frombuffer(element_name, dtype=numpy.uint8)
+        if numpy.any(data[element_starts[:, None] + name_offsets] != element_name_data):
+            return None
+
+        # The attributes, from the start of their name up to and including the closing quote of their value.
+        quotes = numpy.flatnonzero(data == ord("\""))
+        if len(quotes) % 2 != 0:
+            return None
+        value_starts = quotes[0::2] + 1
+        value_ends = quotes[1::2]
+        if numpy.any(data[value_starts - 2] != ord("=")):
+            return None
+        whitespace_positions = numpy.flatnonzero(whitespace)
+        # The attribute name starts after the last whitespace before the "=".
+        name_starts = whitespace_positions[numpy.searchsorted(whitespace_positions, value_starts - 2) - 1] + 1
+        attribute_element = numpy.searchsorted(element_starts, value_starts) - 1
+        if numpy.any(name_starts >= value_starts - 2) or numpy.any(attribute_element < 0):
+            return None  # Attribute without name, or outside of any element.
+
+        # All bytes must be part of an element name, an attribute or the end of an element, or be whitespace.
+        # Count how many of those parts each byte is in. This must be exactly one for all bytes other than whitespace.
+        coverage = numpy.zeros(len(data) + 1, dtype=numpy.int8)
+        coverage[element_starts] += 1
+        coverage[name_end] -= 1
+        coverage[name_starts] += 1
+        coverage[value_ends + 1] -= 1
+        coverage[element_ends - 1] += 1
+        coverage[element_ends + 1] -= 1
+        coverage = numpy.cumsum(coverage[:-1], dtype=numpy.int8)
+        if numpy.any(coverage > 1) or numpy.any((coverage == 0) & ~whitespace):
+            return None
+        # Attributes may not extend past the end of their element.
+        if numpy.any(value_ends >= element_ends[attribute_element]):
+            return None
+
+        names = self.gather_strings(data, name_starts, value_starts - 2)
+        values = self.gather_strings(data, value_starts, value_ends)
+        if names is None or values is None:
+            return None
+        return num_elements, attribute_element, names, values
+
+    def gather_strings(self, data, starts, ends):
+        """
+        Cuts pieces out of an array of bytes, and puts them in an array of fixed-length byte strings.
+        :param data: An array of bytes to cut the pieces out of.
+        :param starts: For each piece, the index of its first byte.
+        :param ends: For each piece, the index after its last byte.
+        :return: An array of byte strings containing the pieces, or `None` if the pieces are too long to be numbers or
+        attribute names.
+        """
+        lengths = ends - starts
+        max_length = int(lengths.max(initial=1))
+        if max_length > 64:
+            return None
+        total_length = int(lengths.sum())
+        piece_index = numpy.repeat(numpy.arange(len(starts)), lengths)
+        offsets = numpy.arange(total_length) - numpy.repeat(numpy.cumsum(lengths) - lengths, lengths)
+        result = numpy.zeros((len(starts), max_length), dtype=numpy.uint8)
+        result[piece_index, offsets] = data[numpy.repeat(starts, lengths) + offsets]
+        return result.view(f"S{max_length}").reshape(-1)
+
+    def scan_vertices(self, block):
+        """
+        Scans the contents of a <vertices> block into an array of coordinates.
+        :param block: The raw bytes between the <vertices> and </vertices> tags.
+        :return: An array of vertices with X, Y and Z coordinates, or `None` if the block couldn't be scanned. In that
+        case the <vertex> elements need to be read one by one.
+        """
+        scanned = self.scan_attributes(block, b"vertex")
+        if scanned is None:
+            return None
+        num_vertices, attribute_vertex, names, values = scanned
 
-        for files in files_by_content_type.values():
-            for file in files:
-                if file.name in preserved_files:
-                    filename = ".3mf_preserved/" + file.name
-                    if filename in bpy.data.texts:
-                        if bpy.data.texts[filename].as_string() == conflicting_mustpreserve_contents:
-                            # This file was previously already in conflict. The new file will always be in conflict with
-                            # one of the previous files.
-                            continue
-                    # Encode as Base85 so that the file can be saved in Blender's Text objects.
-                    file_contents = base64.b85encode(file.read()).decode('UTF-8')
-                    if filename in bpy.data.texts:
-                        if bpy.data.texts[filename].as_string() == file_contents:
-                            # File contents are EXACTLY the same, so the file is not in conflict.
-                            continue  # But we also don't need to re-add the same file then.
-                        else:  # Same file exists with different contents, so they are in conflict.
-                            bpy.data.texts[filename].clear()
-                            bpy.data.texts[filename].write(conflicting_mustpreserve_contents)
-                            continue
-                    else:  # File doesn't exist yet.
-                        handle = bpy.data.texts.new(filename)
-                        handle.write(file_contents)
+        result = numpy.empty((num_vertices, 3), dtype=numpy.float32)
+        in_order = numpy.arange(num_vertices)
+        try:
+            for dimension, name in enumerate((b"x", b"y", b"z")):
+                is_dimension = names == name
+                if not numpy.array_equal(attribute_vertex[is_dimension], in_order):
+                    return None  # Must be exactly once in each vertex.
+                result[:, dimension] = values[is_dimension].astype(numpy.float64)
+        except ValueError:  # Not a float.
+            return None
+        if len(names) != 3 * num_vertices:
+            return None  # There are other attributes. Let the normal reading decide what to do with them.
+        return result
+
+    def scan_triangles(self, block):
+        """
+        Scans the contents of a <triangles> block into arrays.
+        :param block: The raw bytes between the <triangles> and </triangles> tags.
+        :return: A `ScannedTriangles` tuple, or `None` if the block couldn't be scanned. In that case the <triangle>
+        elements need to be read one by one.
+        """
+        scanned = self.scan_attributes(block, b"triangle")
+        if scanned is None:
+            return None
+        num_triangles, attribute_triangle, names, values = scanned
+        known_names = (b"v1", b"v2", b"v3", b"p1", b"p2", b"p3", b"pid")
+        if not numpy.all(numpy.isin(names, known_names)):
+            return None  # There are other attributes. Let the normal reading decide what to do with them.
+        for name in known_names:
+            if numpy.any(numpy.diff(attribute_triangle[names == name]) <= 0):
+                return None  # The same attribute occurs twice in a triangle.
+
+        # Indices must be non-negative integers. Reading them as floats is exact for anything that fits in 32 bits.
+        is_index = names != b"pid"
+        index_digits = values[is_index].view(numpy.uint8)
+        if numpy.any((index_digits != 0) & ((index_digits < ord("0")) | (index_digits > ord("9")))):
+            return None
+        indices = numpy.zeros(len(values), dtype=numpy.int64)
+        try:
+            indices[is_index] = values[is_index].astype(numpy.float64)
+        except ValueError:  # Empty.
+            return None
+        if numpy.any(indices >= 2 ** 32):
+            return None
+
+        vertices = numpy.empty((num_triangles, 3), dtype=numpy.uint32)
+        in_order = numpy.arange(num_triangles)
+        for corner, name in enumerate((b"v1", b"v2", b"v3")):
+            is_corner = names == name
+            if not numpy.array_equal(attribute_triangle[is_corner], in_order):
+                return None  # Must be exactly once in each triangle.
+            vertices[:, corner] = indices[is_corner]
+
+        p1 = numpy.full(num_triangles, -1, dtype=numpy.int64)
+        is_p1 = names == b"p1"
+        p1[attribute_triangle[is_p1]] = indices[is_p1]
+        pid_index = numpy.full(num_triangles, -1, dtype=numpy.int64)
+        is_pid = names == b"pid"
+        pids, pid_inverse = numpy.unique(values[is_pid], return_inverse=True)
+        pid_index[attribute_triangle[is_pid]] = pid_inverse
+        return ScannedTriangles(
+            vertices=vertices,
+            pids=[pid.decode("UTF-8") for pid in pids],
+            pid_index=pid_index,
+            p1=p1)
 
     def is_supported(self, required_extensions):
         """
@@ -323,27 +536,6 @@ class Import3MF(bpy.types.Operator, bpy_extras.io_utils.ImportHelper):
         extensions = set(filter(lambda x: x != "", extensions))
         return extensions <= SUPPORTED_EXTENSIONS
 
-    def unit_scale(self, context, root):
-        """
-        Get the scaling factor we need to use for this document, according to its unit.
-        :param context: The Blender context.
-        :param root: An ElementTree root element containing the entire 3MF file.
-        :return: Floating point value that we need to scale this model by. A small number (<1) means that we need to
-        make the coordinates in Blender smaller than the coordinates in the file. A large number (>1) means we need to
-        make the coordinates in Blender larger than the coordinates in the file.
-        """
-        scale = self.global_scale
-
-        if context.scene.unit_settings.scale_length != 0:
-            scale /= context.scene.unit_settings.scale_length  # Apply the global scale of the units in Blender.
-
-        threemf_unit = root.attrib.get("unit", MODEL_DEFAULT_UNIT)
-        blender_unit = context.scene.unit_settings.length_unit
-        scale *= threemf_to_metre[threemf_unit]  # Convert 3MF units to metre.
-        scale /= blender_to_metre[blender_unit]  # Convert metre to Blender's units.
-
-        return scale
-
     def read_metadata(self, node, original_metadata=None):
         """
         Reads the metadata tags from a metadata group.
@@ -375,122 +567,130 @@ class Import3MF(bpy.types.Operator, bpy_extras.io_utils.ImportHelper):
 
         return metadata
 
-    def read_materials(self, root):
+    def read_basematerials(self, basematerials_item):
         """
-        Read out all of the material resources from the 3MF document.
+        Read out a single group of base materials from the 3MF document.
 
         The materials will be stored in `self.resource_materials` until it gets used to build the items.
-        :param root: The root of an XML document that may contain materials.
+        :param basematerials_item: A <basematerials> element from the 3dmodel.model file.
         """
-        for basematerials_item in root.iterfind("./3mf:resources/3mf:basematerials", MODEL_NAMESPACES):
-            try:
-                material_id = basematerials_item.attrib["id"]
-            except KeyError:
-                log.warning("Encountered a basematerials item without resource ID.")
-                continue  # Need to have an ID, or no item can reference to the materials. Skip this one.
-            if material_id in self.resource_materials:
-                log.warning(f"Duplicate material ID: {material_id}")
-                continue
-
-            # Use a dictionary mapping indices to resources, because some indices may be skipped due to being invalid.
-            self.resource_materials[material_id] = {}
-            index = 0
-
-            # "Base" must be the stupidest name for a material resource. Oh well.
-            for base_item in basematerials_item.iterfind("./3mf:base", MODEL_NAMESPACES):
-                name = base_item.attrib.get("name", "3MF Material")
-                color = base_item.attrib.get("displaycolor")
-                if color is not None:
-                    # Parse the color. It's a hexadecimal number indicating RGB or RGBA.
-                    color = color.lstrip("#")  # Should start with a #. We'll be lenient if it's not.
-                    try:
-                        color_int = int(color, 16)
-                        # Separate out up to four bytes from this int, from right to left.
-                        b1 = (color_int & 0x000000FF) / 255
-                        b2 = ((color_int & 0x0000FF00) >> 8) / 255
-                        b3 = ((color_int & 0x00FF0000) >> 16) / 255
-                        b4 = ((color_int & 0xFF000000) >> 24) / 255
-                        if len(color) == 6:  # RGB format.
-                            color = (b3, b2, b1, 1.0)  # b1, b2 and b3 are B, G, R respectively. b4 is always 0.
-                        else:  # RGBA format, or invalid.
-                            color = (b4, b3, b2, b1)  # b1, b2, b3 and b4 are A, B, G, R respectively.
-                    except ValueError:
-                        log.warning(f"Invalid color for material {name} of resource {material_id}: {color}")
-                        color = None  # Don't add a color for this material.
-
-                # Input is valid. Create a resource.
-                self.resource_materials[material_id][index] = ResourceMaterial(name=name, color=color)
-                index += 1
-
-            if len(self.resource_materials[material_id]) == 0:
-                del self.resource_materials[material_id]  # Don't leave empty material sets hanging.
-
-    def read_objects(self, root):
-        """
-        Reads all repeatable build objects from the resources of an XML root node.
-
-        This stores them in the resource_objects field.
-        :param root: The root node of a 3dmodel.model XML file.
-        """
-        for object_node in root.iterfind("./3mf:resources/3mf:object", MODEL_NAMESPACES):
-            try:
-                objectid = object_node.attrib["id"]
-            except KeyError:
-                log.warning("Object resource without ID!")
-                continue  # ID is required, otherwise the build can't refer to it.
-
-            pid = object_node.attrib.get("pid")  # Material ID.
-            pindex = object_node.attrib.get("pindex")  # Index within a collection of materials.
-            material = None
-            if pid is not None and pindex is not None:
+        try:
+            material_id = basematerials_item.attrib["id"]
+        except KeyError:
+            log.warning("Encountered a basematerials item without resource ID.")
+            return  # Need to have an ID, or no item can reference to the materials. Skip this one.
+        if material_id in self.resource_materials:
+            log.warning(f"Duplicate material ID: {material_id}")
+            return
+
+        # Use a dictionary mapping indices to resources, because some indices may be skipped due to being invalid.
+        self.resource_materials[material_id] = {}
+        index = 0
+
+        # "Base" must be the stupidest name for a material resource. Oh well.
+        for base_item in basematerials_item.iterfind("./3mf:base", MODEL_NAMESPACES):
+            name = base_item.attrib.get("name", "3MF Material")
+            color = base_item.attrib.get("displaycolor")
+            if color is not None:
+                # Parse the color. It's a hexadecimal number indicating RGB or RGBA.
+                color = color.lstrip("#")  # Should start with a #. We'll be lenient if it's not.
                 try:
-                    index = int(pindex)
-                    material = self.resource_materials[pid][index]
-                except KeyError:
-                    log.warning(
-                        f"Object with ID {objectid} refers to material collection {pid} with index {pindex}"
-                        f" which doesn't exist.")
+                    color_int = int(color, 16)
+                    # Separate out up to four bytes from this int, from right to left.
+                    b1 = (color_int & 0x000000FF) / 255
+                    b2 = ((color_int & 0x0000FF00) >> 8) / 255
+                    b3 = ((color_int & 0x00FF0000) >> 16) / 255
+                    b4 = ((color_int & 0xFF000000) >> 24) / 255
+                    if len(color) == 6:  # RGB format.
+                        color = (b3, b2, b1, 1.0)  # b1, b2 and b3 are B, G, R respectively. b4 is always 0.
+                    else:  # RGBA format, or invalid.
+                        color = (b4, b3, b2, b1)  # b1, b2, b3 and b4 are A, B, G, R respectively.
                 except ValueError:
-                    log.warning(f"Object with ID {objectid} specifies material index {pindex}, which is not integer.")
+                    log.warning(f"Invalid color for material {name} of resource {material_id}: {color}")
+                    color = None  # Don't add a color for this material.
 
-            vertices = self.read_vertices(object_node)
-            triangles, materials = self.read_triangles(object_node, material, pid)
-            trianglesets = self.read_trianglesets(object_node)
-            components = self.read_components(object_node)
-            metadata = Metadata()
-            for metadata_node in object_node.iterfind("./3mf:metadatagroup", MODEL_NAMESPACES):
-                metadata = self.read_metadata(metadata_node, metadata)
-            if "partnumber" in object_node.attrib:
-                # Blender has no way to ensure that custom properties get preserved if a mesh is split up, but for most
-                # operations this is retained properly.
-                metadata["3mf:partnumber"] = MetadataEntry(
-                    name="3mf:partnumber",
-                    preserve=True,
-                    datatype="xs:string",
-                    value=object_node.attrib["partnumber"])
-            metadata["3mf:object_type"] = MetadataEntry(
-                name="3mf:object_type",
+            # Input is valid. Create a resource.
+            self.resource_materials[material_id][index] = ResourceMaterial(name=name, color=color)
+            index += 1
+
+        if len(self.resource_materials[material_id]) == 0:
+            del self.resource_materials[material_id]  # Don't leave empty material sets hanging.
+
+    def read_object(self, object_node):
+        """
+        Reads a single repeatable build object from the resources of a 3MF document.
+
+        This stores it in the resource_objects field.
+        :param object_node: An <object> element from the 3dmodel.model file.
+        """
+        try:
+            objectid = object_node.attrib["id"]
+        except KeyError:
+            log.warning("Object resource without ID!")
+            return  # ID is required, otherwise the build can't refer to it.
+
+        pid = object_node.attrib.get("pid")  # Material ID.
+        pindex = object_node.attrib.get("pindex")  # Index within a collection of materials.
+        material = None
+        if pid is not None and pindex is not None:
+            try:
+                index = int(pindex)
+                material = self.resource_materials[pid][index]
+            except KeyError:
+                log.warning(
+                    f"Object with ID {objectid} refers to material collection {pid} with index {pindex}"
+                    f" which doesn't exist.")
+            except ValueError:
+                log.warning(f"Object with ID {objectid} specifies material index {pindex}, which is not integer.")
+
+        vertices = self.read_vertices(object_node)
+        triangles, materials, material_indices = self.read_triangles(object_node, material, pid)
+        trianglesets = self.read_trianglesets(object_node)
+        vertices, triangles, material_indices, trianglesets = self.validate_mesh(
+            objectid, vertices, triangles, material_indices, trianglesets)
+        components = self.read_components(object_node)
+        metadata = Metadata()
+        for metadata_node in object_node.iterfind("./3mf:metadatagroup", MODEL_NAMESPACES):
+            metadata = self.read_metadata(metadata_node, metadata)
+        if "partnumber" in object_node.attrib:
+            # Blender has no way to ensure that custom properties get preserved if a mesh is split up, but for most
+            # operations this is retained properly.
+            metadata["3mf:partnumber"] = MetadataEntry(
+                name="3mf:partnumber",
                 preserve=True,
                 datatype="xs:string",
-                value=object_node.attrib.get("type", "model"))
-
-            self.resource_objects[objectid] = ResourceObject(
-                vertices=vertices,
-                triangles=triangles,
-                materials=materials,
-                components=components,
-                metadata=metadata,
-                trianglesets=trianglesets)
+                value=object_node.attrib["partnumber"])
+        metadata["3mf:object_type"] = MetadataEntry(
+            name="3mf:object_type",
+            preserve=True,
+            datatype="xs:string",
+            value=object_node.attrib.get("type", "model"))
+
+        self.resource_objects[objectid] = ResourceObject(
+            vertices=vertices,
+            triangles=triangles,
+            materials=materials,
+            material_indices=material_indices,
+            components=components,
+            metadata=metadata,
+            trianglesets=trianglesets,
+            name=object_node.attrib.get("name"))
 
     def read_vertices(self, object_node):
         """
         Reads out the vertices from an XML node of an object.
 
-        If any vertex is corrupt, like with a coordinate missing or not proper floats, then the 0 coordinate will be
-        used. This is to prevent messing up the list of indices.
+        If the vertices were already scanned while parsing the document, the scanned array is used. Otherwise they are
+        read one by one. If any vertex is corrupt, like with a coordinate missing or not proper floats, then the 0
+        coordinate will be used. This is to prevent messing up the list of indices.
         :param object_node: An <object> element from the 3dmodel.model file.
-        :return: List of vertices in that object. Each vertex is a tuple of 3 floats for X, Y and Z.
+        :return: Sequence of vertices in that object. Each vertex has 3 floats for X, Y and Z.
         """
+        vertices_node = object_node.find("./3mf:mesh/3mf:vertices", MODEL_NAMESPACES)
+        scanned = self.scanned_blocks.pop(vertices_node, None)
+        if scanned is not None:
+            return scanned
+
         result = []
         for vertex in object_node.iterfind("./3mf:mesh/3mf:vertices/3mf:vertex", MODEL_NAMESPACES):
             attrib = vertex.attrib
@@ -518,16 +718,26 @@ class Import3MF(bpy.types.Operator, bpy_extras.io_utils.ImportHelper):
 
         These triangles always consist of 3 vertices each. Each vertex is an index to the list of vertices read
         previously. The triangle also contains an associated material, or None if the triangle gets no material.
+
+        If the triangles were already scanned while parsing the document, the scanned arrays are used. Otherwise they
+        are read one by one.
         :param object_node: An <object> element from the 3dmodel.model file.
         :param default_material: If the triangle specifies no material, it should get this material. May be `None` if
         the model specifies no material.
         :param material_pid: Triangles that specify a material index will get their material from this material group.
-        :return: Two lists of equal length. The first lists the vertices of each triangle, which are 3-tuples of
-        integers referring to the first, second and third vertex of the triangle. The second list contains a material
-        for each triangle, or `None` if the triangle doesn't get a material.
+        :return: A tuple of three sequences. The first lists the vertices of each triangle, which are 3 integers
+        referring to the first, second and third vertex of the triangle. The second lists the distinct materials of
+        the triangles, which may include `None` for triangles that don't get a material. The third sequence has the
+        same length as the first, and contains for each triangle the index of its material in the second.
         """
+        triangles_node = object_node.find("./3mf:mesh/3mf:triangles", MODEL_NAMESPACES)
+        scanned = self.scanned_blocks.pop(triangles_node, None)
+        if scanned is not None:
+            return self.read_scanned_triangles(scanned, default_material, material_pid)
+
         vertices = []
-        materials = []
+        distinct_materials = {}  # For each distinct material, its index in the list of materials.
+        material_indices = []
         for triangle in object_node.iterfind("./3mf:mesh/3mf:triangles/3mf:triangle", MODEL_NAMESPACES):
             attrib = triangle.attrib
             try:
@@ -554,14 +764,49 @@ class Import3MF(bpy.types.Operator, bpy_extras.io_utils.ImportHelper):
                         material = default_material
 
                 vertices.append((v1, v2, v3))
-                materials.append(material)
+                material_indices.append(distinct_materials.setdefault(material, len(distinct_materials)))
             except KeyError as e:
                 log.warning(f"Vertex {e} is missing.")
                 continue
             except ValueError as e:
                 log.warning(f"Vertex reference is not an integer: {e}")
                 continue  # No fallback this time. Leave out the entire triangle.
-        return vertices, materials
+        return vertices, list(distinct_materials), material_indices
+
+    def read_scanned_triangles(self, scanned, default_material, material_pid):
+        """
+        Finds the materials of triangles that were scanned while parsing the document.
+
+        Each distinct combination of material group and index is looked up only once.
+        :param scanned: The `ScannedTriangles` of an object.
+        :param default_material: If the triangle specifies no material, it should get this material. May be `None` if
+        the model specifies no material.
+        :param material_pid: Triangles that specify a material index will get their material from this material group.
+        :return: A tuple of three sequences, like `read_triangles`.
+        """
+        # Combine the material group and index into a single number, so that they can be compared at once.
+        p1_range = int(scanned.p1.max(initial=0)) + 2
+        combinations, first_triangle, combination_index = numpy.unique(
+            (scanned.pid_index + 1) * p1_range + (scanned.p1 + 1),
+            return_index=True,
+            return_inverse=True)
+        distinct_materials = {}  # For each distinct material, its index in the list of materials.
+        combination_material = numpy.empty(len(combinations), dtype=numpy.int32)
+        for combination in numpy.argsort(first_triangle):  # In order of appearance, like the triangles themselves.
+            pid_index, p1 = divmod(int(combinations[combination]), p1_range)
+            pid_index -= 1
+            p1 -= 1
+            if p1 < 0:
+                material = default_material
+            else:
+                pid = material_pid if pid_index < 0 else scanned.pids[pid_index]
+                try:
+                    material = self.resource_materials[pid][p1]
+                except KeyError as e:
+                    log.warning(f"Material {e} is missing.")
+                    material = default_material
+            combination_material[combination] = distinct_materials.setdefault(material, len(distinct_materials))
+        return scanned.vertices, list(distinct_materials), combination_material[combination_index.reshape(-1)]
 
     def read_trianglesets(self, object_node):
         """
@@ -570,6 +815,9 @@ class Import3MF(bpy.types.Operator, bpy_extras.io_utils.ImportHelper):
         Triangle sets are non-geometric groupings for organizational purposes.
         They do not affect geometry or material assignments and may be used by
         editing applications for display, selection, or workflow purposes.
+
+        The triangles are kept the way the document lists them, as ranges and separate references, rather than expanding
+        the ranges into every triangle index they contain.
         :param object_node: An <object> element from the 3dmodel.model file.
         :return: List of TriangleSet namedtuples containing triangle set information.
         """
@@ -583,38 +831,118 @@ class Import3MF(bpy.types.Operator, bpy_extras.io_utils.ImportHelper):
                 log.warning(f"Triangle set missing required name or identifier attribute, skipping")
                 continue
 
-            # Parse the triangle indices from <ref> and <refrange> elements
-            triangle_indices = []
-
             # Handle <ref> elements (single triangle references)
+            refs = []
             for ref in triangleset.iterfind("./t:ref", MODEL_NAMESPACES):
                 try:
                     index = int(ref.attrib.get("index", "-1"))
                     if index >= 0:
-                        triangle_indices.append(index)
+                        refs.append(index)
                     else:
                         log.warning(f"Triangle set '{name}' contains negative triangle index: {index}")
                 except (ValueError, KeyError):
                     log.warning(f"Triangle set '{name}' contains invalid ref element")
 
-            # Handle <refrange> elements (triangle ranges)
+            # Handle <refrange> elements (triangle ranges), including both the start and the end index
+            ranges = []
             for refrange in triangleset.iterfind("./t:refrange", MODEL_NAMESPACES):
                 try:
                     start_index = int(refrange.attrib.get("startindex", "-1"))
                     end_index = int(refrange.attrib.get("endindex", "-1"))
                     if start_index >= 0 and end_index >= start_index:
-                        triangle_indices.extend(range(start_index, end_index + 1))
+                        ranges.append((start_index, end_index))
                     else:
                         log.warning(f"Triangle set '{name}' contains invalid refrange: {start_index}-{end_index}")
                 except (ValueError, KeyError):
                     log.warning(f"Triangle set '{name}' contains invalid refrange element")
 
-            if triangle_indices:
-                result.append(TriangleSet(name=name, identifier=identifier, triangle_indices=triangle_indices))
-                log.info(f"Loaded triangle set '{name}' (id: {identifier}) with {len(triangle_indices)} triangles")
+            if refs or ranges:
+                ranges = numpy.array(ranges, dtype=numpy.int64).reshape((-1, 2))
+                refs = numpy.array(refs, dtype=numpy.int64)
+                result.append(TriangleSet(name=name, identifier=identifier, ranges=ranges, refs=refs))
+                num_triangles = len(refs) + int((ranges[:, 1] - ranges[:, 0] + 1).sum())
+                log.info(f"Loaded triangle set '{name}' (id: {identifier}) with {num_triangles} triangles")
 
         return result
 
+    def validate_mesh(self, objectid, vertices, triangles, material_indices, trianglesets):
+        """
+        Repairs the mesh of an object, so that it can be built in Blender.
+
+        Triangles are removed if they refer to vertices that don't exist, if they have no area, or if they have the
+        same vertices as an earlier triangle. Vertices that no triangle refers to are removed too. The remaining
+        vertices and triangles are renumbered, and the triangle sets are adjusted to that. All of this is done with
+        array operations on the whole mesh at once. How much was removed is logged once for the whole mesh.
+        :param objectid: The ID of the object that the mesh belongs to, to report problems with.
+        :param vertices: The vertices of the mesh. Each vertex has 3 coordinates, for X, Y and Z.
+        :param triangles: The triangles of the mesh. Each triangle has 3 indices, referring to the list of vertices.
+        :param material_indices: For each triangle, the index of its material.
+        :param trianglesets: The triangle sets of the mesh, referring to the triangles.
+        :return: A tuple of the vertices, triangles, material indices and triangle sets after the repair.
+        """
+        if len(triangles) == 0:
+            return vertices, triangles, material_indices, trianglesets  # No mesh to build.
+        vertices = numpy.asarray(vertices, dtype=numpy.float32).reshape((-1, 3))
+        triangles = numpy.asarray(triangles, dtype=numpy.int64).reshape((-1, 3))
+        material_indices = numpy.asarray(material_indices, dtype=numpy.int32)
+
+        in_range = ((triangles >= 0) & (triangles < len(vertices))).all(axis=1)
+        corners = vertices[triangles[in_range]]  # Only of triangles in range. There may be no vertices at all.
+        normals = numpy.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+        degenerate = in_range.copy()
+        degenerate[in_range] = ~normals.any(axis=1)  # Also covers triangles that use the same vertex twice.
+        valid = in_range & ~degenerate
+        # Triangles with the same vertices, in any order, have the same sorted vertices. Keep the first one of those.
+        sorted_vertices = numpy.sort(triangles[valid], axis=1)
+        if len(vertices) < 2 ** 21:  # All three indices fit in a single 64-bit key, which sorts much faster.
+            keys = (sorted_vertices[:, 0] << 42) | (sorted_vertices[:, 1] << 21) | sorted_vertices[:, 2]
+            order = numpy.argsort(keys, kind="stable")
+        else:
+            order = numpy.lexsort((sorted_vertices[:, 2], sorted_vertices[:, 1], sorted_vertices[:, 0]))
+        sorted_vertices = sorted_vertices[order]
+        is_first = numpy.ones(len(order), dtype=bool)  # Sorting is stable, so the first of each group came first.
+        is_first[1:] = (sorted_vertices[1:] != sorted_vertices[:-1]).any(axis=1)
+        first_occurrences = order[is_first]
+        keep = numpy.zeros(len(triangles), dtype=bool)
+        keep[numpy.flatnonzero(valid)[first_occurrences]] = True
+
+        used = numpy.zeros(len(vertices), dtype=bool)
+        used[triangles[keep]] = True
+        new_vertex_index = (numpy.cumsum(used) - 1).astype(numpy.int32)
+
+        num_invalid = len(triangles) - int(numpy.count_nonzero(in_range))
+        num_degenerate = int(numpy.count_nonzero(degenerate))
+        num_duplicate = int(numpy.count_nonzero(valid)) - len(first_occurrences)
+        num_unused = len(vertices) - int(numpy.count_nonzero(used))
+        if num_invalid or num_degenerate or num_duplicate:
+            log.warning(f"Object {objectid} has {num_invalid} triangles referring to vertices that don't exist, "
+                        f"{num_degenerate} triangles without area and {num_duplicate} duplicate triangles. These are "
+                        f"removed, along with {num_unused} vertices that no triangle uses.")
+            trianglesets = [self.renumber_triangleset(triangleset, keep) for triangleset in trianglesets]
+        elif num_unused:
+            log.info(f"Object {objectid} has {num_unused} vertices that no triangle uses. These are removed.")
+
+        return vertices[used], new_vertex_index[triangles[keep]], material_indices[keep], trianglesets
+
+    def renumber_triangleset(self, triangleset, keep):
+        """
+        Adjusts the references of a triangle set to the triangles that are left after removing some.
+
+        The triangles that were removed are removed from the triangle set too, also from the middle of ranges.
+        :param triangleset: The triangle set to adjust.
+        :param keep: For each of the original triangles, whether it's kept.
+        :return: The triangle set, referring to the triangles that are kept, by their new index.
+        """
+        num_kept_before = numpy.concatenate(([0], numpy.cumsum(keep)))  # The new index of each original triangle.
+        ranges = triangleset.ranges[triangleset.ranges[:, 0] < len(keep)]  # Leave out triangles that don't exist.
+        starts = num_kept_before[ranges[:, 0]]
+        ends = num_kept_before[numpy.minimum(ranges[:, 1], len(keep) - 1) + 1] - 1
+        refs = triangleset.refs[triangleset.refs < len(keep)]
+        refs = refs[keep[refs]]
+        return triangleset._replace(
+            ranges=numpy.stack((starts, ends), axis=1)[ends >= starts],
+            refs=num_kept_before[refs])
+
     def read_components(self, object_node):
         """
         Reads out the components from an XML node of an object.
@@ -676,6 +1004,218 @@ class Import3MF(bpy.types.Operator, bpy_extras.io_utils.ImportHelper):
             result[row][col] = component_float
         return result
 
+
+class Import3MF(bpy.types.Operator, bpy_extras.io_utils.ImportHelper, ModelReader):
+    """
+    Operator that imports a 3MF file into Blender.
+    """
+
+    # Metadata.
+    bl_idname = "import_mesh.threemf"
+    bl_label = "Import 3MF"
+    bl_description = "Load a 3MF scene"
+    bl_options = {'UNDO'}
+    filename_ext = ".3mf"
+
+    # Options for the user.
+    filter_glob: bpy.props.StringProperty(default="*.3mf", options={'HIDDEN'})
+    files: bpy.props.CollectionProperty(name="File Path", type=bpy.types.OperatorFileListElement)
+    directory: bpy.props.StringProperty(subtype='DIR_PATH')
+    global_scale: bpy.props.FloatProperty(name="Scale", default=1.0, soft_min=0.001, soft_max=1000.0, min=1e-6, max=1e6)
+    use_single_mesh: bpy.props.BoolProperty(
+        name="Single Mesh",
+        description="Combine all objects of each file into a single mesh, instead of an object for each part. Supports "
+                    "are combined into a separate mesh for each type of support, which is not rendered.",
+        default=False)
+
+    def execute(self, context):
+        """
+        The main routine that reads out the 3MF file.
+
+        This function serves as a high-level overview of the steps involved to read the 3MF file.
+        :param context: The Blender context.
+        :return: A set of status flags to indicate whether the operation succeeded or not.
+        """
+        # Reset state.
+        self.resource_objects = {}
+        self.resource_materials = {}
+        self.resource_to_material = {}
+        self.resource_to_mesh = {}
+        self.resource_to_collection = {}
+        self.shared_resources = set()
+        self.num_loaded = 0
+        # The names in use by objects and meshes, to the next number to try appending to them to make them unique.
+        self.object_names = dict.fromkeys(bpy.data.objects.keys(), 1)
+        self.mesh_names = dict.fromkeys(bpy.data.meshes.keys(), 1)
+        self.collection_names = dict.fromkeys(bpy.data.collections.keys(), 1)
+        scene_metadata = Metadata()
+        # If there was already metadata in the scene, combine that with this file.
+        scene_metadata.retrieve(bpy.context.scene)
+        # Don't load the title from the old scene. If there is a title in the imported 3MF, use that.
+        # Else, we'll not override the scene title and it gets retained.
+        del scene_metadata["Title"]
+        annotations = Annotations()
+        annotations.retrieve()  # If there were already annotations in the scene, combine that with this file.
+
+        # Preparation of the input parameters.
+        paths = [os.path.join(self.directory, name.name) for name in self.files]
+        if not paths:
+            paths.append(self.filepath)
+
+        if bpy.ops.object.mode_set.poll():
+            bpy.ops.object.mode_set(mode='OBJECT')  # Switch to object mode to view the new file.
+        if bpy.ops.object.select_all.poll():
+            bpy.ops.object.select_all(action='DESELECT')  # Deselect other files.
+
+        for path, archive, files_by_content_type, documents in self.read_files(paths):
+            with archive:  # Close the archive once everything is taken out of it.
+                # File metadata.
+                for rels_file in files_by_content_type.get(RELS_MIMETYPE, []):
+                    with rels_file.archive.open(rels_file.name) as f:
+                        annotations.add_rels(f)
+                annotations.add_content_types(files_by_content_type)
+                self.must_preserve(files_by_content_type, annotations)
+
+                # Build the model data, into a collection of its own.
+                file_name = os.path.splitext(os.path.basename(path))[0]
+                self.collection = bpy.data.collections.new(self.unique_name(file_name, self.collection_names))
+                self.built_objects = []
+                for document in documents:
+                    self.resource_objects = document.resource_objects
+                    self.resource_materials = document.resource_materials
+                    self.resource_to_mesh = {}  # Object IDs are only unique within the same document.
+                    self.resource_to_collection = {}
+                    root = document.root
+                    if not self.is_supported(root.attrib.get("requiredextensions", "")):
+                        log.warning(f"3MF document in {path} requires unknown extensions.")
+                        # Still continue processing even though the spec says not to. Our aim is to retrieve whatever
+                        # information we can.
+
+                    scale_unit = self.unit_scale(context, root)
+                    scene_metadata = self.read_metadata(root, scene_metadata)
+                    if self.use_single_mesh:
+                        self.build_flattened(root, scale_unit, file_name)
+                    else:
+                        self.build_items(root, scale_unit)
+                self.link_collection(self.collection, self.built_objects)
+
+        scene_metadata.store(bpy.context.scene)
+        annotations.store()
+
+        # Zoom the camera to view the imported objects.
+        for area in bpy.context.screen.areas:
+            if area.type == 'VIEW_3D':
+                for region in area.regions:
+                    if region.type == 'WINDOW':
+                        try:
+                            # Since Blender 3.2:
+                            context = bpy.context.copy()
+                            context['area'] = area
+                            context['region'] = region
+                            context['edit_object'] = bpy.context.edit_object
+                            with bpy.context.temp_override(**context):
+                                bpy.ops.view3d.view_selected()
+                        except AttributeError:  # temp_override doesn't exist before Blender 3.2.
+                            # Before Blender 3.2:
+                            override = {'area': area, 'region': region, 'edit_object': bpy.context.edit_object}
+                            bpy.ops.view3d.view_selected(override)
+
+        log.info(f"Imported {self.num_loaded} objects from 3MF files.")
+
+        return {'FINISHED'}
+
+    # The rest of the functions are in order of when they are called.
+
+    def read_files(self, paths):
+        """
+        Reads the archives at the given paths on a pool of threads.
+
+        Reading an archive and parsing its documents doesn't involve the Blender scene, so multiple archives can be read
+        at the same time. Each job gets its own `ModelReader`, so that the threads don't share any state. The results
+        are given in the same order as the paths though, so that the scene can be built on the main thread in a
+        predictable order. Only a few archives are read ahead of the one that is being built, to limit how many parsed
+        archives need to be kept in memory at the same time.
+        :param paths: The paths to the archives to read.
+        :return: A generator of tuples, one for each path. The tuples contain the path, an `ExitStack` that closes the
+        archive, the files in the archive by content type, and the `ModelDocument`s read from the archive. The consumer
+        needs to close each archive when it's done with it.
+        """
+        num_threads = min(len(paths), os.cpu_count() or 1)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
+            pending = collections.deque()  # Paths that are being read, with the future of their results.
+            try:
+                for path in paths:
+                    pending.append((path, executor.submit(ModelReader().read_file, path)))
+                    if len(pending) > num_threads:  # Read far enough ahead. Wait for the oldest archive first.
+                        oldest_path, future = pending.popleft()
+                        yield (oldest_path, *future.result())
+                while pending:
+                    oldest_path, future = pending.popleft()
+                    yield (oldest_path, *future.result())
+            finally:  # If the import is aborted, still close the archives that were already read ahead.
+                for _, future in pending:
+                    if future.cancel() or future.exception() is not None:
+                        continue  # Never started, or failed. Then there is no archive to close.
+                    future.result()[0].close()
+
+    def must_preserve(self, files_by_content_type, annotations):
+        """
+        Preserves files that are marked with the 'MustPreserve' relationship and PrintTickets.
+
+        These files are stored in the user data directory of this extension, and the Blender context refers to them with
+        text files in a hidden folder. See `PreservedFiles`. If the preserved files are in conflict with previously
+        loaded 3MF archives (same file path, different content) then they will not be preserved.
+        :param files_by_content_type: The files in this 3MF archive, by content type. They must be provided by content
+        type because that is how the ``read_archive`` function stores them, which is not ideal. But this function will
+        sort that out.
+        :param annotations: Collection of annotations gathered so far.
+        """
+        preserved_files = set()  # Find all files which must be preserved according to the annotations.
+        for target, its_annotations in annotations.annotations.items():
+            for annotation in its_annotations:
+                if type(annotation) is Relationship:
+                    if annotation.namespace in {
+                        "http://schemas.openxmlformats.org/package/2006/relationships/mustpreserve",
+                        "http://schemas.microsoft.com/3dmanufacturing/2013/01/printticket"
+                    }:
+                        preserved_files.add(target)
+                elif type(annotation) is ContentType:
+                    if annotation.mime_type == "application/vnd.ms-printing.printticket+xml":
+                        preserved_files.add(target)
+
+        if not preserved_files:
+            return
+        try:
+            storage = PreservedFiles()
+        except (EnvironmentError, ValueError) as e:
+            log.warning(f"Unable to preserve {len(preserved_files)} files: {e}")
+            return
+        for files in files_by_content_type.values():
+            for file in files:
+                if file.name in preserved_files:
+                    storage.add(file.archive, file.name)
+
+    def unit_scale(self, context, root):
+        """
+        Get the scaling factor we need to use for this document, according to its unit.
+        :param context: The Blender context.
+        :param root: An ElementTree root element containing the entire 3MF file.
+        :return: Floating point value that we need to scale this model by. A small number (<1) means that we need to
+        make the coordinates in Blender smaller than the coordinates in the file. A large number (>1) means we need to
+        make the coordinates in Blender larger than the coordinates in the file.
+        """
+        scale = self.global_scale
+
+        if context.scene.unit_settings.scale_length != 0:
+            scale /= context.scene.unit_settings.scale_length  # Apply the global scale of the units in Blender.
+
+        threemf_unit = root.attrib.get("unit", MODEL_DEFAULT_UNIT)
+        blender_unit = context.scene.unit_settings.length_unit
+        scale *= threemf_to_metre[threemf_unit]  # Convert 3MF units to metre.
+        scale /= blender_to_metre[blender_unit]  # Convert metre to Blender's units.
+
+        return scale
+
     def build_items(self, root, scale_unit):
         """
         Builds the scene. This places objects with certain transformations in
@@ -686,7 +1226,8 @@ class Import3MF(bpy.types.Operator, bpy_extras.io_utils.ImportHelper):
         :return: A sequence of Blender Objects that need to be placed in the
         scene. Each mesh gets transformed appropriately.
         """
-        for build_item in root.iterfind("./3mf:build/3mf:item", MODEL_NAMESPACES):
+        self.shared_resources = self.find_shared_resources(root)
+        for item_index, build_item in enumerate(root.iterfind("./3mf:build/3mf:item", MODEL_NAMESPACES), start=1):
             try:
                 objectid = build_item.attrib["objectid"]
                 resource_object = self.resource_objects[objectid]
@@ -707,82 +1248,97 @@ class Import3MF(bpy.types.Operator, bpy_extras.io_utils.ImportHelper):
             transform = mathutils.Matrix.Scale(scale_unit, 4)
             transform @= self.parse_transformation(build_item.attrib.get("transform", ""))
 
-            self.build_object(resource_object, transform, metadata, [objectid])
+            self.build_object(resource_object, transform, metadata, [objectid], item_index=item_index)
 
-    def build_object(self, resource_object, transformation, metadata, objectid_stack_trace, parent=None):
+    def find_shared_resources(self, root):
+        """
+        Finds the resource objects with components that are used in multiple places.
+
+        Expanding these for every build item and component that refers to them would multiply with every level of the
+        component tree. Resource objects that are referred to only once are expanded only once as well.
+        :param root: The root node of the 3dmodel.model XML document.
+        :return: A set of the object IDs of the resource objects that are used in multiple places.
+        """
+        reference_counts = collections.Counter(
+            build_item.attrib.get("objectid") for build_item in root.iterfind("./3mf:build/3mf:item", MODEL_NAMESPACES))
+        for resource_object in self.resource_objects.values():
+            reference_counts.update(component.resource_object for component in resource_object.components)
+        return {
+            objectid for objectid, count in reference_counts.items()
+            if count > 1 and objectid in self.resource_objects and self.resource_objects[objectid].components
+        }
+
+    def build_object(self, resource_object, transformation, metadata, objectid_stack_trace, parent=None, item_index=0,
+                     use_instance=True):
         """
         Converts a resource object into a Blender object.
 
         This resource object may refer to components that need to be built along. These components may again have
         subcomponents, and so on. These will be built recursively. A "stack trace" will be traced in order to prevent
         going into an infinite recursion.
+
+        Resource objects with components that are used in multiple places are built only once, in a collection of their
+        own. Each place then gets an empty that instances that collection.
         :param resource_object: The resource object that needs to be converted.
         :param transformation: A transformation matrix to apply to this resource object.
         :param metadata: A collection of metadata belonging to this build item.
         :param objectid_stack_trace: A list of all object IDs that have been processed so far, including the object ID
         we're processing now.
         :param parent: The resulting object must be marked as a child of this Blender object.
+        :param item_index: The number of the build item that this object is built for, to name the object after if the
+        resource object has no name.
+        :param use_instance: Whether to instance the collection of a resource object that is used in multiple places.
+        If `False`, the resource object itself is built.
         :return: A sequence of Blender objects. These objects may be "nested" in the sense that they sometimes refer to
         other objects as their parents.
         """
         # Create a mesh if there is mesh data here.
         mesh = None
-        if resource_object.triangles:
-            mesh = bpy.data.meshes.new("3MF Mesh")
-            mesh.from_pydata(resource_object.vertices, [], resource_object.triangles)
-            mesh.update()
+        instance_collection = None
+        objectid = objectid_stack_trace[-1]
+        if use_instance and objectid in self.shared_resources:
+            # This sub-assembly is used in multiple places. Refer to its collection rather than building it again.
+            instance_collection = self.build_collection(resource_object, objectid_stack_trace)
+        elif objectid in self.resource_to_mesh:
+            # This resource was already built for a different item or component. Make a linked duplicate of it.
+            mesh = self.resource_to_mesh[objectid]
+        elif len(resource_object.triangles) > 0:
+            mesh_name = self.unique_name(resource_object.name or f"3MF Mesh {objectid}", self.mesh_names)
+            mesh = self.build_mesh(resource_object.vertices, resource_object.triangles, mesh_name)
             resource_object.metadata.store(mesh)
+            self.resource_to_mesh[objectid] = mesh
 
-            # Mapping resource materials to indices in the list of materials for this specific mesh.
-            materials_to_index = {}
-            for triangle_index, triangle_material in enumerate(resource_object.materials):
-                if triangle_material is None:
-                    continue
-
-                # Add the material to Blender if it doesn't exist yet. Otherwise create a new material in Blender.
-                if triangle_material not in self.resource_to_material:
-                    material = bpy.data.materials.new(triangle_material.name)
-                    material.use_nodes = True
-                    principled = bpy_extras.node_shader_utils.PrincipledBSDFWrapper(material, is_readonly=False)
-                    principled.base_color = triangle_material.color[:3]
-                    principled.alpha = triangle_material.color[3]
-                    self.resource_to_material[triangle_material] = material
-                else:
-                    material = self.resource_to_material[triangle_material]
-
-                # Add the material to this mesh if it doesn't have it yet. Otherwise re-use previous index.
-                if triangle_material not in materials_to_index:
-                    new_index = len(mesh.materials.items())
-                    if new_index > 32767:
-                        log.warning("Blender doesn't support more than 32768 different materials per mesh.")
-                        continue
-                    mesh.materials.append(material)
-                    materials_to_index[triangle_material] = new_index
-
-                # Assign the material to the correct triangle.
-                mesh.polygons[triangle_index].material_index = materials_to_index[triangle_material]
+            self.assign_materials(mesh, resource_object.materials, resource_object.material_indices)
 
             # Note: Triangle sets are non-geometric groupings per 3MF spec §4.1.5.1
             # They do not affect geometry or material assignments.
             # Consumers may use them for internal purposes (display, selection, etc.)
             # but they should not generate materials or affect rendering.
-            # We preserve the triangle set information but do not apply it to the mesh.
+            # We store them as face attributes, which don't affect rendering but allow selecting the faces.
+            for triangleset in resource_object.trianglesets:
+                self.build_triangleset(mesh, triangleset, len(resource_object.triangles))
 
         # Create an object.
-        blender_object = bpy.data.objects.new("3MF Object", mesh)
+        object_name = self.unique_name(resource_object.name or f"3MF Object {objectid}-{item_index}", self.object_names)
+        blender_object = bpy.data.objects.new(object_name, mesh)
+        if instance_collection is not None:
+            blender_object.instance_type = 'COLLECTION'
+            blender_object.instance_collection = instance_collection
         self.num_loaded += 1
         if parent is not None:
             blender_object.parent = parent
         blender_object.matrix_world = transformation
-        bpy.context.collection.objects.link(blender_object)
-        bpy.context.view_layer.objects.active = blender_object
-        blender_object.select_set(True)
+        self.collection.objects.link(blender_object)  # The collection is not in the scene yet, so this is cheap.
+        self.built_objects.append(blender_object)
         metadata.store(blender_object)
         if "3mf:object_type" in resource_object.metadata\
                 and resource_object.metadata["3mf:object_type"].value in {"solidsupport", "support"}:
             # Don't render support meshes.
             blender_object.hide_render = True
 
+        if instance_collection is not None:
+            return  # The components are in the collection already.
+
         # Recurse for all components.
         for component in resource_object.components:
             if component.resource_object in objectid_stack_trace:
@@ -796,5 +1352,297 @@ class Import3MF(bpy.types.Operator, bpy_extras.io_utils.ImportHelper):
                 continue
             transform = transformation @ component.transformation  # Apply the child's transformation and pass it on.
             objectid_stack_trace.append(component.resource_object)
-            self.build_object(child_object, transform, metadata, objectid_stack_trace, parent=blender_object)
+            self.build_object(child_object, transform, metadata, objectid_stack_trace, parent=blender_object,
+                              item_index=item_index)
+            objectid_stack_trace.pop()
+
+    def assign_materials(self, mesh, materials, material_indices):
+        """
+        Adds the materials of the triangles to a mesh, and assigns them to its faces.
+
+        Each distinct material gets added to the material slots of the mesh once. Triangles without material keep the
+        first material slot.
+        :param mesh: The Blender mesh to assign the materials to.
+        :param materials: The distinct materials of the triangles, which may include `None` for triangles that don't
+        get a material.
+        :param material_indices: For each triangle, the index of its material in the list of materials.
+        """
+        # Mapping the materials to material slots of this specific mesh.
+        material_slots = numpy.zeros(len(materials), dtype=numpy.int32)
+        num_slots = 0
+        for material_index, triangle_material in enumerate(materials):
+            if triangle_material is None:
+                continue
+
+            # Add the material to Blender if it doesn't exist yet. Otherwise create a new material in Blender.
+            if triangle_material not in self.resource_to_material:
+                material = bpy.data.materials.new(triangle_material.name)
+                material.use_nodes = True
+                principled = bpy_extras.node_shader_utils.PrincipledBSDFWrapper(material, is_readonly=False)
+                principled.base_color = triangle_material.color[:3]
+                principled.alpha = triangle_material.color[3]
+                self.resource_to_material[triangle_material] = material
+            else:
+                material = self.resource_to_material[triangle_material]
+
+            if num_slots > 32767:
+                log.warning("Blender doesn't support more than 32768 different materials per mesh.")
+                continue
+            mesh.materials.append(material)
+            material_slots[material_index] = num_slots
+            num_slots += 1
+
+        if num_slots > 0:
+            # Assign the materials to all triangles at once. Materials that didn't fit get the first slot.
+            mesh.polygons.foreach_set("material_index", material_slots[material_indices])
+
+    def build_flattened(self, root, scale_unit, name):
+        """
+        Builds all items of a 3MF document into a single mesh, instead of an object for each item and component.
+
+        Supports are not part of the model itself. They are built into a separate object for each type of support, which
+        is hidden from renders like when building an object for each part, and keeps its type for exporting.
+        :param root: The root node of the 3dmodel.model XML document.
+        :param scale_unit: The scale to apply for the units of the model to be transformed to Blender's units, as a
+        float ratio.
+        :param name: The name for the object that contains the model. The objects with supports get the type of support
+        appended to it.
+        """
+        placements = {}  # For each resource object with a mesh, the transformations of all places where it's used.
+        for build_item in root.iterfind("./3mf:build/3mf:item", MODEL_NAMESPACES):
+            try:
+                objectid = build_item.attrib["objectid"]
+                resource_object = self.resource_objects[objectid]
+            except KeyError:  # ID is required, and it must be in the available resource_objects.
+                log.warning("Encountered build item without object ID.")
+                continue  # Ignore this invalid item.
+            transform = mathutils.Matrix.Scale(scale_unit, 4)
+            transform @= self.parse_transformation(build_item.attrib.get("transform", ""))
+            self.flatten_object(resource_object, transform, [objectid], placements)
+
+        placements_by_type = {"model": {}, "support": {}, "solidsupport": {}}
+        for objectid, transformations in placements.items():
+            metadata = self.resource_objects[objectid].metadata
+            object_type = metadata["3mf:object_type"].value if "3mf:object_type" in metadata else "model"
+            if object_type not in placements_by_type:
+                object_type = "model"  # Everything other than supports is combined into the model.
+            placements_by_type[object_type][objectid] = transformations
+
+        for object_type, type_placements in placements_by_type.items():
+            if not type_placements:
+                continue
+            if object_type == "model":
+                self.build_placements(type_placements, name)
+                continue
+            blender_object = self.build_placements(type_placements, f"{name} {object_type}")
+            metadata = Metadata()
+            metadata["3mf:object_type"] = MetadataEntry(
+                name="3mf:object_type",
+                preserve=True,
+                datatype="xs:string",
+                value=object_type)
+            metadata.store(blender_object)
+            blender_object.hide_render = True  # Don't render support meshes.
+
+    def build_placements(self, placements, name):
+        """
+        Builds resource objects in all places where they are used into a single mesh, with an object containing it.
+
+        The vertices of each resource object are transformed to every place where that resource object is used at once,
+        with a single matrix multiplication. The triangles are copied for each place, referring to the vertices of
+        that place. Then everything is concatenated into a single mesh.
+        :param placements: For each object ID of a resource object with a mesh, the transformations of all places where
+        it's used. There must be at least one.
+        :param name: The name for the object that contains the mesh.
+        :return: The Blender object that was built.
+        """
+        vertices = []
+        triangles = []
+        material_indices = []
+        distinct_materials = {}  # For each distinct material among all resource objects, its index in the mesh.
+        num_vertices = 0
+        for objectid, transformations in placements.items():
+            resource_object = self.resource_objects[objectid]
+            resource_vertices = numpy.asarray(resource_object.vertices, dtype=numpy.float64).reshape((-1, 3))
+            resource_triangles = numpy.asarray(resource_object.triangles, dtype=numpy.int32).reshape((-1, 3))
+            matrices = numpy.array([[list(row) for row in transformation] for transformation in transformations])
+
+            # Transform the vertices to all places at once, giving an array of the vertices of each place.
+            vertices.append(resource_vertices @ matrices[:, :3, :3].transpose((0, 2, 1)) + matrices[:, None, :3, 3])
+            # The triangles of each place refer to the vertices of that place.
+            offsets = num_vertices + numpy.arange(len(matrices), dtype=numpy.int32) * len(resource_vertices)
+            triangles.append(resource_triangles + offsets[:, None, None])
+            num_vertices += len(matrices) * len(resource_vertices)
+            # Map the materials of this resource object to the materials of the combined mesh.
+            material_map = numpy.array(
+                [distinct_materials.setdefault(material, len(distinct_materials))
+                 for material in resource_object.materials],
+                dtype=numpy.int32)
+            material_indices.append(numpy.tile(material_map[resource_object.material_indices], len(matrices)))
+
+        mesh_name = self.unique_name(name, self.mesh_names)
+        mesh = self.build_mesh(numpy.concatenate([block.reshape((-1, 3)) for block in vertices]),
+                               numpy.concatenate([block.reshape((-1, 3)) for block in triangles]),
+                               mesh_name)
+        self.assign_materials(mesh, list(distinct_materials), numpy.concatenate(material_indices))
+
+        blender_object = bpy.data.objects.new(self.unique_name(name, self.object_names), mesh)
+        self.num_loaded += 1
+        self.collection.objects.link(blender_object)
+        self.built_objects.append(blender_object)
+        return blender_object
+
+    def flatten_object(self, resource_object, transformation, objectid_stack_trace, placements):
+        """
+        Finds all places where a resource object and its components end up, to build them into a single mesh.
+
+        Like when building objects, a "stack trace" is traced to prevent going into an infinite recursion.
+        :param resource_object: The resource object to place.
+        :param transformation: The transformation of this place of the resource object.
+        :param objectid_stack_trace: A list of all object IDs that have been processed so far, including the object ID
+        we're processing now.
+        :param placements: For each object ID, the transformations of all places found so far. This gets updated.
+        """
+        if len(resource_object.triangles) > 0:
+            placements.setdefault(objectid_stack_trace[-1], []).append(transformation)
+
+        for component in resource_object.components:
+            if component.resource_object in objectid_stack_trace:
+                # These object IDs refer to each other in a loop. Don't go in there!
+                log.warning(f"Recursive components in object ID: {component.resource_object}")
+                continue
+            try:
+                child_object = self.resource_objects[component.resource_object]
+            except KeyError:  # Invalid resource ID. Doesn't exist!
+                log.warning(f"Build item with unknown resource ID: {component.resource_object}")
+                continue
+            transform = transformation @ component.transformation  # Apply the child's transformation and pass it on.
+            objectid_stack_trace.append(component.resource_object)
+            self.flatten_object(child_object, transform, objectid_stack_trace, placements)
             objectid_stack_trace.pop()
+
+    def build_triangleset(self, mesh, triangleset, num_triangles):
+        """
+        Stores a triangle set in a mesh, as a boolean face attribute that is named after the identifier of the set.
+
+        The membership of all faces is computed at once and then stored in bulk. Each range marks where membership
+        starts and where it stops again, and the running sum of those marks covers all faces in the range.
+        :param mesh: The Blender mesh to store the triangle set in.
+        :param triangleset: The triangle set to store.
+        :param num_triangles: The number of triangles in the mesh.
+        """
+        # Blender cuts off long names. Check against the name that the attribute would actually get.
+        attribute_name = triangleset.identifier.encode("UTF-8")[:MAX_NAME_LENGTH].decode("UTF-8", errors="ignore")
+        if attribute_name in mesh.attributes:
+            log.warning(f"Triangle set '{triangleset.name}' has the same identifier as an existing attribute of the "
+                        f"mesh: {attribute_name}")
+            return
+
+        ranges = triangleset.ranges[triangleset.ranges[:, 0] < num_triangles]
+        refs = triangleset.refs[triangleset.refs < num_triangles]
+        if len(ranges) < len(triangleset.ranges) or len(refs) < len(triangleset.refs)\
+                or (len(ranges) > 0 and ranges[:, 1].max() >= num_triangles):
+            log.warning(f"Triangle set '{triangleset.name}' refers to triangles that don't exist.")
+
+        marks = numpy.zeros(num_triangles + 1, dtype=numpy.int32)
+        numpy.add.at(marks, ranges[:, 0], 1)
+        numpy.add.at(marks, numpy.minimum(ranges[:, 1] + 1, num_triangles), -1)
+        in_set = numpy.cumsum(marks[:num_triangles]) > 0
+        in_set[refs] = True
+
+        attribute = mesh.attributes.new(name=attribute_name, type="BOOLEAN", domain="FACE")
+        attribute.data.foreach_set("value", in_set)
+
+    def link_collection(self, collection, blender_objects):
+        """
+        Adds the collection with the objects of a file to the scene, and selects those objects.
+
+        The objects are all linked to the collection while it's not in the scene yet. This way the view layer only
+        needs to be updated once for all of them, rather than for each object separately.
+        :param collection: The collection that the objects of the file were linked to.
+        :param blender_objects: The objects that were built for the file, in the order in which they were built.
+        """
+        if not blender_objects:  # Nothing was imported from this file. Don't leave an empty collection.
+            bpy.data.collections.remove(collection)
+            return
+        bpy.context.collection.children.link(collection)
+        for blender_object in blender_objects:
+            blender_object.select_set(True)
+        bpy.context.view_layer.objects.active = blender_objects[-1]
+
+    def unique_name(self, name, used_names):
+        """
+        Finds a name for a new data block that no other data block of the same type has yet, and reserves it.
+
+        Blender would otherwise make the name unique itself, by appending one number after another until it finds a
+        free one. With thousands of objects of the same name, that takes time for each of them. This continues from the
+        last number that was appended to the same name instead.
+        :param name: The preferred name for the data block.
+        :param used_names: The names in use, to the next number to try appending to them. This gets updated.
+        :return: A name that isn't in use yet.
+        """
+        name = name.encode("UTF-8")[:MAX_NAME_LENGTH].decode("UTF-8", errors="ignore")  # Blender would cut it off.
+        candidate = name
+        number = used_names.get(name)
+        if number is not None:
+            # Leave room for a number, within the maximum length of names in Blender.
+            base = name.encode("UTF-8")[:MAX_NAME_LENGTH - 8].decode("UTF-8", errors="ignore")
+            while candidate in used_names:
+                number += 1
+                candidate = f"{base} {number}"
+            used_names[name] = number
+        used_names[candidate] = 1
+        return candidate
+
+    def build_collection(self, resource_object, objectid_stack_trace):
+        """
+        Builds a resource object into a collection of its own, so that it can be instanced in multiple places.
+
+        The collection is built only once for each resource object. It's not added to the scene itself.
+        :param resource_object: The resource object to build.
+        :param objectid_stack_trace: A list of all object IDs that have been processed so far, including the object ID
+        of this resource object.
+        :return: The collection containing the resource object and its components.
+        """
+        objectid = objectid_stack_trace[-1]
+        if objectid in self.resource_to_collection:
+            return self.resource_to_collection[objectid]
+
+        collection_name = self.unique_name(resource_object.name or f"3MF Component {objectid}", self.collection_names)
+        collection = bpy.data.collections.new(collection_name)
+        # Build the objects into this collection instead of the collection of the file, without selecting them.
+        file_collection, file_objects = self.collection, self.built_objects
+        self.collection = collection
+        self.built_objects = []
+        self.build_object(resource_object, mathutils.Matrix.Identity(4), Metadata(), objectid_stack_trace,
+                          use_instance=False)
+        self.collection, self.built_objects = file_collection, file_objects
+
+        self.resource_to_collection[objectid] = collection
+        return collection
+
+    def build_mesh(self, vertices, triangles, name):
+        """
+        Creates a Blender mesh from vertex and triangle data.
+
+        Rather than letting Blender convert the coordinates and indices one tuple at a time, the data is flattened into
+        buffers with the same data types as Blender's internal storage. Those buffers are then copied into the mesh in
+        bulk.
+        :param vertices: The vertices of the mesh. Each vertex has 3 coordinates, for X, Y and Z.
+        :param triangles: The triangles of the mesh. Each triangle has 3 indices, referring to the list of vertices.
+        :param name: The name of the new mesh.
+        :return: A new Blender mesh with this geometry.
+        """
+        vertices = numpy.asarray(vertices, dtype=numpy.float32).reshape(-1)
+        triangles = numpy.asarray(triangles, dtype=numpy.int32).reshape(-1)
+
+        mesh = bpy.data.meshes.new(name)
+        mesh.vertices.add(len(vertices) // 3)
+        mesh.vertices.foreach_set("co", vertices)
+        mesh.loops.add(len(triangles))
+        mesh.loops.foreach_set("vertex_index", triangles)
+        mesh.polygons.add(len(triangles) // 3)
+        # All faces are triangles, so every face starts 3 loops after the previous. The size of each face follows.
+        mesh.polygons.foreach_set("loop_start", numpy.arange(0, len(triangles), 3, dtype=numpy.int32))
+        mesh.update(calc_edges=True)
+        return mesh
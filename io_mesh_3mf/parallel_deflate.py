@@ -0,0 +1,118 @@
+# Blender add-on to import and export 3MF files.
+# Copyright (C) 2020 Ghostkeeper
+# This add-on is free software; you can redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation; either version 2 of the License, or (at your option) any later
+# version.
+# This add-on is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License along with this program; if not, write to the Free
+# Software Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# <pep8 compliant>
+
+import collections  # A queue of the blocks that are being compressed.
+import concurrent.futures  # To compress blocks on multiple threads.
+import os  # To find the number of processors.
+import zlib  # To deflate the blocks. This releases the GIL while compressing, so the threads run in parallel.
+
+BLOCK_SIZE = 1 << 20  # Number of bytes to compress per block. Smaller blocks compress slightly worse.
+DICTIONARY_SIZE = 1 << 15  # The window of the deflate algorithm. Each block may refer back this far into the previous.
+
+
+class ParallelDeflate:
+    """
+    A compressor that deflates a stream in blocks on multiple threads, producing a single deflate stream.
+
+    Each block is compressed separately, primed with the end of the previous block as dictionary, so that it compresses
+    nearly as well as if it were compressed in one go. The blocks are ended with a sync flush, which aligns them to
+    whole bytes without marking them as the last block. That way they can be concatenated in order. Only the last block
+    marks the end of the stream.
+
+    This has the same interface as the compressors of `zlib`, producing raw deflate data as used in ZIP archives.
+    """
+
+    def __init__(self, level, block_size=BLOCK_SIZE, max_workers=None):
+        """
+        Prepare to compress a stream.
+        :param level: The compression level, from 0 to 9.
+        :param block_size: The number of bytes to compress per block.
+        :param max_workers: The number of threads to compress with. By default, one per processor.
+        """
+        self.level = level
+        self.block_size = block_size
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        self.max_pending = max_workers * 2  # Limit the number of blocks in memory if the compression can't keep up.
+        self.pending = collections.deque()  # Futures of the blocks being compressed, in order.
+        self.buffer = bytearray()  # Data that is not enough for a complete block yet.
+        self.dictionary = b""  # The end of the previous block.
+
+    def compress(self, data):
+        """
+        Add data to compress.
+
+        The data is compressed in the background. Whatever was finished compressing by now is returned.
+        :param data: The data to compress.
+        :return: The compressed data of the blocks that are done, if any.
+        """
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            block = bytes(self.buffer[:self.block_size])
+            del self.buffer[:self.block_size]
+            self.submit(block, zlib.Z_SYNC_FLUSH)
+
+        result = bytearray()
+        while self.pending and (self.pending[0].done() or len(self.pending) > self.max_pending):
+            result += self.pending.popleft().result()
+        return bytes(result)
+
+    def flush(self):
+        """
+        Finish compressing the stream.
+        :return: The remainder of the compressed data.
+        """
+        try:
+            self.submit(bytes(self.buffer), zlib.Z_FINISH)
+            self.buffer.clear()
+
+            result = bytearray()
+            while self.pending:
+                result += self.pending.popleft().result()
+        finally:
+            self.close()
+        return bytes(result)
+
+    def close(self):
+        """
+        Stop the threads that compress the blocks, discarding any blocks that were not compressed yet.
+
+        This is done when the stream is flushed. It only needs to be called separately if compressing is abandoned.
+        """
+        self.pending.clear()
+        self.executor.shutdown(cancel_futures=True)
+
+    def submit(self, block, mode):
+        """
+        Start compressing a block on one of the threads.
+        :param block: The data to compress.
+        :param mode: How to end the block: `Z_SYNC_FLUSH` to continue the stream, or `Z_FINISH` to end it.
+        """
+        self.pending.append(self.executor.submit(self.deflate, block, self.dictionary, mode))
+        self.dictionary = (self.dictionary + block[-DICTIONARY_SIZE:])[-DICTIONARY_SIZE:]
+
+    def deflate(self, block, dictionary, mode):
+        """
+        Compress a single block.
+
+        This is executed on the threads.
+        :param block: The data to compress.
+        :param dictionary: The data that preceded this block, which the block may refer to.
+        :param mode: How to end the block: `Z_SYNC_FLUSH` to continue the stream, or `Z_FINISH` to end it.
+        :return: Raw deflate data.
+        """
+        if dictionary:
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=dictionary)
+        else:  # The first block. An empty dictionary is not allowed.
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        return compressor.compress(block) + compressor.flush(mode)
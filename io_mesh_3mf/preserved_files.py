@@ -0,0 +1,238 @@
+# Blender add-on to import and export 3MF files.
+# Copyright (C) 2020 Ghostkeeper
+# This add-on is free software; you can redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation; either version 2 of the License, or (at your option) any later
+# version.
+# This add-on is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License along with this program; if not, write to the Free
+# Software Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# <pep8 compliant>
+
+import base64  # To read files that were preserved by older versions of this add-on.
+import bpy  # To refer to the preserved files from the Blender scene.
+import hashlib  # To name the stored files after their contents.
+import io  # To store files that were preserved by older versions of this add-on.
+import logging  # To report files that could not be preserved.
+import os  # To find and move the stored files.
+import tempfile  # To write a stored file before we know what its name will be.
+import time  # To find stored files that were not used for a long time.
+import zipfile  # To store the compressed files.
+
+from .constants import *
+from .zipfile_compat import copy_compressed  # To copy the compressed files between archives.
+
+log = logging.getLogger(__name__)
+
+PRESERVED_FOLDER = ".3mf_preserved/"  # Prefix for the names of the Text blocks that refer to preserved files.
+STORE_PATH = "preserved"  # Directory in the user data of this extension where the contents are stored.
+MAX_UNUSED_AGE = 90 * 24 * 60 * 60  # After how many seconds without being used stored contents may be removed.
+REFERENCE_PREFIX = "sha256:"  # Prefix of the Text block contents that refer to a stored file.
+
+
+class PreservedFiles:
+    """
+    This is the storage of files that must be preserved from 3MF archives, until they are written to a 3MF archive
+    again.
+
+    The contents of these files can be big, and are often binary. So rather than putting their contents in the Blender
+    scene, the contents are stored in the user data directory of this extension, in a file named after the SHA-256 hash
+    of the contents. Files with the same contents are stored only once. The Blender scene refers to each preserved file
+    with a Text block in a hidden folder, which contains the hash of its contents. Stored contents that no .blend file
+    was opened with for a long time get removed.
+
+    Each stored file is a ZIP archive holding the file exactly as it was compressed in the original 3MF archive. The
+    compressed data is copied as it is, both when storing it and when writing it to a 3MF archive again, so that big
+    files never need to be compressed again. Only if the `zipfile` module of this version of Python doesn't allow that,
+    the files are decompressed and compressed again (see `zipfile_compat`).
+
+    Older versions of this add-on stored the contents in the Text block itself, encoded as Base85. Those can still be
+    read.
+    """
+
+    def __init__(self):
+        """
+        Prepares access to the stored files.
+        :raises ValueError: This add-on is not installed as an extension, so it has no user data directory.
+        :raises EnvironmentError: The directory to store the files in can't be created.
+        """
+        # This module is in a subpackage. Blender only knows the user data of the package of the extension itself.
+        extension_package = __package__.rpartition(".")[0]
+        self.directory = bpy.utils.extension_path_user(extension_package, path=STORE_PATH, create=True)
+
+    def add(self, archive, filename):
+        """
+        Preserve a file from a 3MF archive.
+
+        If a file with the same path was preserved before, but with different contents, then the file is in conflict.
+        It will then not be preserved at all.
+        :param archive: The 3MF archive that contains the file.
+        :param filename: The path of the file in the archive.
+        """
+        text_name = PRESERVED_FOLDER + filename
+        if text_name in bpy.data.texts:
+            previous_reference = self.read_reference(bpy.data.texts[text_name])
+            if previous_reference == conflicting_mustpreserve_contents:
+                # This file was previously already in conflict. The new file will always be in conflict with one of
+                # the previous files.
+                return
+        else:
+            previous_reference = None
+
+        reference = self.store(archive, filename)
+        if previous_reference is None:  # File doesn't exist yet.
+            handle = bpy.data.texts.new(text_name)
+            handle.write(reference)
+        elif previous_reference != reference:  # Same file exists with different contents, so they are in conflict.
+            bpy.data.texts[text_name].clear()
+            bpy.data.texts[text_name].write(conflicting_mustpreserve_contents)
+        # Else, the contents are EXACTLY the same, so the file is not in conflict. It doesn't need to be re-added.
+
+    def write(self, archive):
+        """
+        Write all preserved files to an archive.
+
+        The compressed data is copied in pieces, so it never needs to be in memory entirely, nor compressed again.
+
+        The contents of a preserved file may no longer be stored, for instance if the .blend file was made on a
+        different computer. Those files can't be written. The caller should report them to the user.
+        :param archive: The archive to write the files to.
+        :return: The paths of the preserved files whose contents are no longer available.
+        """
+        missing = []
+        for text in bpy.data.texts:
+            if not text.name.startswith(PRESERVED_FOLDER):
+                continue  # Unrelated file. Not ours to read.
+            contents = text.as_string()
+            if contents == conflicting_mustpreserve_contents:
+                continue  # This file was in conflict. Don't preserve any copy of it then.
+            filename = text.name[len(PRESERVED_FOLDER):]
+
+            if not contents.startswith(REFERENCE_PREFIX):  # Stored by an older version, in the Text block itself.
+                with archive.open(filename, 'w', force_zip64=True) as f:
+                    f.write(base64.b85decode(contents.encode("UTF-8")))
+                continue
+            try:
+                with zipfile.ZipFile(self.path(contents)) as stored:
+                    copy_compressed(stored, stored.infolist()[0], archive, filename)
+            except (FileNotFoundError, ValueError, IndexError, zipfile.BadZipFile):
+                log.warning(f"The contents of preserved file {filename} are no longer available.")
+                missing.append(filename)
+        return missing
+
+    def cleanup(self):
+        """
+        Remove stored contents that are no longer used.
+
+        Only one .blend file is open at a time, but .blend files that are not open may still refer to stored contents.
+        So the contents that the open .blend file refers to are marked as used, and only contents that were not used by
+        any .blend file that was opened in the last `MAX_UNUSED_AGE` seconds are removed.
+        """
+        used = set()
+        for text in bpy.data.texts:
+            if not text.name.startswith(PRESERVED_FOLDER):
+                continue  # Unrelated file. Not ours to read.
+            contents = text.as_string()
+            if not contents.startswith(REFERENCE_PREFIX):
+                continue  # In conflict, or stored by an older version in the Text block itself.
+            try:
+                stored_path = self.path(contents)
+            except ValueError:
+                continue  # Not a valid reference. It can't refer to anything in the storage.
+            used.add(os.path.basename(stored_path))
+            try:
+                os.utime(stored_path)  # Mark as used.
+            except FileNotFoundError:
+                pass
+
+        expiry = time.time() - MAX_UNUSED_AGE
+        for entry in os.scandir(self.directory):
+            if entry.name in used:
+                continue
+            try:
+                if entry.stat().st_mtime < expiry:
+                    os.remove(entry.path)
+            except EnvironmentError as e:
+                log.warning(f"Unable to remove unused preserved contents {entry.name}: {e}")
+
+    def store(self, archive, filename):
+        """
+        Store the contents of a file from a 3MF archive.
+
+        The contents are decompressed once, in pieces, to compute their hash. The compressed data itself is copied to
+        the storage as it is.
+        :param archive: The 3MF archive that contains the file.
+        :param filename: The path of the file in the archive.
+        :return: A reference to the stored contents, to put in the Blender scene.
+        """
+        info = archive.getinfo(filename)
+        file_hash = hashlib.sha256()
+        with archive.open(info) as f:  # This also verifies the CRC of the contents.
+            while True:
+                chunk = f.read(1024 * 1024)
+                if not chunk:
+                    break
+                file_hash.update(chunk)
+        reference = REFERENCE_PREFIX + file_hash.hexdigest()
+        stored_path = self.path(reference)
+        if os.path.exists(stored_path):
+            os.utime(stored_path)  # Same contents were stored before. Mark them as used again.
+            return reference
+
+        handle, temporary_path = tempfile.mkstemp(dir=self.directory)
+        try:
+            with os.fdopen(handle, "wb") as f, zipfile.ZipFile(f, "w") as stored:
+                copy_compressed(archive, info, stored, file_hash.hexdigest())
+            os.replace(temporary_path, stored_path)
+        except BaseException:
+            os.remove(temporary_path)
+            raise
+        return reference
+
+    def read_reference(self, text):
+        """
+        Get the reference to the contents of a preserved file from its Text block.
+
+        If the file was preserved by an older version of this add-on, its contents are moved to the storage, and the
+        Text block is changed to refer to them.
+        :param text: The Text block of a preserved file.
+        :return: The reference to the contents of the file, or the flag that the file is in conflict.
+        """
+        contents = text.as_string()
+        if contents.startswith(REFERENCE_PREFIX) or contents == conflicting_mustpreserve_contents:
+            return contents
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_DEFLATED) as legacy:
+            legacy.writestr("contents", base64.b85decode(contents.encode("UTF-8")))
+        with zipfile.ZipFile(buffer) as legacy:
+            reference = self.store(legacy, "contents")
+        text.clear()
+        text.write(reference)
+        return reference
+
+    def path(self, reference):
+        """
+        Get the path to where the contents of a preserved file are stored.
+        :param reference: The reference to the contents, as stored in the Blender scene.
+        :return: A file path.
+        :raises ValueError: The reference is not a valid hash, so it can't refer to any stored contents.
+        """
+        file_hash = reference[len(REFERENCE_PREFIX):]
+        if len(file_hash) != 64 or file_hash.strip("0123456789abcdef"):
+            raise ValueError(f"Invalid reference to preserved file: {reference}")
+        return os.path.join(self.directory, file_hash)
+
+
+@bpy.app.handlers.persistent
+def cleanup_preserved_files(*args):
+    """
+    Removes stored contents of preserved files that are no longer used, after a .blend file is loaded.
+
+    This is called by Blender, from the `load_post` handler.
+    :param args: The arguments that Blender passes to the handler, which are not used.
+    """
+    try:
+        PreservedFiles().cleanup()
+    except (EnvironmentError, ValueError) as e:
+        log.warning(f"Unable to clean up preserved files: {e}")
@@ -0,0 +1,259 @@
+# Blender add-on to import and export 3MF files.
+# Copyright (C) 2020 Ghostkeeper
+# This add-on is free software; you can redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation; either version 2 of the License, or (at your option) any later
+# version.
+# This add-on is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License along with this program; if not, write to the Free
+# Software Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# <pep8 compliant>
+
+import collections  # A queue of the parts of the document that are not written yet.
+import concurrent.futures  # To serialize parts of the document on other threads.
+import io  # To encode the document while writing it to a binary stream.
+
+# Characters that need to be escaped in the text of an element, and in the values of attributes.
+TEXT_ESCAPES = str.maketrans({
+    "&": "&amp;",
+    "<": "&lt;",
+    ">": "&gt;"
+})
+ATTRIBUTE_ESCAPES = str.maketrans({
+    "&": "&amp;",
+    "<": "&lt;",
+    ">": "&gt;",
+    "\"": "&quot;",
+    "\n": "&#10;",
+    "\r": "&#13;",
+    "\t": "&#09;"
+})
+
+
+class XMLWriter:
+    """
+    Writes an XML document to a stream, one element at a time.
+
+    Unlike an ElementTree, this never holds more of the document in memory than a small buffer. The elements must be
+    written in document order then, and every element that is started must be ended again.
+
+    Tags and attribute names are given in the same form as for ElementTree, with the namespace URI in braces. They are
+    written with the prefixes given to the namespaces when creating the writer. Attributes in the default namespace are
+    written without prefix.
+
+    Big parts of the document can be serialized on other threads with `defer`. Everything is still written in the
+    order in which it was given to the writer.
+
+    A buffered writer only collects the document, without writing anything to the stream. The deferred parts keep the
+    arguments to serialize them with. Closing the writer then serializes and writes the document, which may happen on a
+    different thread.
+    """
+
+    def __init__(self, stream, namespaces, executor=None, max_deferred=16, buffered=False):
+        """
+        Start writing an XML document.
+        :param stream: A binary stream to write the document to.
+        :param namespaces: A dictionary of prefixes to the namespace URIs they stand for. The namespace with the empty
+        prefix is the default namespace. All of these are declared on the root element.
+        :param executor: An executor to serialize deferred parts of the document with. If not given, deferred parts are
+        serialized right away.
+        :param max_deferred: The maximum number of deferred parts that may be serialized at the same time. Writing
+        waits when there are more, to limit the memory they take.
+        :param buffered: Whether to write nothing to the stream until the writer is closed.
+        """
+        self.stream = io.TextIOWrapper(stream, encoding="UTF-8", newline="")
+        self.namespaces = namespaces
+        self.prefixes = {uri: prefix for prefix, uri in namespaces.items()}
+        self.qualified_names = {}  # Cache of the names as they were written, since the same few are written very often.
+        self.is_root = True
+        self.executor = executor
+        self.max_deferred = max_deferred
+        self.buffered = buffered
+        self.cancelled = False
+        # Parts that wait to be written. Strings, or deferred parts as lists of function, arguments and future.
+        self.queue = collections.deque()
+        self.unsubmitted = collections.deque()  # The deferred parts that were not given to the executor yet.
+        self.num_deferred = 0  # How many of the parts in the queue are deferred.
+        self.num_submitted = 0  # How many of the deferred parts in the queue were given to the executor.
+        self.total_deferred = 0  # How many parts were deferred in total, to track the progress.
+
+        self.write("<?xml version='1.0' encoding='UTF-8'?>\n")
+
+    def __enter__(self):
+        """
+        Allows using the writer as a context manager, to make sure that everything gets written to the stream.
+        :return: This writer.
+        """
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """
+        Writes the remainder of the buffer to the stream, leaving the stream itself open.
+        """
+        self.close()
+
+    def close(self):
+        """
+        Writes the remainder of the buffer to the stream, leaving the stream itself open.
+        """
+        if self.stream is not None:
+            try:
+                self.write_queue(wait=True)
+            finally:
+                stream = self.stream
+                self.stream = None
+                stream.detach()  # Also flushes what was written so far.
+
+    def start(self, tag, attrib=None):
+        """
+        Write the start tag of an element.
+
+        The children of the element can be written afterwards, and then the element must be ended with `end`.
+        :param tag: The name of the element.
+        :param attrib: A dictionary of attribute names to their values, if any.
+        """
+        self.write(self.open_tag(tag, attrib) + ">")
+
+    def end(self, tag):
+        """
+        Write the end tag of an element.
+        :param tag: The name of the element.
+        """
+        self.write(f"</{self.qualified_name(tag)}>")
+
+    def element(self, tag, attrib=None, text=None):
+        """
+        Write a complete element, which has no child elements.
+        :param tag: The name of the element.
+        :param attrib: A dictionary of attribute names to their values, if any.
+        :param text: The text to put in the element, if any.
+        """
+        if text:
+            text = text.translate(TEXT_ESCAPES)
+            self.write(f"{self.open_tag(tag, attrib)}>{text}</{self.qualified_name(tag)}>")
+        else:
+            self.write(self.open_tag(tag, attrib) + " />")
+
+    def defer(self, function, *args):
+        """
+        Write a part of the document that gets serialized by a function, on a thread of the executor.
+
+        The writer doesn't wait for the function to finish. What gets written afterwards waits in a queue until it did.
+        :param function: A function that serializes a part of the document, returning it as a string. Names in it must
+        already have their namespace prefixes.
+        :param args: The arguments to call the function with.
+        """
+        if self.executor is None and not self.buffered:
+            self.write(function(*args))
+            return
+        part = [function, args, None]  # The future is filled in when it's given to the executor.
+        self.queue.append(part)
+        self.unsubmitted.append(part)
+        self.num_deferred += 1
+        self.total_deferred += 1
+        if not self.buffered:
+            self.write_queue(wait=False)
+
+    def progress(self):
+        """
+        Get how far the deferred parts of the document are written.
+        :return: The fraction of the deferred parts that are written, between 0 and 1.
+        """
+        if self.total_deferred == 0:
+            return 1.0
+        return 1.0 - self.num_deferred / self.total_deferred
+
+    def cancel(self):
+        """
+        Stop writing the document.
+
+        This may be called from a different thread than the one writing the document. Writing then raises a
+        `CancelledError` as soon as possible.
+        """
+        self.cancelled = True
+
+    def write(self, serialized):
+        """
+        Write serialized text to the stream, or to the queue if it needs to wait for deferred parts.
+        :param serialized: The text to write.
+        """
+        if self.queue or self.buffered:
+            self.queue.append(serialized)
+        else:
+            self.stream.write(serialized)
+
+    def write_queue(self, wait):
+        """
+        Write the parts in the queue to the stream, as far as they are serialized.
+        :param wait: Whether to wait for all deferred parts to finish, emptying the queue. If not, this only waits if
+        there are too many deferred parts.
+        """
+        while self.queue:
+            if self.cancelled:
+                raise concurrent.futures.CancelledError("Writing the document was cancelled.")
+            self.submit_deferred()
+            part = self.queue[0]
+            if isinstance(part, str):
+                self.stream.write(part)
+            else:
+                future = part[2]
+                if not (wait or future.done() or self.num_deferred > self.max_deferred):
+                    break  # Still being serialized.
+                self.stream.write(future.result())  # Raises the exception of the function, if any.
+                self.num_deferred -= 1
+                self.num_submitted -= 1
+            self.queue.popleft()
+
+    def submit_deferred(self):
+        """
+        Start serializing deferred parts, as many as may be serialized at the same time.
+        """
+        while self.unsubmitted and self.num_submitted < self.max_deferred:
+            part = self.unsubmitted.popleft()
+            function, args, _ = part
+            if self.executor is None:  # Buffered, but nothing to serialize it with. Serialize it right away.
+                part[2] = concurrent.futures.Future()
+                part[2].set_result(function(*args))
+            else:
+                part[2] = self.executor.submit(function, *args)
+            self.num_submitted += 1
+
+    def open_tag(self, tag, attrib):
+        """
+        Serializes the first part of a start tag, containing the name and the attributes, but not the closing bracket.
+
+        The namespaces are declared on the first element that is written.
+        :param tag: The name of the element.
+        :param attrib: A dictionary of attribute names to their values, if any.
+        :return: The serialized start of the tag.
+        """
+        result = "<" + self.qualified_name(tag)
+        if self.is_root:
+            self.is_root = False
+            for prefix, uri in self.namespaces.items():
+                name = f"xmlns:{prefix}" if prefix else "xmlns"
+                result += f" {name}=\"{uri.translate(ATTRIBUTE_ESCAPES)}\""
+        if attrib:
+            for name, value in attrib.items():
+                result += f" {self.qualified_name(name)}=\"{value.translate(ATTRIBUTE_ESCAPES)}\""
+        return result
+
+    def qualified_name(self, name):
+        """
+        Translate a name in ElementTree's notation to the name as it is written in the document.
+        :param name: A name with the namespace URI in braces, or a name without namespace.
+        :return: The name with the prefix of the namespace, if it has one.
+        """
+        try:
+            return self.qualified_names[name]
+        except KeyError:
+            pass
+        if name.startswith("{"):
+            uri, local_name = name[1:].split("}", 1)
+            prefix = self.prefixes[uri]  # Raises KeyError if the namespace was not declared.
+            qualified_name = f"{prefix}:{local_name}" if prefix else local_name
+        else:
+            qualified_name = name
+        self.qualified_names[name] = qualified_name
+        return qualified_name
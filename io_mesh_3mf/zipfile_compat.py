@@ -0,0 +1,109 @@
+# Blender add-on to import and export 3MF files.
+# Copyright (C) 2020 Ghostkeeper
+# This add-on is free software; you can redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation; either version 2 of the License, or (at your option) any later
+# version.
+# This add-on is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License along with this program; if not, write to the Free
+# Software Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# <pep8 compliant>
+
+"""
+Access to the internals of the `zipfile` module, for what it has no public interface for.
+
+The `zipfile` module can't copy compressed data from one archive to another, nor compress a file with a different
+compressor. Both are done here through private attributes of `zipfile`, which may change between versions of Python.
+Before using them, the functions here check that they exist. If not, they fall back to the public interface, which is
+slower but gives the same archive.
+"""
+
+import os  # To skip over the file name and extra field in local file headers.
+import shutil  # To copy decompressed files if the compressed data can't be copied.
+import struct  # To read the local headers of compressed files in the archives.
+import zipfile  # To copy files between archives.
+
+# The private attributes of `ZipFile` that copying compressed data relies on.
+ARCHIVE_ATTRIBUTES = ("_lock", "_writing", "_seekable", "start_dir", "_didModify", "_writecheck")
+# The private attribute of the streams of `ZipFile.open` that holds their compressor.
+COMPRESSOR_ATTRIBUTE = "_compressor"
+
+
+def can_copy_compressed(*archives):
+    """
+    Checks whether compressed data can be copied between archives with this version of the `zipfile` module.
+    :param archives: The `ZipFile` archives involved in the copy.
+    :return: `True` if all private attributes that copying relies on exist, or `False` if not.
+    """
+    return all(hasattr(archive, attribute) for archive in archives for attribute in ARCHIVE_ATTRIBUTES)
+
+
+def copy_compressed(source, info, target, filename):
+    """
+    Copy a file from one ZIP archive to another, without decompressing and compressing it again, if possible.
+
+    This writes the local file header and the compressed data itself, and registers the file in the target archive the
+    same way `ZipFile.write` does. If this version of the `zipfile` module doesn't have the attributes for that, the
+    file is decompressed and compressed again instead, with the same compression method.
+    :param source: The ZIP archive to copy the file from, opened for reading.
+    :param info: The `ZipInfo` of the file in the source archive.
+    :param target: The ZIP archive to copy the file to, opened for writing.
+    :param filename: The path to give the file in the target archive.
+    :raises zipfile.BadZipFile: The local file header in the source archive is damaged.
+    """
+    copy_info = zipfile.ZipInfo(filename, info.date_time)
+    copy_info.compress_type = info.compress_type
+    copy_info.external_attr = info.external_attr
+
+    if not can_copy_compressed(source, target):
+        with source.open(info) as source_file, target.open(copy_info, "w", force_zip64=True) as target_file:
+            shutil.copyfileobj(source_file, target_file, 1024 * 1024)
+        return
+
+    copy_info.CRC = info.CRC
+    copy_info.compress_size = info.compress_size
+    copy_info.file_size = info.file_size
+    with source._lock, target._lock:
+        source.fp.seek(info.header_offset)
+        header = source.fp.read(zipfile.sizeFileHeader)
+        if len(header) != zipfile.sizeFileHeader or header[:4] != zipfile.stringFileHeader:
+            raise zipfile.BadZipFile(f"Bad local file header for {info.filename}")
+        header = struct.unpack(zipfile.structFileHeader, header)
+        source.fp.seek(header[10] + header[11], os.SEEK_CUR)  # Skip the file name and extra field.
+
+        if target._writing:
+            raise ValueError("Can't copy a file while another file is being written to the archive.")
+        if target._seekable:
+            target.fp.seek(target.start_dir)
+        copy_info.header_offset = target.fp.tell()
+        target._writecheck(copy_info)
+        target._didModify = True
+        target.fp.write(copy_info.FileHeader())
+        remaining = info.compress_size
+        while remaining > 0:
+            chunk = source.fp.read(min(remaining, 1024 * 1024))
+            if not chunk:
+                raise zipfile.BadZipFile(f"Compressed data of {info.filename} is truncated")
+            target.fp.write(chunk)
+            remaining -= len(chunk)
+        target.filelist.append(copy_info)
+        target.NameToInfo[filename] = copy_info
+        target.start_dir = target.fp.tell()
+
+
+def replace_compressor(stream, create_compressor):
+    """
+    Swap the compressor of a file that is being written to a ZIP archive for a different one, if possible.
+
+    This must be done before anything is written to the stream. If this version of the `zipfile` module doesn't keep
+    the compressor where it's expected, the stream keeps compressing with its own compressor.
+    :param stream: A stream returned by `ZipFile.open` in writing mode, for a compressed file.
+    :param create_compressor: A function that creates the new compressor. It must have the same interface as the
+    compressors of `zlib`. It's only called if the compressor can be replaced.
+    :return: `True` if the compressor was replaced, or `False` if the stream keeps its own compressor.
+    """
+    if getattr(stream, COMPRESSOR_ATTRIBUTE, None) is None:
+        return False
+    setattr(stream, COMPRESSOR_ATTRIBUTE, create_compressor())
+    return True
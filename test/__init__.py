@@ -24,6 +24,7 @@ from .mock import mathutils
 # Mock all of the Blender API packages.
 sys.modules["mathutils"] = mathutils
 sys.modules["bpy"] = unittest.mock.MagicMock()
+sys.modules["bpy"].app.handlers.persistent = lambda function: function  # Keep the handlers themselves, to test them.
 sys.modules["bpy.ops"] = unittest.mock.MagicMock()
 sys.modules["bpy.props"] = unittest.mock.MagicMock()
 sys.modules["bpy.types"] = unittest.mock.MagicMock()
@@ -38,3 +39,7 @@ from .import_3mf import TestImport3MF
 from .export_3mf import TestExport3MF
 from .metadata import TestMetadata
 from .annotations import TestAnnotations
+from .preserved_files import TestPreservedFiles
+from .xml_writer import TestXMLWriter
+from .parallel_deflate import TestParallelDeflate
+from .zipfile_compat import TestZipfileCompat
@@ -10,12 +10,17 @@
 
 # <pep8 compliant>
 
+import concurrent.futures  # To format the mesh data on multiple threads.
+import io  # To write documents to memory.
 import os  # To save archives to a temporary file.
 import mathutils  # To mock parameters and return values that are transformations.
+import numpy  # To mock bulk access to Blender's mesh data.
 import tempfile  # To save archives to a temporary file.
+import threading  # To check that no threads are left running after a failed export.
 import unittest  # To run the tests.
 import unittest.mock  # To mock away the Blender API.
-import xml.etree.ElementTree  # To construct empty documents for the functions to build elements in.
+import xml.etree.ElementTree  # To parse the documents that the functions write.
+import zipfile  # To read the archives that the functions write.
 
 from .mock.bpy import MockOperator, MockExportHelper, MockImportHelper, MockPrincipledBSDFWrapper
 
@@ -31,10 +36,58 @@ bpy_extras.io_utils.ImportHelper = MockImportHelper
 bpy_extras.io_utils.ExportHelper = MockExportHelper
 bpy_extras.node_shader_utils.PrincipledBSDFWrapper = MockPrincipledBSDFWrapper
 import io_mesh_3mf.export_3mf  # Now we may safely import the unit under test.
+import io_mesh_3mf.import_3mf  # To import documents, to export them again.
+import io_mesh_3mf.xml_writer  # To write documents for the functions to write elements in.
 from io_mesh_3mf.constants import *
 from io_mesh_3mf.metadata import MetadataEntry
 
 
+class MockObject(dict):
+    """
+    A Blender object, as created by the importer. Its custom properties are stored in the dictionary.
+    """
+
+    def __init__(self, name, data, all_objects):
+        super().__init__()
+        self.name = name
+        self.data = data
+        self.type = 'EMPTY' if data is None else 'MESH'
+        self.mode = 'OBJECT'
+        self.parent = None
+        self.matrix_world = mathutils.Matrix.Identity(4)
+        self.instance_type = 'NONE'
+        self.instance_collection = None
+        self.material_slots = []
+        self.all_objects = all_objects
+        all_objects.append(self)
+
+    def __hash__(self):
+        return id(self)
+
+    def __eq__(self, other):
+        return self is other
+
+    @property
+    def children(self):
+        return [blender_object for blender_object in self.all_objects if blender_object.parent is self]
+
+    def to_mesh(self):
+        return self.data
+
+
+class MockCollection:
+    """
+    A Blender collection, which just keeps a list of the objects linked to it.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.all_objects = []
+        self.objects = unittest.mock.MagicMock()
+        self.objects.link.side_effect = self.all_objects.append
+        self.instance_offset = mathutils.Vector((0.0, 0.0, 0.0))
+
+
 class TestExport3MF(unittest.TestCase):
     """
     Unit tests for exporting 3MF files.
@@ -46,6 +99,7 @@ class TestExport3MF(unittest.TestCase):
         """
         self.exporter = io_mesh_3mf.export_3mf.Export3MF()  # An exporter class.
         self.exporter.use_mesh_modifiers = False
+        self.exporter.use_selection = False
         self.exporter.coordinate_precision = 4
 
         # Initialize instance variables that would normally be set in execute()
@@ -53,9 +107,72 @@ class TestExport3MF(unittest.TestCase):
         self.exporter.num_written = 0
         self.exporter.material_resource_id = -1
         self.exporter.material_name_to_index = {}
+        self.exporter.mesh_resources = {}
+        self.exporter.collection_resources = {}
+
+    def write_document(self, function, *args, **kwargs):
+        """
+        Calls a function that writes part of a 3MF document, and parses what it wrote.
+
+        The function is called while the writer is in the <model> element. The writer is stored in `self.writer`, to
+        verify that it gets passed on to other functions.
+        :param function: The function to call. Its first parameter must be the writer to write the document with.
+        :param args: Further positional arguments to call the function with.
+        :param kwargs: Further keyword arguments to call the function with.
+        :return: A tuple of the root element of the document that was written, and the result of the function.
+        """
+        stream = io.BytesIO()
+        namespaces = {"": MODEL_NAMESPACE, "t": TRIANGLESETS_NAMESPACE}
+        with io_mesh_3mf.xml_writer.XMLWriter(stream, namespaces) as self.writer:
+            self.writer.start(f"{{{MODEL_NAMESPACE}}}model")
+            result = function(self.writer, *args, **kwargs)
+            self.writer.end(f"{{{MODEL_NAMESPACE}}}model")
+        return xml.etree.ElementTree.fromstring(stream.getvalue()), result
+
+    def write_objects(self, writer, blender_objects, global_scale):
+        """
+        Writes the resources and the build of a group of objects, like when exporting them.
+        :param writer: The writer to write the document with.
+        :param blender_objects: The Blender objects to write.
+        :param global_scale: A scaling factor to apply to all objects.
+        """
+        writer.start(f"{{{MODEL_NAMESPACE}}}resources")
+        build_items = self.exporter.write_objects(writer, blender_objects, global_scale)
+        writer.end(f"{{{MODEL_NAMESPACE}}}resources")
+        self.exporter.write_build(writer, build_items)
+
+    def mock_vertices(self, coordinates):
+        """
+        Creates a mock for the collection of vertices of a Blender mesh.
+        :param coordinates: A list of the coordinates of each vertex.
+        :return: A mock that gives the coordinates with `foreach_get`, like Blender's vertex collection.
+        """
+        vertices = unittest.mock.MagicMock()
+        vertices.__len__.return_value = len(coordinates)
+
+        def foreach_get(attribute, buffer):
+            self.assertEqual(attribute, "co")
+            buffer[:] = numpy.array(coordinates, dtype=buffer.dtype).flatten()
+
+        vertices.foreach_get.side_effect = foreach_get
+        return vertices
+
+    def mock_triangles(self, vertices, material_indices):
+        """
+        Creates a mock for the collection of loop triangles of a Blender mesh.
+        :param vertices: A list of the three vertex indices of each triangle.
+        :param material_indices: A list of the material slot index of each triangle.
+        :return: A mock that gives the vertices and material indices with `foreach_get`, like Blender's loop triangles.
+        """
+        triangles = unittest.mock.MagicMock()
+        triangles.__len__.return_value = len(vertices)
+        attributes = {"vertices": vertices, "material_index": material_indices}
 
-        self.mock_triangle_loop = unittest.mock.MagicMock()
-        self.mock_triangle_loop.material_index = 0
+        def foreach_get(attribute, buffer):
+            buffer[:] = numpy.array(attributes[attribute], dtype=buffer.dtype).flatten()
+
+        triangles.foreach_get.side_effect = foreach_get
+        return triangles
 
     def test_create_archive(self):
         """
@@ -97,6 +214,165 @@ class TestExport3MF(unittest.TestCase):
                 if file_path is not None:
                     os.remove(file_path)
 
+    def test_must_preserve_missing(self):
+        """
+        Tests warning the user about files that must be preserved, but whose contents are no longer available.
+        """
+        self.exporter.report = unittest.mock.MagicMock()
+        archive = unittest.mock.MagicMock()
+        with unittest.mock.patch("io_mesh_3mf.export_3mf.PreservedFiles") as preserved_files:
+            preserved_files.return_value.write.return_value = []
+            self.exporter.must_preserve(archive)
+            self.exporter.report.assert_not_called()
+
+            preserved_files.return_value.write.return_value = ["Metadata/plate_1.gcode"]
+            self.exporter.must_preserve(archive)
+            self.exporter.report.assert_called_once()
+            self.assertEqual(self.exporter.report.call_args[0][0], {'WARNING'})
+            self.assertIn("Metadata/plate_1.gcode", self.exporter.report.call_args[0][1], "The missing file is named.")
+
+    def test_must_preserve_unavailable(self):
+        """
+        Tests exporting when the storage of the files that must be preserved can't be accessed.
+        """
+        self.exporter.report = unittest.mock.MagicMock()
+        archive = unittest.mock.MagicMock()
+        with unittest.mock.patch("io_mesh_3mf.export_3mf.PreservedFiles") as preserved_files:
+            preserved_files.side_effect = ValueError("The package is not an extension.")
+            self.exporter.must_preserve(archive)  # Must not raise, or the whole export fails.
+        self.exporter.report.assert_called_once()
+        self.assertEqual(self.exporter.report.call_args[0][0], {'WARNING'})
+
+    def test_open_model(self):
+        """
+        Tests writing the 3D model to the archive with each of the compression presets.
+        """
+        document = b"<model>" + b"<vertex x=\"1\" y=\"2\" z=\"3\" />" * 10000 + b"</model>"
+        for compression in io_mesh_3mf.export_3mf.COMPRESSION_LEVELS:
+            with self.subTest(compression=compression):
+                self.exporter.compression = compression
+                stream = io.BytesIO()
+                with zipfile.ZipFile(stream, "w") as archive:
+                    with self.exporter.open_model(archive) as f:
+                        f.write(document)
+
+                with zipfile.ZipFile(stream) as archive:
+                    self.assertIsNone(archive.testzip(), "The archive is intact.")
+                    self.assertEqual(archive.read(MODEL_LOCATION), document)
+                    info = archive.getinfo(MODEL_LOCATION)
+                    if compression == 'STORED':
+                        self.assertEqual(info.compress_type, zipfile.ZIP_STORED)
+                    else:
+                        self.assertEqual(info.compress_type, zipfile.ZIP_DEFLATED)
+                        self.assertLess(info.compress_size, len(document) // 10, "Such repetition compresses well.")
+
+    def test_finish_cancelled(self):
+        """
+        Tests cancelling an export while the 3D model is being written in the background.
+        """
+        file_handle, file_path = tempfile.mkstemp()
+        os.close(file_handle)
+        try:
+            self.exporter.compression = 'FAST'
+            self.exporter.executor = concurrent.futures.ThreadPoolExecutor()
+            archive = zipfile.ZipFile(file_path, "w")
+            model_stream = self.exporter.open_model(archive)
+            self.exporter.writer = io_mesh_3mf.xml_writer.XMLWriter(
+                model_stream, {"": MODEL_NAMESPACE}, self.exporter.executor, buffered=True)
+            self.exporter.writer.start(f"{{{MODEL_NAMESPACE}}}model")
+            self.exporter.writer.defer(str, "<vertices />")
+            self.exporter.writer.end(f"{{{MODEL_NAMESPACE}}}model")
+
+            self.exporter.writer.cancel()
+            status = self.exporter.finish(archive, model_stream, file_path)
+
+            self.assertEqual(status, {'CANCELLED'})
+            self.assertFalse(os.path.exists(file_path), "The incomplete archive is removed.")
+        finally:
+            if os.path.exists(file_path):
+                os.remove(file_path)
+
+    def test_execute_error(self):
+        """
+        Tests that an error while writing the 3D model closes everything and removes the incomplete archive.
+        """
+        for use_background in (False, True):
+            with self.subTest(use_background=use_background):
+                file_handle, file_path = tempfile.mkstemp()
+                os.close(file_handle)
+                try:
+                    self.exporter.filepath = file_path
+                    self.exporter.compression = 'FAST'
+                    self.exporter.use_instances = False
+                    self.exporter.use_background = use_background
+                    self.exporter.unit_scale = unittest.mock.MagicMock(return_value=1.0)
+                    self.exporter.write_objects = unittest.mock.MagicMock(side_effect=RuntimeError("Simulated error!"))
+                    threads_before = set(threading.enumerate())
+
+                    with self.assertRaises(RuntimeError):
+                        self.exporter.execute(unittest.mock.MagicMock())
+
+                    self.assertFalse(os.path.exists(file_path), "The incomplete archive is removed.")
+                    self.assertSetEqual(
+                        set(threading.enumerate()) - threads_before,
+                        set(),
+                        "The threads that format and compress the 3D model are stopped.")
+                finally:
+                    if os.path.exists(file_path):
+                        os.remove(file_path)
+
+    def test_finish_error(self):
+        """
+        Tests that an error while completing the 3D model in the background removes the incomplete archive.
+        """
+        file_handle, file_path = tempfile.mkstemp()
+        os.close(file_handle)
+        try:
+            self.exporter.compression = 'FAST'
+            threads_before = set(threading.enumerate())
+            self.exporter.executor = concurrent.futures.ThreadPoolExecutor()
+            archive = zipfile.ZipFile(file_path, "w")
+            model_stream = self.exporter.open_model(archive)
+            self.exporter.writer = io_mesh_3mf.xml_writer.XMLWriter(
+                model_stream, {"": MODEL_NAMESPACE}, self.exporter.executor, buffered=True)
+            self.exporter.writer.start(f"{{{MODEL_NAMESPACE}}}model")
+            self.exporter.writer.defer(int, "Not a number, so formatting this fails.")
+            self.exporter.writer.end(f"{{{MODEL_NAMESPACE}}}model")
+
+            with self.assertRaises(ValueError):
+                self.exporter.finish(archive, model_stream, file_path)
+
+            self.assertFalse(os.path.exists(file_path), "The incomplete archive is removed.")
+            self.assertIsNone(archive.fp, "The archive is closed.")
+            self.assertSetEqual(set(threading.enumerate()) - threads_before, set(), "No threads are left running.")
+        finally:
+            if os.path.exists(file_path):
+                os.remove(file_path)
+
+    def test_modal(self):
+        """
+        Tests following the progress of an export in the background.
+        """
+        self.exporter.report = unittest.mock.MagicMock()
+        self.exporter.writer = unittest.mock.MagicMock()
+        self.exporter.writer.progress.return_value = 0.5
+        self.exporter.thread = unittest.mock.MagicMock()
+        self.exporter.thread.is_alive.return_value = True
+        self.exporter.timer = unittest.mock.MagicMock()
+        context = unittest.mock.MagicMock()
+
+        self.assertEqual(self.exporter.modal(context, unittest.mock.MagicMock(type='TIMER')), {'PASS_THROUGH'})
+        context.window_manager.progress_update.assert_called_once_with(50)
+
+        self.assertEqual(self.exporter.modal(context, unittest.mock.MagicMock(type='ESC')), {'RUNNING_MODAL'})
+        self.exporter.writer.cancel.assert_called_once_with()
+
+        self.exporter.thread.is_alive.return_value = False  # The thread stopped after cancelling.
+        self.exporter.status = {'CANCELLED'}
+        self.assertEqual(self.exporter.modal(context, unittest.mock.MagicMock(type='TIMER')), {'CANCELLED'})
+        context.window_manager.progress_end.assert_called_once_with()
+        context.window_manager.event_timer_remove.assert_called_once_with(self.exporter.timer)
+
     def test_unit_scale_global(self):
         """
         Tests whether the global scaling factor is taken into account with the scale.
@@ -169,12 +445,10 @@ class TestExport3MF(unittest.TestCase):
 
         Try to not crash, please.
         """
-        resources_element = xml.etree.ElementTree.Element(f"{{{MODEL_NAMESPACE}}}resources")
-
-        result = self.exporter.write_materials(resources_element, [])
+        root, result = self.write_document(self.exporter.write_materials, [])
 
         self.assertListEqual(
-            list(resources_element.iterfind("3mf:basematerials", MODEL_NAMESPACES)),
+            list(root.iterfind("3mf:basematerials", MODEL_NAMESPACES)),
             [],
             "There were no objects to write, so there are no materials, and it should not write a material group.")
         self.assertDictEqual(result, {}, "There are no materials, so nothing gets an index assigned.")
@@ -183,37 +457,68 @@ class TestExport3MF(unittest.TestCase):
         """
         Tests writing the materials for objects that have no materials.
         """
-        resources_element = xml.etree.ElementTree.Element(f"{{{MODEL_NAMESPACE}}}resources")
         object1 = unittest.mock.MagicMock()
         object1.material_slots = []
         object2 = unittest.mock.MagicMock()
         object2.material_slots = []
 
-        result = self.exporter.write_materials(resources_element, [object1, object2])
+        root, result = self.write_document(self.exporter.write_materials, [object1, object2])
 
         self.assertListEqual(
-            list(resources_element.iterfind("3mf:basematerials", MODEL_NAMESPACES)),
+            list(root.iterfind("3mf:basematerials", MODEL_NAMESPACES)),
             [],
             "None of the objects have materials, so we should not even create an (empty) basematerials tag.")
         self.assertDictEqual(result, {}, "There are no materials, so nothing gets an index assigned.")
 
+    def test_write_materials_empty_slot(self):
+        """
+        Tests exporting an object with an empty material slot, from writing the materials to writing the object.
+        """
+        material = unittest.mock.MagicMock()
+        material.name = "PLA"
+        material.diffuse_color = (1.0, 0.0, 0.0, 1.0)
+        blender_object = self.mock_mesh_object("Nibbler", [(0, 0, 0), (1, 0, 0), (0, 1, 0)])
+        blender_object.type = 'MESH'
+        blender_object.parent = None
+        blender_object.material_slots = [
+            unittest.mock.MagicMock(material=None),
+            unittest.mock.MagicMock(material=material)
+        ]
+        blender_object.to_mesh().loop_triangles = self.mock_triangles([(0, 1, 2), (0, 2, 1)], [0, 1])
+
+        def write_model(writer):
+            writer.start(f"{{{MODEL_NAMESPACE}}}resources")
+            self.exporter.material_name_to_index = self.exporter.write_materials(writer, [blender_object])
+            build_items = self.exporter.write_objects(writer, [blender_object], 1.0)
+            writer.end(f"{{{MODEL_NAMESPACE}}}resources")
+            self.exporter.write_build(writer, build_items)
+
+        root, _ = self.write_document(write_model)
+
+        base_elements = root.findall("3mf:resources/3mf:basematerials/3mf:base", MODEL_NAMESPACES)
+        self.assertEqual([element.attrib["name"] for element in base_elements], ["PLA"], "The empty slot is skipped.")
+        object_element = root.find("3mf:resources/3mf:object", MODEL_NAMESPACES)
+        self.assertEqual(object_element.attrib["pindex"], "0", "The only real material is the material of the object.")
+        triangles = root.findall("3mf:resources/3mf:object/3mf:mesh/3mf:triangles/3mf:triangle", MODEL_NAMESPACES)
+        self.assertEqual(len(triangles), 2, "The triangle in the empty slot is written too.")
+        self.assertEqual(len(root.findall("3mf:build/3mf:item", MODEL_NAMESPACES)), 1)
+
     def test_write_material_name(self):
         """
         Tests writing the name of a material.
         """
-        resources_element = xml.etree.ElementTree.Element(f"{{{MODEL_NAMESPACE}}}resources")
         material_slot = unittest.mock.MagicMock()
         material_slot.material.name = "Navel lint"
         material_slot.material.diffuse_color = (0.8, 0.8, 0.8, 0.8)
         blender_object = unittest.mock.MagicMock()
         blender_object.material_slots = [material_slot]
 
-        result = self.exporter.write_materials(resources_element, [blender_object])
+        root, result = self.write_document(self.exporter.write_materials, [blender_object])
 
-        base_elements = list(resources_element.iterfind("3mf:basematerials/3mf:base", MODEL_NAMESPACES))
+        base_elements = list(root.iterfind("3mf:basematerials/3mf:base", MODEL_NAMESPACES))
         self.assertEqual(len(base_elements), 1, "There must be a <base> tag, since there is a material on this object.")
         base_element = base_elements[0]
-        self.assertEqual(base_element.attrib[f"{{{MODEL_NAMESPACE}}}name"], "Navel lint")
+        self.assertEqual(base_element.attrib["name"], "Navel lint")
         self.assertDictEqual(result, {"Navel lint": 0})
 
     def test_write_material_color(self):
@@ -237,28 +542,26 @@ class TestExport3MF(unittest.TestCase):
 
         for input, output in ground_truth.items():
             with self.subTest(input=input, output=output):
-                resources_element = xml.etree.ElementTree.Element(f"{{{MODEL_NAMESPACE}}}resources")
                 material_slot = unittest.mock.MagicMock()
                 material_slot.material.name = "Programmable wood"
                 material_slot.material.diffuse_color = input
                 blender_object = unittest.mock.MagicMock()
                 blender_object.material_slots = [material_slot]
 
-                self.exporter.write_materials(resources_element, [blender_object])
+                root, _ = self.write_document(self.exporter.write_materials, [blender_object])
 
-                base_elements = list(resources_element.iterfind("3mf:basematerials/3mf:base", MODEL_NAMESPACES))
+                base_elements = list(root.iterfind("3mf:basematerials/3mf:base", MODEL_NAMESPACES))
                 self.assertEqual(
                     len(base_elements),
                     1,
                     "There must be a <base> tag, since there is a material on this object.")
                 base_element = base_elements[0]
-                self.assertEqual(base_element.attrib[f"{{{MODEL_NAMESPACE}}}displaycolor"], output)
+                self.assertEqual(base_element.attrib["displaycolor"], output)
 
     def test_write_material_duplicate(self):
         """
         Test writing multiple objects that share the same material.
         """
-        resources_element = xml.etree.ElementTree.Element(f"{{{MODEL_NAMESPACE}}}resources")
         material_slot = unittest.mock.MagicMock()
         material_slot.material.name = "Putty"
         material_slot.material.diffuse_color = (0.2, 0.4, 0.6, 1.0)
@@ -267,9 +570,9 @@ class TestExport3MF(unittest.TestCase):
         object2 = unittest.mock.MagicMock()
         object2.material_slots = [material_slot]  # Same material as object 1.
 
-        result = self.exporter.write_materials(resources_element, [object1, object2])
+        root, result = self.write_document(self.exporter.write_materials, [object1, object2])
 
-        base_elements = list(resources_element.iterfind("3mf:basematerials/3mf:base", MODEL_NAMESPACES))
+        base_elements = list(root.iterfind("3mf:basematerials/3mf:base", MODEL_NAMESPACES))
         self.assertEqual(
             len(base_elements),
             1,
@@ -280,7 +583,6 @@ class TestExport3MF(unittest.TestCase):
         """
         Test writing an object with multiple materials and multiple objects with different materials.
         """
-        resources_element = xml.etree.ElementTree.Element(f"{{{MODEL_NAMESPACE}}}resources")
         material1_slot = unittest.mock.MagicMock()
         material1_slot.material.name = "Aerogel"
         material1_slot.material.diffuse_color = (0.1, 0.2, 0.3, 0.4)
@@ -292,9 +594,9 @@ class TestExport3MF(unittest.TestCase):
         object2 = unittest.mock.MagicMock()
         object2.material_slots = [material2_slot]  # Same material as what's included in object 1.
 
-        result = self.exporter.write_materials(resources_element, [object1, object2])
+        root, result = self.write_document(self.exporter.write_materials, [object1, object2])
 
-        base_elements = list(resources_element.iterfind("3mf:basematerials/3mf:base", MODEL_NAMESPACES))
+        base_elements = list(root.iterfind("3mf:basematerials/3mf:base", MODEL_NAMESPACES))
         self.assertEqual(
             len(base_elements),
             2,
@@ -307,7 +609,7 @@ class TestExport3MF(unittest.TestCase):
         # Make sure that the indices are correct.
         for material_name, material_index in result.items():
             self.assertEqual(
-                base_elements[material_index].attrib[f"{{{MODEL_NAMESPACE}}}name"],
+                base_elements[material_index].attrib["name"],
                 material_name,
                 f"At index {material_index} in the order of the tags we should store material {material_name}, "
                 f"according to our mapping.")
@@ -316,10 +618,8 @@ class TestExport3MF(unittest.TestCase):
         """
         Tests writing objects when there are no objects in the scene.
         """
-        root = xml.etree.ElementTree.Element(f"{{{MODEL_NAMESPACE}}}model")
-        resources_element = xml.etree.ElementTree.SubElement(root, f"{{{MODEL_NAMESPACE}}}resources")
         self.exporter.write_object_resource = unittest.mock.MagicMock()  # Record how this gets called.
-        self.exporter.write_objects(root, resources_element, [], global_scale=1.0)  # Empty list of Blender objects.
+        root, _ = self.write_document(self.write_objects, [], global_scale=1.0)  # Empty list of Blender objects.
 
         self.assertListEqual(
             list(root.iterfind("3mf:resources/3mf:object", MODEL_NAMESPACES)),
@@ -336,8 +636,6 @@ class TestExport3MF(unittest.TestCase):
         """
         Tests writing a single object into the XML document.
         """
-        root = xml.etree.ElementTree.Element(f"{{{MODEL_NAMESPACE}}}model")
-        resources_element = xml.etree.ElementTree.SubElement(root, f"{{{MODEL_NAMESPACE}}}resources")
         # Record how this gets called.
         self.exporter.write_object_resource = unittest.mock.MagicMock(return_value=(1, mathutils.Matrix.Identity(4)))
 
@@ -345,22 +643,23 @@ class TestExport3MF(unittest.TestCase):
         the_object = unittest.mock.MagicMock()
         the_object.parent = None
         the_object.type = 'MESH'
+        the_object.name = "Calculon"
 
-        self.exporter.write_objects(root, resources_element, [the_object], global_scale=1.0)
+        root, _ = self.write_document(self.write_objects, [the_object], global_scale=1.0)
 
         # Test that we've written the resource object.
-        self.exporter.write_object_resource.assert_called_once_with(resources_element, the_object)
+        self.exporter.write_object_resource.assert_called_once_with(self.writer, the_object)
 
         # Test that we've created an item.
         item_elements = list(root.iterfind("3mf:build/3mf:item", MODEL_NAMESPACES))
         self.assertEqual(len(item_elements), 1, "There was one build item, building the only Blender object.")
         item_element = item_elements[0]
         self.assertEqual(
-            item_element.attrib[f"{{{MODEL_NAMESPACE}}}objectid"],
+            item_element.attrib["objectid"],
             "1",
             "The object ID must be equal to what the write_object_resource function returned.")
         self.assertNotIn(
-            f"{{{MODEL_NAMESPACE}}}transform",
+            "transform",
             item_element.attrib,
             "There should not be a transformation since the transformation returned by write_object_resource was "
             "Identity.")
@@ -369,8 +668,6 @@ class TestExport3MF(unittest.TestCase):
         """
         Tests writing one object contained inside another.
         """
-        root = xml.etree.ElementTree.Element(f"{{{MODEL_NAMESPACE}}}model")
-        resources_element = xml.etree.ElementTree.SubElement(root, f"{{{MODEL_NAMESPACE}}}resources")
         # Record how this gets called.
         self.exporter.write_object_resource = unittest.mock.MagicMock(return_value=(1, mathutils.Matrix.Identity(4)))
 
@@ -378,15 +675,17 @@ class TestExport3MF(unittest.TestCase):
         parent_obj = unittest.mock.MagicMock()
         parent_obj.parent = None
         parent_obj.type = 'MESH'
+        parent_obj.name = "Hedonismbot"
         child_obj = unittest.mock.MagicMock()
         child_obj.parent = parent_obj
         child_obj.type = 'MESH'
+        child_obj.name = "Roberto"
 
-        self.exporter.write_objects(root, resources_element, [parent_obj, child_obj], global_scale=1.0)
+        root, _ = self.write_document(self.write_objects, [parent_obj, child_obj], global_scale=1.0)
 
         # We may only have written one resource object, for the parent.
         # We may only save the parent in the file. This takes care of children recursively.
-        self.exporter.write_object_resource.assert_called_once_with(resources_element, parent_obj)
+        self.exporter.write_object_resource.assert_called_once_with(self.writer, parent_obj)
 
         # We may only make one build item, for the parent.
         item_elements = list(root.iterfind("3mf:build/3mf:item", MODEL_NAMESPACES))
@@ -396,8 +695,6 @@ class TestExport3MF(unittest.TestCase):
         """
         Tests that Blender objects with different types get ignored.
         """
-        root = xml.etree.ElementTree.Element(f"{{{MODEL_NAMESPACE}}}model")
-        resources_element = xml.etree.ElementTree.SubElement(root, f"{{{MODEL_NAMESPACE}}}resources")
         # Record whether this gets called.
         self.exporter.write_object_resource = unittest.mock.MagicMock(return_value=(1, mathutils.Matrix.Identity(4)))
 
@@ -406,7 +703,7 @@ class TestExport3MF(unittest.TestCase):
         the_object.parent = None
         the_object.type = 'LIGHT'  # Lights don't get saved.
 
-        self.exporter.write_objects(root, resources_element, [the_object], global_scale=1.0)
+        root, _ = self.write_document(self.write_objects, [the_object], global_scale=1.0)
 
         self.exporter.write_object_resource.assert_not_called()  # We may not call this for the "LIGHT" object.
         item_elements = list(root.iterfind("3mf:build/3mf:item", MODEL_NAMESPACES))
@@ -420,8 +717,6 @@ class TestExport3MF(unittest.TestCase):
         """
         Tests writing two objects.
         """
-        root = xml.etree.ElementTree.Element(f"{{{MODEL_NAMESPACE}}}model")
-        resources_element = xml.etree.ElementTree.SubElement(root, f"{{{MODEL_NAMESPACE}}}resources")
         self.exporter.write_object_resource = unittest.mock.MagicMock(side_effect=[
             (1, mathutils.Matrix.Identity(4)),
             (2, mathutils.Matrix.Identity(4))
@@ -431,16 +726,18 @@ class TestExport3MF(unittest.TestCase):
         object1 = unittest.mock.MagicMock()
         object1.parent = None
         object1.type = 'MESH'
+        object1.name = "Flexo"
         object2 = unittest.mock.MagicMock()
         object2.parent = None
         object2.type = 'MESH'
+        object2.name = "URL"
 
-        self.exporter.write_objects(root, resources_element, [object1, object2], global_scale=1.0)
+        root, _ = self.write_document(self.write_objects, [object1, object2], global_scale=1.0)
 
         # We must have written the resource objects of both.
         # Both object must have had their object resources written.
-        self.exporter.write_object_resource.assert_any_call(resources_element, object1)
-        self.exporter.write_object_resource.assert_any_call(resources_element, object2)  # The order doesn't matter.
+        self.exporter.write_object_resource.assert_any_call(self.writer, object1)
+        self.exporter.write_object_resource.assert_any_call(self.writer, object2)  # The order doesn't matter.
 
         # We must have written build items for both.
         item_elements = list(root.iterfind("3mf:build/3mf:item", MODEL_NAMESPACES))
@@ -452,8 +749,6 @@ class TestExport3MF(unittest.TestCase):
 
         This tests both the global scale as well as a scale applied to the object itself.
         """
-        root = xml.etree.ElementTree.Element(f"{{{MODEL_NAMESPACE}}}model")
-        resources_element = xml.etree.ElementTree.SubElement(root, f"{{{MODEL_NAMESPACE}}}resources")
         self.exporter.format_transformation = lambda x: str(x)  # The transformation formatter is not being tested here.
 
         # The object itself is moved.
@@ -465,8 +760,9 @@ class TestExport3MF(unittest.TestCase):
         the_object = unittest.mock.MagicMock()
         the_object.parent = None
         the_object.type = 'MESH'
+        the_object.name = "Clamps"
 
-        self.exporter.write_objects(root, resources_element, [the_object], global_scale=global_scale)
+        root, _ = self.write_document(self.write_objects, [the_object], global_scale=global_scale)
 
         # The build item must have the correct transformation then.
         expected_transformation = mathutils.Matrix.Scale(global_scale, 4) @ object_transformation
@@ -474,7 +770,7 @@ class TestExport3MF(unittest.TestCase):
         self.assertEqual(len(item_elements), 1, "There was only one object to build.")
         item_element = item_elements[0]
         self.assertEqual(
-            item_element.attrib[f"{{{MODEL_NAMESPACE}}}transform"],
+            item_element.attrib["transform"],
             str(expected_transformation),
             "The transformation must be equal to the expected transformation.")
 
@@ -482,8 +778,6 @@ class TestExport3MF(unittest.TestCase):
         """
         Tests writing build items with metadata.
         """
-        root = xml.etree.ElementTree.Element(f"{{{MODEL_NAMESPACE}}}model")
-        resources_element = xml.etree.ElementTree.SubElement(root, f"{{{MODEL_NAMESPACE}}}resources")
         # Not interested in testing this code here.
         self.exporter.write_object_resource = unittest.mock.MagicMock(return_value=(1, mathutils.Matrix.Identity(4)))
 
@@ -498,7 +792,7 @@ class TestExport3MF(unittest.TestCase):
             datatype="mostly fur",
             value="A CIA project to spy on the Soviet embassies.")
 
-        self.exporter.write_objects(root, resources_element, [the_object], global_scale=1.0)
+        root, _ = self.write_document(self.write_objects, [the_object], global_scale=1.0)
 
         # Test that we've created an item with the correct metadata.
         metadatagroup_elements = list(root.iterfind("3mf:build/3mf:item/3mf:metadatagroup", MODEL_NAMESPACES))
@@ -506,18 +800,18 @@ class TestExport3MF(unittest.TestCase):
         metadatagroup_element = metadatagroup_elements[0]
         metadata_elements = metadatagroup_element.findall("3mf:metadata", namespaces=MODEL_NAMESPACES)
         for metadata_element in metadata_elements:
-            if metadata_element.attrib[f"{{{MODEL_NAMESPACE}}}name"] == "Title":
+            if metadata_element.attrib["name"] == "Title":
                 self.assertEqual(
                     metadata_element.text,
                     "Acoustic Kitty",
                     "The name of the object was 'Acoustic Kitty', "
                     "which should get stored as the 'Title' metadata entry.")
                 self.assertEqual(
-                    metadata_element.attrib[f"{{{MODEL_NAMESPACE}}}type"],
+                    metadata_element.attrib["type"],
                     "xs:string",
                     "The object name is always a string.")
                 self.assertEqual(
-                    metadata_element.attrib[f"{{{MODEL_NAMESPACE}}}preserve"],
+                    metadata_element.attrib["preserve"],
                     "1",
                     "The object name must always be preserved (the way that we write these files).")
             elif metadata_element.attrib["name"] == "Description":
@@ -526,11 +820,11 @@ class TestExport3MF(unittest.TestCase):
                     "A CIA project to spy on the Soviet embassies.",
                     "This is the 'Description' metadata value.")
                 self.assertEqual(
-                    metadata_element.attrib[f"{{{MODEL_NAMESPACE}}}type"],
+                    metadata_element.attrib["type"],
                     "mostly fur",
                     "The data type was set to 'mostly fur'.")
                 self.assertNotIn(
-                    f"{{{MODEL_NAMESPACE}}}preserve",
+                    "preserve",
                     metadata_element.attrib,
                     "Since this metadata isn't preserved, "
                     "don't write a 'preserve' attribute but let it be the default, which is to not preserve.")
@@ -538,6 +832,168 @@ class TestExport3MF(unittest.TestCase):
                 self.assertFalse("We only had 'Title' and 'Description' metadata, not {name}".format(
                     name=metadata_element.attrib["name"]))
 
+    def mock_instance(self, blender_object, matrix_world, parent=None):
+        """
+        Creates a mock for an object instance in Blender's dependency graph.
+        :param blender_object: The evaluated object that is instanced.
+        :param matrix_world: The transformation of the instance.
+        :param parent: The object that creates this instance, or `None` if this is not an instance of another object.
+        :return: A mock of the object instance.
+        """
+        instance = unittest.mock.MagicMock()
+        instance.object = blender_object
+        instance.matrix_world = matrix_world
+        instance.is_instance = parent is not None
+        instance.parent = parent
+        instance.show_self = True
+        return instance
+
+    def test_write_objects_collection_instance(self):
+        """
+        Tests exporting a sub-assembly that was imported once and instanced in multiple places.
+
+        The instances must be written with the geometry of the collection they instance.
+        """
+        model_file = io.BytesIO(f"""<?xml version="1.0" encoding="UTF-8"?>
+            <model xmlns="{MODEL_NAMESPACE}" unit="millimeter">
+                <resources>
+                    <object id="1">
+                        <mesh>
+                            <vertices>
+                                <vertex x="0" y="0" z="0" /><vertex x="1" y="0" z="0" /><vertex x="0" y="1" z="0" />
+                            </vertices>
+                            <triangles><triangle v1="0" v2="1" v3="2" /></triangles>
+                        </mesh>
+                    </object>
+                    <object id="2">
+                        <components>
+                            <component objectid="1" /><component objectid="1" transform="1 0 0 0 1 0 0 0 1 5 0 0" />
+                        </components>
+                    </object>
+                    <object id="3">
+                        <components>
+                            <component objectid="2" /><component objectid="2" transform="1 0 0 0 1 0 0 0 1 0 5 0" />
+                        </components>
+                    </object>
+                </resources>
+                <build><item objectid="3" /></build>
+            </model>""".encode("UTF-8"))
+
+        # Import the document into a mock of Blender's data, holding the geometry of each mesh for the exporter.
+        importer = io_mesh_3mf.import_3mf.Import3MF()
+        importer.resource_objects = {}
+        importer.resource_materials = {}
+        importer.resource_to_mesh = {}
+        importer.resource_to_collection = {}
+        importer.resource_to_material = {}
+        importer.num_loaded = 0
+        importer.object_names = {}
+        importer.mesh_names = {}
+        importer.collection_names = {}
+        importer.collection = MockCollection("File")
+        importer.built_objects = []
+        all_objects = []
+
+        def build_mesh(vertices, triangles, name):
+            mesh = unittest.mock.MagicMock()
+            mesh.vertices = self.mock_vertices(numpy.asarray(vertices).tolist())
+            mesh.loop_triangles = self.mock_triangles(numpy.asarray(triangles).tolist(), [0] * len(triangles))
+            return mesh
+        importer.build_mesh = build_mesh
+        with unittest.mock.patch("bpy.data.objects.new", lambda name, data: MockObject(name, data, all_objects)), \
+                unittest.mock.patch("bpy.data.collections.new", MockCollection):
+            root = importer.read_model(model_file)
+            importer.build_items(root, 1.0)
+        self.assertTrue(
+            any(blender_object.instance_type == 'COLLECTION' for blender_object in all_objects),
+            "The sub-assembly that is used twice was imported as a collection that is instanced.")
+
+        # Export the objects in the scene, which are the objects in the collection of the file, with default settings.
+        scene_objects = importer.collection.all_objects
+        root, _ = self.write_document(self.write_objects, scene_objects, global_scale=1.0)
+
+        def count_triangles(objectid):
+            object_element = root.find(f"3mf:resources/3mf:object[@id='{objectid}']", MODEL_NAMESPACES)
+            self.assertIsNotNone(object_element, "Components refer to objects that were written.")
+            triangles = len(object_element.findall("3mf:mesh/3mf:triangles/3mf:triangle", MODEL_NAMESPACES))
+            for component in object_element.iterfind("3mf:components/3mf:component", MODEL_NAMESPACES):
+                triangles += count_triangles(component.attrib["objectid"])
+            return triangles
+        items = root.findall("3mf:build/3mf:item", MODEL_NAMESPACES)
+        self.assertEqual(len(items), 1, "There is one object in the scene without parent.")
+        self.assertEqual(
+            count_triangles(items[0].attrib["objectid"]),
+            4,
+            "Both instances of the sub-assembly contain both of its triangles.")
+        self.assertEqual(
+            len(root.findall("3mf:resources/3mf:object/3mf:mesh", MODEL_NAMESPACES)),
+            2,
+            "The objects in the sub-assembly are written once, not once for every instance of the sub-assembly.")
+        for object_element in root.iterfind("3mf:resources/3mf:object", MODEL_NAMESPACES):
+            contents = object_element.findall("3mf:mesh", MODEL_NAMESPACES)
+            contents += object_element.findall("3mf:components", MODEL_NAMESPACES)
+            self.assertTrue(contents, "Each object must have a mesh or components.")
+
+    def test_write_instances(self):
+        """
+        Tests writing the instances of a mesh, created by another object.
+        """
+        bracket = self.mock_mesh_object("Bracket", [(0, 0, 0), (1, 0, 0), (0, 1, 0)])
+        bracket.type = 'MESH'
+        scatter = self.mock_mesh_object("Scatter", [(0, 0, 0), (5, 0, 0), (0, 5, 0)])
+        scatter.type = 'MESH'
+        collection_instance = unittest.mock.MagicMock()
+        collection_instance.type = 'EMPTY'
+        dependency_graph = unittest.mock.MagicMock()
+        dependency_graph.object_instances = [
+            self.mock_instance(scatter, mathutils.Matrix.Identity(4)),
+            self.mock_instance(collection_instance, mathutils.Matrix.Identity(4)),
+            self.mock_instance(bracket, mathutils.Matrix.Translation((1, 0, 0)), parent=scatter),
+            self.mock_instance(bracket, mathutils.Matrix.Translation((2, 0, 0)), parent=scatter),
+            self.mock_instance(bracket, mathutils.Matrix.Translation((3, 0, 0)), parent=collection_instance)
+        ]
+        dependency_graph.object_instances[0].show_self = False  # The scatter object only shows its instances.
+
+        def write_instances(writer):
+            writer.start(f"{{{MODEL_NAMESPACE}}}resources")
+            build_items = self.exporter.write_instances(writer, dependency_graph, 1.0)
+            writer.end(f"{{{MODEL_NAMESPACE}}}resources")
+            self.exporter.write_build(writer, build_items)
+
+        root, _ = self.write_document(write_instances)
+
+        object_elements = root.findall("3mf:resources/3mf:object", namespaces=MODEL_NAMESPACES)
+        self.assertEqual(len(object_elements), 1, "Only the bracket is visible, and its mesh is written once.")
+        bracket.to_mesh.assert_called_once()
+        item_elements = root.findall("3mf:build/3mf:item", namespaces=MODEL_NAMESPACES)
+        self.assertEqual(len(item_elements), 3, "Each instance of the bracket is a build item.")
+        for item_element, x in zip(item_elements, ["1", "2", "3"]):
+            self.assertEqual(item_element.attrib["objectid"], object_elements[0].attrib["id"])
+            self.assertEqual(item_element.attrib["transform"], f"1 0 0 0 1 0 0 0 1 {x} 0 0")
+        self.assertEqual(self.exporter.num_written, 3)
+
+    def test_write_instances_selection(self):
+        """
+        Tests writing only the instances created by selected objects.
+        """
+        self.exporter.use_selection = True
+        bracket = self.mock_mesh_object("Bracket", [(0, 0, 0), (1, 0, 0), (0, 1, 0)])
+        bracket.type = 'MESH'
+        selected = unittest.mock.MagicMock()
+        selected.original.select_get.return_value = True
+        unselected = unittest.mock.MagicMock()
+        unselected.original.select_get.return_value = False
+        dependency_graph = unittest.mock.MagicMock()
+        dependency_graph.object_instances = [
+            self.mock_instance(bracket, mathutils.Matrix.Identity(4), parent=unselected),
+            self.mock_instance(bracket, mathutils.Matrix.Translation((1, 0, 0)), parent=selected),
+        ]
+
+        root, build_items = self.write_document(self.exporter.write_instances, dependency_graph, 1.0)
+
+        self.assertEqual(len(build_items), 1, "Only the instance of the selected object is written.")
+        self.assertEqual(build_items[0].transformation, mathutils.Matrix.Translation((1, 0, 0)))
+
     def test_write_object_resource_id(self):
         """
         Ensures that the resource IDs given to the resources are unique positive integers.
@@ -545,12 +1001,12 @@ class TestExport3MF(unittest.TestCase):
         The IDs are probably just ascending numbers, but we only need to test that they are positive integers that were
         not used before.
         """
-        resources_element = xml.etree.ElementTree.Element(f"{{{MODEL_NAMESPACE}}}resources")
         blender_object = unittest.mock.MagicMock()
+        writer = io_mesh_3mf.xml_writer.XMLWriter(io.BytesIO(), {"": MODEL_NAMESPACE})
 
         given_ids = set()
         for i in range(1000):  # 1000x is probably more than any user would export.
-            resource_id, _ = self.exporter.write_object_resource(resources_element, blender_object)
+            resource_id, _ = self.exporter.write_object_resource(writer, blender_object)
             # We SHOULD only give out integer IDs. If not, this will crash and fail the test.
             resource_id = int(resource_id)
             self.assertGreater(resource_id, 0, "Resource IDs must be strictly positive IDs (not 0 either).")
@@ -563,13 +1019,12 @@ class TestExport3MF(unittest.TestCase):
 
         It should become an empty <object> element then.
         """
-        resources_element = xml.etree.ElementTree.Element(f"{{{MODEL_NAMESPACE}}}resources")
         blender_object = unittest.mock.MagicMock()
 
         blender_object.to_mesh.return_value = None  # Indicates that there is no Mesh in this object.
-        self.exporter.write_object_resource(resources_element, blender_object)
+        root, _ = self.write_document(self.exporter.write_object_resource, blender_object)
 
-        object_elements = resources_element.findall("3mf:object", namespaces=MODEL_NAMESPACES)
+        object_elements = root.findall("3mf:object", namespaces=MODEL_NAMESPACES)
         self.assertEqual(len(object_elements), 1, "We have written only one object.")
         object_element = object_elements[0]
         self.assertListEqual(
@@ -581,8 +1036,8 @@ class TestExport3MF(unittest.TestCase):
         """
         Tests writing the mesh of an object resource.
         """
-        resources_element = xml.etree.ElementTree.Element(f"{{{MODEL_NAMESPACE}}}resources")
         blender_object = unittest.mock.MagicMock()
+        blender_object.name = "Donbot"
         mock_material = unittest.mock.MagicMock()
         mock_material.name = "Mock Material"
         blender_object.material_slots = [unittest.mock.MagicMock(material=mock_material)]
@@ -593,27 +1048,28 @@ class TestExport3MF(unittest.TestCase):
 
         # Prepare a mock for the mesh.
         original_vertices = [(1, 2, 3), (4, 5, 6)]
-        original_triangles = [self.mock_triangle_loop, self.mock_triangle_loop]
-        blender_object.to_mesh().vertices = original_vertices
+        original_triangles = self.mock_triangles([(0, 1, 1), (1, 0, 0)], [0, 0])
+        blender_object.to_mesh().vertices = self.mock_vertices(original_vertices)
         blender_object.to_mesh().loop_triangles = original_triangles
 
-        self.exporter.write_object_resource(resources_element, blender_object)
+        root, _ = self.write_document(self.exporter.write_object_resource, blender_object)
 
-        mesh_elements = resources_element.findall("3mf:object/3mf:mesh", namespaces=MODEL_NAMESPACES)
+        mesh_elements = root.findall("3mf:object/3mf:mesh", namespaces=MODEL_NAMESPACES)
         self.assertEqual(len(mesh_elements), 1, "There is exactly one object with one mesh in it.")
-        mesh_element = mesh_elements[0]
-        self.exporter.write_vertices.assert_called_once_with(mesh_element, original_vertices)
-        self.exporter.write_triangles.assert_called_once_with(
-            mesh_element,
-            original_triangles,
-            0,
-            blender_object.material_slots)
+        self.exporter.write_vertices.assert_called_once()
+        self.assertEqual(self.exporter.write_vertices.call_args.args[0], self.writer)
+        self.assertEqual(self.exporter.write_vertices.call_args.args[1].tolist(), [[1, 2, 3], [4, 5, 6]])
+        self.exporter.write_triangles.assert_called_once()
+        writer, vertices, material_indices, object_material_list_index = self.exporter.write_triangles.call_args.args
+        self.assertEqual(writer, self.writer)
+        self.assertEqual(vertices.tolist(), [[0, 1, 1], [1, 0, 0]])
+        self.assertEqual(material_indices.tolist(), [0, 0], "Both triangles have the first material in our list.")
+        self.assertEqual(object_material_list_index, 0)
 
     def test_write_object_resource_children(self):
         """
         Tests writing an object resource that has children.
         """
-        resources_element = xml.etree.ElementTree.Element(f"{{{MODEL_NAMESPACE}}}resources")
         blender_object = unittest.mock.MagicMock()
         blender_object.matrix_world = mathutils.Matrix.Identity(4)
 
@@ -624,21 +1080,26 @@ class TestExport3MF(unittest.TestCase):
         child.children = []
         blender_object.children = [child]
 
-        parent_id, _ = self.exporter.write_object_resource(resources_element, blender_object)
+        root, (parent_id, _) = self.write_document(self.exporter.write_object_resource, blender_object)
 
-        component_elements = resources_element.findall(
+        component_elements = root.findall(
             "3mf:object/3mf:components/3mf:component",
             namespaces=MODEL_NAMESPACES)
         self.assertEqual(len(component_elements), 1, "There was 1 child, so there should be 1 component.")
         component_element = component_elements[0]
         self.assertNotEqual(
-            int(component_element.attrib[f"{{{MODEL_NAMESPACE}}}objectid"]),
+            int(component_element.attrib["objectid"]),
             int(parent_id),
             "The ID given to the child object must be unique.")
         self.assertEqual(
-            component_element.attrib[f"{{{MODEL_NAMESPACE}}}transform"],
+            component_element.attrib["transform"],
             "2 0 0 0 2 0 0 0 2 0 0 0",
             "The transformation for 200% scale must be given to this component.")
+        object_elements = root.findall("3mf:object", namespaces=MODEL_NAMESPACES)
+        self.assertEqual(
+            [element.attrib["id"] for element in object_elements],
+            [component_element.attrib["objectid"], str(parent_id)],
+            "The child must be written before the parent, since resources may only refer to earlier resources.")
 
     def test_write_object_resource_children_mesh(self):
         """
@@ -650,8 +1111,8 @@ class TestExport3MF(unittest.TestCase):
         self.exporter.write_vertices = unittest.mock.MagicMock()
         self.exporter.write_triangles = unittest.mock.MagicMock()
 
-        resources_element = xml.etree.ElementTree.Element(f"{{{MODEL_NAMESPACE}}}resources")
         blender_object = unittest.mock.MagicMock()
+        blender_object.name = "Joey Mousepad"
         blender_object.matrix_world = mathutils.Matrix.Identity(4)
         mock_material = unittest.mock.MagicMock()
         mock_material.name = "Mock Material"
@@ -667,13 +1128,13 @@ class TestExport3MF(unittest.TestCase):
 
         # Give the object a (pretend-)mesh.
         original_vertices = [(1, 2, 3), (4, 5, 6)]
-        original_triangles = [self.mock_triangle_loop, self.mock_triangle_loop]
-        blender_object.to_mesh().vertices = original_vertices
+        original_triangles = self.mock_triangles([(0, 1, 1), (1, 0, 0)], [0, 0])
+        blender_object.to_mesh().vertices = self.mock_vertices(original_vertices)
         blender_object.to_mesh().loop_triangles = original_triangles
 
-        parent_id, _ = self.exporter.write_object_resource(resources_element, blender_object)
+        root, (parent_id, _) = self.write_document(self.exporter.write_object_resource, blender_object)
 
-        component_elements = resources_element.findall(
+        component_elements = root.findall(
             "3mf:object/3mf:components/3mf:component",
             namespaces=MODEL_NAMESPACES)
         self.assertEqual(
@@ -682,22 +1143,24 @@ class TestExport3MF(unittest.TestCase):
             "There is 1 child component, and 1 new component created for the mesh in the parent object.")
         used_ids = {parent_id}
         for component_element in component_elements:
-            child_id = int(component_element.attrib[f"{{{MODEL_NAMESPACE}}}objectid"])
+            child_id = int(component_element.attrib["objectid"])
             self.assertNotIn(child_id, used_ids, "The ID given to the components must be unique.")
             used_ids.add(child_id)
-        mesh_elements = resources_element.findall("3mf:object/3mf:mesh", namespaces=MODEL_NAMESPACES)
+        mesh_elements = root.findall("3mf:object/3mf:mesh", namespaces=MODEL_NAMESPACES)
         self.assertEqual(
             len(mesh_elements),
             1,
             "There is only one object with a mesh in it. The other one has no mesh data, so no mesh should be created.")
-        mesh_element = mesh_elements[0]
         # Only one of the objects had a mesh, so it should get called only once.
-        self.exporter.write_vertices.assert_called_once_with(mesh_element, original_vertices)
-        self.exporter.write_triangles.assert_called_once_with(
-            mesh_element,
-            original_triangles,
-            0,
-            blender_object.material_slots)
+        self.exporter.write_vertices.assert_called_once()
+        self.assertEqual(self.exporter.write_vertices.call_args.args[0], self.writer)
+        self.assertEqual(self.exporter.write_vertices.call_args.args[1].tolist(), [[1, 2, 3], [4, 5, 6]])
+        self.exporter.write_triangles.assert_called_once()
+        writer, vertices, material_indices, object_material_list_index = self.exporter.write_triangles.call_args.args
+        self.assertEqual(writer, self.writer)
+        self.assertEqual(vertices.tolist(), [[0, 1, 1], [1, 0, 0]])
+        self.assertEqual(material_indices.tolist(), [0, 0], "Both triangles have the first material in our list.")
+        self.assertEqual(object_material_list_index, 0)
 
     def test_write_object_resource_metadata(self):
         """
@@ -707,7 +1170,6 @@ class TestExport3MF(unittest.TestCase):
         self.exporter.write_vertices = unittest.mock.MagicMock()
         self.exporter.write_triangles = unittest.mock.MagicMock()
 
-        resources_element = xml.etree.ElementTree.Element(f"{{{MODEL_NAMESPACE}}}resources")
         blender_object = unittest.mock.MagicMock()
         blender_object.matrix_world = mathutils.Matrix.Identity(4)
         mock_material = unittest.mock.MagicMock()
@@ -717,8 +1179,8 @@ class TestExport3MF(unittest.TestCase):
 
         # Give the object a (pretend-)mesh.
         original_vertices = [(1, 2, 3), (4, 5, 6)]
-        original_triangles = [self.mock_triangle_loop, self.mock_triangle_loop]
-        blender_object.to_mesh().vertices = original_vertices
+        original_triangles = self.mock_triangles([(0, 1, 1), (1, 0, 0)], [0, 0])
+        blender_object.to_mesh().vertices = self.mock_vertices(original_vertices)
         blender_object.to_mesh().loop_triangles = original_triangles
 
         # Give the object's mesh some metadata.
@@ -729,9 +1191,9 @@ class TestExport3MF(unittest.TestCase):
             preserve=False,
             value="Pack horse")
 
-        _, _ = self.exporter.write_object_resource(resources_element, blender_object)
+        root, _ = self.write_document(self.exporter.write_object_resource, blender_object)
 
-        metadatagroup_elements = resources_element.findall(
+        metadatagroup_elements = root.findall(
             "3mf:object/3mf:metadatagroup",
             namespaces=MODEL_NAMESPACES)
         self.assertEqual(
@@ -743,18 +1205,18 @@ class TestExport3MF(unittest.TestCase):
             "3mf:metadata",
             namespaces=MODEL_NAMESPACES)
         for metadata_element in metadata_elements:
-            if metadata_element.attrib[f"{{{MODEL_NAMESPACE}}}name"] == "Title":
+            if metadata_element.attrib["name"] == "Title":
                 self.assertEqual(
                     metadata_element.text,
                     "Sergeant Reckless",
                     "The name of the mesh was 'Sergeant Reckless', "
                     "which should get stored as the 'Title' metadata entry.")
                 self.assertEqual(
-                    metadata_element.attrib[f"{{{MODEL_NAMESPACE}}}type"],
+                    metadata_element.attrib["type"],
                     "xs:string",
                     "The object name is always a string.")
                 self.assertEqual(
-                    metadata_element.attrib[f"{{{MODEL_NAMESPACE}}}preserve"],
+                    metadata_element.attrib["preserve"],
                     "1",
                     "The object name must always be preserved (the way that we write these files).")
             elif metadata_element.attrib["name"] == "Description":
@@ -763,11 +1225,11 @@ class TestExport3MF(unittest.TestCase):
                     "Pack horse",
                     "This is the 'Description' metadata, which was set to 'Pack horse'.")
                 self.assertEqual(
-                    metadata_element.attrib[f"{{{MODEL_NAMESPACE}}}type"],
+                    metadata_element.attrib["type"],
                     "some_type",
                     "The data type was set to 'some_type'.")
                 self.assertNotIn(
-                    f"{{{MODEL_NAMESPACE}}}preserve",
+                    "preserve",
                     metadata_element.attrib,
                     "Since this metadata isn't preserved, don't write a 'preserve' attribute "
                     "but let it be the default, which is to not preserve.")
@@ -784,8 +1246,8 @@ class TestExport3MF(unittest.TestCase):
         self.exporter.write_triangles = unittest.mock.MagicMock()
         self.exporter.material_resource_id = "999"  # Simulate having written a material.
 
-        resources_element = xml.etree.ElementTree.Element(f"{{{MODEL_NAMESPACE}}}resources")
         blender_object = unittest.mock.MagicMock()
+        blender_object.name = "Sal"
         blender_object.matrix_world = mathutils.Matrix.Identity(4)
         blender_object.children = []
         mock_material = unittest.mock.MagicMock()
@@ -795,21 +1257,21 @@ class TestExport3MF(unittest.TestCase):
 
         # Give the object a (pretend-)mesh.
         original_vertices = [(1, 2, 3), (4, 5, 6)]
-        original_triangles = [self.mock_triangle_loop, self.mock_triangle_loop]
-        blender_object.to_mesh().vertices = original_vertices
+        original_triangles = self.mock_triangles([(0, 1, 1), (1, 0, 0)], [0, 0])
+        blender_object.to_mesh().vertices = self.mock_vertices(original_vertices)
         blender_object.to_mesh().loop_triangles = original_triangles
 
-        _, _ = self.exporter.write_object_resource(resources_element, blender_object)
+        root, _ = self.write_document(self.exporter.write_object_resource, blender_object)
 
-        object_elements = resources_element.findall("3mf:object", namespaces=MODEL_NAMESPACES)
+        object_elements = root.findall("3mf:object", namespaces=MODEL_NAMESPACES)
         self.assertEqual(len(object_elements), 1, "We have written only one object.")
         object_element = object_elements[0]
         self.assertEqual(
-            object_element.attrib[f"{{{MODEL_NAMESPACE}}}pid"],
+            object_element.attrib["pid"],
             "999",
             "We simulated having written a material with ID 999.")
         self.assertEqual(
-            object_element.attrib[f"{{{MODEL_NAMESPACE}}}pindex"],
+            object_element.attrib["pindex"],
             "0",
             "There is only one material, and it's the most common one: index 0.")
 
@@ -822,8 +1284,8 @@ class TestExport3MF(unittest.TestCase):
         self.exporter.write_vertices = unittest.mock.MagicMock()
         self.exporter.material_resource_id = "999"  # Simulate having written a material.
 
-        resources_element = xml.etree.ElementTree.Element(f"{{{MODEL_NAMESPACE}}}resources")
         blender_object = unittest.mock.MagicMock()
+        blender_object.name = "Elzar"
         blender_object.matrix_world = mathutils.Matrix.Identity(4)
         blender_object.children = []
         material1 = unittest.mock.MagicMock()
@@ -839,42 +1301,40 @@ class TestExport3MF(unittest.TestCase):
 
         # Give the object a (pretend-)mesh.
         original_vertices = [(1, 2, 3), (4, 5, 6)]
-        original_triangles = [
-            unittest.mock.MagicMock(material_index=1),  # Index 1 is the most common one.
-            unittest.mock.MagicMock(material_index=0),
-            unittest.mock.MagicMock(material_index=1)
-        ]
-        blender_object.to_mesh().vertices = original_vertices
+        original_triangles = self.mock_triangles(
+            [(0, 1, 1), (1, 0, 0), (0, 0, 1)],
+            [1, 0, 1])  # Index 1 is the most common one.
+        blender_object.to_mesh().vertices = self.mock_vertices(original_vertices)
         blender_object.to_mesh().loop_triangles = original_triangles
 
-        _, _ = self.exporter.write_object_resource(resources_element, blender_object)
+        root, _ = self.write_document(self.exporter.write_object_resource, blender_object)
 
-        object_elements = resources_element.findall("3mf:object", namespaces=MODEL_NAMESPACES)
+        object_elements = root.findall("3mf:object", namespaces=MODEL_NAMESPACES)
         self.assertEqual(len(object_elements), 1, "We have written only one object.")
         object_element = object_elements[0]
         self.assertEqual(
-            object_element.attrib[f"{{{MODEL_NAMESPACE}}}pid"],
+            object_element.attrib["pid"],
             "999",
             "We simulated having written a material with ID 999.")
         self.assertEqual(
-            object_element.attrib[f"{{{MODEL_NAMESPACE}}}pindex"],
+            object_element.attrib["pindex"],
             "1",
             "Material with index 1 was the most common one for this object.")
-        triangles = resources_element.findall(
+        triangles = root.findall(
             "3mf:object/3mf:mesh/3mf:triangles/3mf:triangle",
             namespaces=MODEL_NAMESPACES)
         self.assertNotIn(
-            f"{{{MODEL_NAMESPACE}}}p1",
+            "p1",
             triangles[0].attrib,
             "The first triangle had the index of the most common material, "
             "so it shouldn't override the material index.")
         self.assertNotIn(
-            f"{{{MODEL_NAMESPACE}}}p1",
+            "p1",
             triangles[2].attrib,
             "The third triangle had the index of the most common material, "
             "so it shouldn't override the material index.")
         self.assertEqual(
-            triangles[1].attrib[f"{{{MODEL_NAMESPACE}}}p1"],
+            triangles[1].attrib["p1"],
             "0",
             "This triangle had material index 0, which is not the most common material, "
             "so it must override the material index to 0.")
@@ -906,13 +1366,12 @@ class TestExport3MF(unittest.TestCase):
         will not even be a <mesh> element then. We merely test this for defensive coding. The function should be
         reliable as a stand-alone routine regardless of input.
         """
-        mesh_element = xml.etree.ElementTree.Element(f"{{{MODEL_NAMESPACE}}}mesh")
-        vertices = []
+        vertices = numpy.empty((0, 3), dtype=numpy.float32)
 
-        self.exporter.write_vertices(mesh_element, vertices)
+        root, _ = self.write_document(self.exporter.write_vertices, vertices)
 
         self.assertListEqual(
-            mesh_element.findall("3mf:vertices/3mf:vertex", namespaces=MODEL_NAMESPACES),
+            root.findall("3mf:vertices/3mf:vertex", namespaces=MODEL_NAMESPACES),
             [],
             "There may not be any vertices in the file, because there were no vertices to write.")
 
@@ -920,33 +1379,217 @@ class TestExport3MF(unittest.TestCase):
         """
         Tests writing several vertices to the 3MF document.
         """
-        mesh_element = xml.etree.ElementTree.Element(f"{{{MODEL_NAMESPACE}}}mesh")
-        # The vertices this function accepts are Blender's implementation, where the coordinates are in the "co"
-        # property.
-        vertex1 = unittest.mock.MagicMock(co=(0.0, 1.1, 2.2))
-        vertex2 = unittest.mock.MagicMock(co=(3.3, 4.4, 5.5))
-        vertex3 = unittest.mock.MagicMock(co=(6.6, 7.7, 8.8))
-        vertices = [vertex1, vertex2, vertex3]
+        # The coordinates are 32-bit floats, as Blender stores them.
+        vertices = numpy.array([(0.0, 1.1, 2.2), (3.3, 4.4, 5.5), (6.6, 7.7, 8.8)], dtype=numpy.float32)
 
-        self.exporter.write_vertices(mesh_element, vertices)
+        root, _ = self.write_document(self.exporter.write_vertices, vertices)
 
-        vertex_elements = mesh_element.findall("3mf:vertices/3mf:vertex", namespaces=MODEL_NAMESPACES)
+        vertex_elements = root.findall("3mf:vertices/3mf:vertex", namespaces=MODEL_NAMESPACES)
         self.assertEqual(len(vertex_elements), 3, "There were 3 vertices to write.")
         self.assertEqual(
-            vertex_elements[0].attrib[f"{{{MODEL_NAMESPACE}}}x"],
+            vertex_elements[0].attrib["x"],
             "0",
             "Formatting must format as integers if possible.")
         self.assertEqual(
-            vertex_elements[0].attrib[f"{{{MODEL_NAMESPACE}}}y"],
+            vertex_elements[0].attrib["y"],
             "1.1",
             "Formatting must format as floats if necessary.")
-        self.assertEqual(vertex_elements[0].attrib[f"{{{MODEL_NAMESPACE}}}z"], "2.2")
-        self.assertEqual(vertex_elements[1].attrib[f"{{{MODEL_NAMESPACE}}}x"], "3.3")
-        self.assertEqual(vertex_elements[1].attrib[f"{{{MODEL_NAMESPACE}}}y"], "4.4")
-        self.assertEqual(vertex_elements[1].attrib[f"{{{MODEL_NAMESPACE}}}z"], "5.5")
-        self.assertEqual(vertex_elements[2].attrib[f"{{{MODEL_NAMESPACE}}}x"], "6.6")
-        self.assertEqual(vertex_elements[2].attrib[f"{{{MODEL_NAMESPACE}}}y"], "7.7")
-        self.assertEqual(vertex_elements[2].attrib[f"{{{MODEL_NAMESPACE}}}z"], "8.8")
+        self.assertEqual(vertex_elements[0].attrib["z"], "2.2")
+        self.assertEqual(vertex_elements[1].attrib["x"], "3.3")
+        self.assertEqual(vertex_elements[1].attrib["y"], "4.4")
+        self.assertEqual(vertex_elements[1].attrib["z"], "5.5")
+        self.assertEqual(vertex_elements[2].attrib["x"], "6.6")
+        self.assertEqual(vertex_elements[2].attrib["y"], "7.7")
+        self.assertEqual(vertex_elements[2].attrib["z"], "8.8")
+
+    def test_write_vertices_format(self):
+        """
+        Tests that the coordinates of vertices are formatted the same way as `format_number` formats them.
+        """
+        coordinates = [
+            (0.0, -0.0, 1.0),
+            (10.0, 100.5, -1000.25),
+            (0.00001, -0.00001, 123456.789),
+            (1e-20, 3e12, -7.5e-3)
+        ]
+        for precision in range(13):
+            with self.subTest(precision=precision):
+                self.exporter.coordinate_precision = precision
+                vertices = numpy.array(coordinates, dtype=numpy.float32)
+
+                root, _ = self.write_document(self.exporter.write_vertices, vertices)
+
+                vertex_elements = root.findall("3mf:vertices/3mf:vertex", namespaces=MODEL_NAMESPACES)
+                expected = numpy.array(coordinates, dtype=numpy.float32).tolist()  # Blender stores 32-bit floats.
+                for vertex_element, vertex in zip(vertex_elements, expected):
+                    for attribute, coordinate in zip(("x", "y", "z"), vertex):
+                        self.assertEqual(
+                            vertex_element.attrib[attribute],
+                            self.exporter.format_number(coordinate, precision))
+
+    def test_write_vertices_blocks(self):
+        """
+        Tests writing more vertices than fit in one block of formatted vertices.
+        """
+        coordinates = [(i, i + 0.5, -i) for i in range(io_mesh_3mf.export_3mf.VERTICES_PER_BLOCK * 2 + 1)]
+        vertices = numpy.array(coordinates, dtype=numpy.float32)
+
+        root, _ = self.write_document(self.exporter.write_vertices, vertices)
+
+        vertex_elements = root.findall("3mf:vertices/3mf:vertex", namespaces=MODEL_NAMESPACES)
+        self.assertEqual(len(vertex_elements), len(coordinates), "All vertices must be written, across all blocks.")
+        for i in [0, io_mesh_3mf.export_3mf.VERTICES_PER_BLOCK, len(coordinates) - 1]:
+            self.assertEqual(vertex_elements[i].attrib["x"], str(i))
+            self.assertEqual(vertex_elements[i].attrib["y"], f"{i}.5")
+            self.assertEqual(vertex_elements[i].attrib["z"], str(-i))
+
+    def test_write_vertices_threads(self):
+        """
+        Tests formatting blocks of vertices and triangles on multiple threads.
+        """
+        count = io_mesh_3mf.export_3mf.VERTICES_PER_BLOCK * 4 + 1
+        coordinates = numpy.arange(count * 3, dtype=numpy.float32).reshape((count, 3))
+        triangles = numpy.arange(count * 3, dtype=numpy.int32).reshape((count, 3))
+        stream = io.BytesIO()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+            with io_mesh_3mf.xml_writer.XMLWriter(stream, {"": MODEL_NAMESPACE}, executor, max_deferred=2) as writer:
+                writer.start(f"{{{MODEL_NAMESPACE}}}mesh")
+                self.exporter.write_vertices(writer, coordinates)
+                self.exporter.write_triangles(writer, triangles, numpy.zeros(count, dtype=numpy.int32), 0)
+                writer.end(f"{{{MODEL_NAMESPACE}}}mesh")
+
+        root = xml.etree.ElementTree.fromstring(stream.getvalue())
+        vertex_elements = root.findall("3mf:vertices/3mf:vertex", namespaces=MODEL_NAMESPACES)
+        self.assertEqual(
+            [element.attrib["x"] for element in vertex_elements],
+            [str(i * 3) for i in range(count)],
+            "All blocks are written in their original order.")
+        triangle_elements = root.findall("3mf:triangles/3mf:triangle", namespaces=MODEL_NAMESPACES)
+        self.assertEqual(
+            [element.attrib["v1"] for element in triangle_elements],
+            [str(i * 3) for i in range(count)],
+            "All blocks are written in their original order.")
+
+    def test_write_object_resource_unassigned_material(self):
+        """
+        Tests writing an object with triangles in material slots that have no material.
+        """
+        self.exporter.write_vertices = unittest.mock.MagicMock()
+        self.exporter.material_resource_id = "999"  # Simulate having written a material.
+
+        blender_object = unittest.mock.MagicMock()
+        blender_object.name = "Nibbler"
+        blender_object.matrix_world = mathutils.Matrix.Identity(4)
+        blender_object.children = []
+        material = unittest.mock.MagicMock()
+        material.name = "PLA"
+        blender_object.material_slots = [
+            unittest.mock.MagicMock(material=None),
+            unittest.mock.MagicMock(material=material)
+        ]
+        self.exporter.material_name_to_index["PLA"] = 3
+
+        # Most triangles are in the empty slot, and one refers to a slot that doesn't exist.
+        blender_object.to_mesh().vertices = self.mock_vertices([(1, 2, 3), (4, 5, 6)])
+        blender_object.to_mesh().loop_triangles = self.mock_triangles(
+            [(0, 1, 1), (1, 0, 0), (0, 0, 1), (1, 1, 0)],
+            [0, 1, 0, 5])
+
+        root, _ = self.write_document(self.exporter.write_object_resource, blender_object)
+
+        object_element = root.find("3mf:object", namespaces=MODEL_NAMESPACES)
+        self.assertEqual(
+            object_element.attrib["pindex"],
+            "3",
+            "Triangles without material are not counted, so the only real material is the most common one.")
+        triangles = root.findall(
+            "3mf:object/3mf:mesh/3mf:triangles/3mf:triangle",
+            namespaces=MODEL_NAMESPACES)
+        self.assertEqual(len(triangles), 4)
+        for triangle in triangles:
+            self.assertNotIn("p1", triangle.attrib, "None of the triangles have a different material than the object.")
+
+    def mock_mesh_object(self, name, coordinates):
+        """
+        Creates a mock for a Blender object with a mesh of one triangle, without children or materials.
+        :param name: The name of the object.
+        :param coordinates: A list of the coordinates of the three vertices of the mesh.
+        :return: A mock of the Blender object.
+        """
+        blender_object = unittest.mock.MagicMock()
+        blender_object.name = name
+        blender_object.matrix_world = mathutils.Matrix.Identity(4)
+        blender_object.children = []
+        blender_object.material_slots = []
+        blender_object.to_mesh.return_value.vertices = self.mock_vertices(coordinates)
+        blender_object.to_mesh.return_value.loop_triangles = self.mock_triangles([(0, 1, 2)], [0])
+        return blender_object
+
+    def test_write_object_resource_shared_mesh(self):
+        """
+        Tests writing multiple objects with the same geometry, which must share a single mesh resource.
+        """
+        coordinates = [(0, 0, 0), (1, 0, 0), (0, 1, 0)]
+        blender_objects = [
+            self.mock_mesh_object("Bracket", coordinates),
+            self.mock_mesh_object("Bracket.001", coordinates),
+            self.mock_mesh_object("Wedge", [(0, 0, 0), (1, 0, 0), (0, 0, 1)])
+        ]
+
+        def write_resources(writer):
+            return [self.exporter.write_object_resource(writer, blender_object)[0] for blender_object in
+                    blender_objects]
+
+        root, resource_ids = self.write_document(write_resources)
+
+        self.assertEqual(resource_ids[0], resource_ids[1], "The two brackets are identical, so refer to the same mesh.")
+        self.assertNotEqual(resource_ids[0], resource_ids[2], "The wedge has different geometry.")
+        object_elements = root.findall("3mf:object", namespaces=MODEL_NAMESPACES)
+        self.assertEqual(
+            [element.attrib["id"] for element in object_elements],
+            [str(resource_ids[0]), str(resource_ids[2])],
+            "Each distinct mesh is written only once.")
+
+    def test_write_object_resource_shared_mesh_children(self):
+        """
+        Tests writing an object with children that have the same geometry as each other.
+
+        Components can't have metadata of their own, so each child keeps its own mesh resource, with its own metadata.
+        """
+        coordinates = [(0, 0, 0), (1, 0, 0), (0, 1, 0)]
+        blender_object = unittest.mock.MagicMock()
+        blender_object.name = "Array"
+        blender_object.matrix_world = mathutils.Matrix.Identity(4)
+        blender_object.to_mesh.return_value = None
+        blender_object.children = [
+            self.mock_mesh_object("Bracket", coordinates),
+            self.mock_mesh_object("Bracket.001", coordinates)
+        ]
+        blender_object.children[0].type = 'MESH'
+        blender_object.children[1].type = 'MESH'
+        blender_object.children[1].matrix_world = mathutils.Matrix.Translation((10, 0, 0))
+
+        root, (parent_id, _) = self.write_document(self.exporter.write_object_resource, blender_object)
+
+        mesh_objects = [
+            element for element in root.iterfind("3mf:object", namespaces=MODEL_NAMESPACES)
+            if element.find("3mf:mesh", namespaces=MODEL_NAMESPACES) is not None]
+        self.assertListEqual(
+            [element.find("3mf:metadatagroup/3mf:metadata[@name='Title']", MODEL_NAMESPACES).text
+             for element in mesh_objects],
+            ["Bracket", "Bracket.001"],
+            "Each child keeps its own title, so they can't share a mesh resource.")
+        component_elements = root.findall("3mf:object/3mf:components/3mf:component", namespaces=MODEL_NAMESPACES)
+        self.assertEqual(len(component_elements), 2, "Both children are components of the parent.")
+        self.assertListEqual(
+            [component.attrib["objectid"] for component in component_elements],
+            [element.attrib["id"] for element in mesh_objects])
+        self.assertNotIn("transform", component_elements[0].attrib)
+        self.assertEqual(
+            component_elements[1].attrib["transform"],
+            "1 0 0 0 1 0 0 0 1 10 0 0",
+            "Each component has its own transformation.")
+        self.assertEqual(self.exporter.num_written, 2, "Both children were exported.")
 
     def test_write_triangles_empty(self):
         """
@@ -955,13 +1598,13 @@ class TestExport3MF(unittest.TestCase):
         Contrary to the similar test for writing vertices, this may actually happen in the field, if a mesh consists of
         only vertices or edges.
         """
-        mesh_element = xml.etree.ElementTree.Element(f"{{{MODEL_NAMESPACE}}}mesh")
-        triangles = []
+        vertices = numpy.empty((0, 3), dtype=numpy.int32)
+        material_indices = numpy.empty(0, dtype=numpy.int32)
 
-        self.exporter.write_triangles(mesh_element, triangles, 0, [])
+        root, _ = self.write_document(self.exporter.write_triangles, vertices, material_indices, 0)
 
         self.assertListEqual(
-            mesh_element.findall("3mf:triangles/3mf:triangle", namespaces=MODEL_NAMESPACES),
+            root.findall("3mf:triangles/3mf:triangle", namespaces=MODEL_NAMESPACES),
             [],
             "There may not be any triangles in the file, because there were no triangles to write.")
 
@@ -969,29 +1612,160 @@ class TestExport3MF(unittest.TestCase):
         """
         Tests writing several triangles to the 3MF document.
         """
-        mesh_element = xml.etree.ElementTree.Element(f"{{{MODEL_NAMESPACE}}}mesh")
-        triangle1 = unittest.mock.MagicMock(vertices=[0, 1, 2], material_index=0)
-        triangle2 = unittest.mock.MagicMock(vertices=[3, 4, 5], material_index=0)
-        triangle3 = unittest.mock.MagicMock(vertices=[4, 2, 0], material_index=0)
-        triangles = [triangle1, triangle2, triangle3]
-        self.exporter.material_name_to_index["BLA"] = 0
-        material_mock = unittest.mock.MagicMock()
-        material_mock.name = "BLA"
-        material_slots = [unittest.mock.MagicMock(material=material_mock)]
+        vertices = numpy.array([[0, 1, 2], [3, 4, 5], [4, 2, 0]], dtype=numpy.int32)
+        material_indices = numpy.array([0, 0, 0], dtype=numpy.int32)
 
-        self.exporter.write_triangles(mesh_element, triangles, 0, material_slots)
+        root, _ = self.write_document(self.exporter.write_triangles, vertices, material_indices, 0)
 
-        triangle_elements = mesh_element.findall("3mf:triangles/3mf:triangle", namespaces=MODEL_NAMESPACES)
+        triangle_elements = root.findall("3mf:triangles/3mf:triangle", namespaces=MODEL_NAMESPACES)
         self.assertEqual(len(triangle_elements), 3, "There were 3 triangles to write.")
-        self.assertEqual(triangle_elements[0].attrib[f"{{{MODEL_NAMESPACE}}}v1"], "0")
-        self.assertEqual(triangle_elements[0].attrib[f"{{{MODEL_NAMESPACE}}}v2"], "1")
-        self.assertEqual(triangle_elements[0].attrib[f"{{{MODEL_NAMESPACE}}}v3"], "2")
-        self.assertEqual(triangle_elements[1].attrib[f"{{{MODEL_NAMESPACE}}}v1"], "3")
-        self.assertEqual(triangle_elements[1].attrib[f"{{{MODEL_NAMESPACE}}}v2"], "4")
-        self.assertEqual(triangle_elements[1].attrib[f"{{{MODEL_NAMESPACE}}}v3"], "5")
-        self.assertEqual(triangle_elements[2].attrib[f"{{{MODEL_NAMESPACE}}}v1"], "4")
-        self.assertEqual(triangle_elements[2].attrib[f"{{{MODEL_NAMESPACE}}}v2"], "2")
-        self.assertEqual(triangle_elements[2].attrib[f"{{{MODEL_NAMESPACE}}}v3"], "0")
+        self.assertEqual(triangle_elements[0].attrib["v1"], "0")
+        self.assertEqual(triangle_elements[0].attrib["v2"], "1")
+        self.assertEqual(triangle_elements[0].attrib["v3"], "2")
+        self.assertEqual(triangle_elements[1].attrib["v1"], "3")
+        self.assertEqual(triangle_elements[1].attrib["v2"], "4")
+        self.assertEqual(triangle_elements[1].attrib["v3"], "5")
+        self.assertEqual(triangle_elements[2].attrib["v1"], "4")
+        self.assertEqual(triangle_elements[2].attrib["v2"], "2")
+        self.assertEqual(triangle_elements[2].attrib["v3"], "0")
+        for triangle_element in triangle_elements:
+            self.assertNotIn("p1", triangle_element.attrib, "All triangles have the material of the object.")
+
+    def test_write_triangles_materials(self):
+        """
+        Tests writing triangles that override the material of the object, across multiple blocks of triangles.
+        """
+        count = io_mesh_3mf.export_3mf.TRIANGLES_PER_BLOCK * 2 + 1
+        vertices = numpy.arange(count * 3, dtype=numpy.int32).reshape((count, 3))
+        material_indices = numpy.zeros(count, dtype=numpy.int32)
+        material_indices[count - 2] = 2  # Only the last block has a different material.
+        material_indices[count - 1] = -1  # And a triangle without material.
+
+        root, _ = self.write_document(self.exporter.write_triangles, vertices, material_indices, 0)
+
+        triangle_elements = root.findall("3mf:triangles/3mf:triangle", namespaces=MODEL_NAMESPACES)
+        self.assertEqual(len(triangle_elements), count, "All triangles must be written, across all blocks.")
+        for i in [0, io_mesh_3mf.export_3mf.TRIANGLES_PER_BLOCK, count - 2, count - 1]:
+            self.assertEqual(triangle_elements[i].attrib["v1"], str(i * 3))
+            self.assertEqual(triangle_elements[i].attrib["v3"], str(i * 3 + 2))
+        self.assertEqual(triangle_elements[count - 2].attrib["p1"], "2", "This triangle has a different material.")
+        self.assertEqual(
+            [element for element in triangle_elements if "p1" in element.attrib],
+            [triangle_elements[count - 2]],
+            "Only the triangle with a different material gets a p1 attribute, not the one without material.")
+
+    def test_write_trianglesets(self):
+        """
+        Tests writing triangle sets, where runs of consecutive triangles are written as ranges.
+        """
+        red = unittest.mock.MagicMock()
+        red.material.name = "Red"
+        green = unittest.mock.MagicMock()
+        green.material.name = "Green"
+        slot_indices = numpy.array([0, 0, 0, 1, 0, 1, 1, 0], dtype=numpy.int32)
+
+        root, _ = self.write_document(self.exporter.write_trianglesets, slot_indices, [red, green])
+
+        triangleset_elements = root.findall("t:trianglesets/t:triangleset", namespaces=MODEL_NAMESPACES)
+        self.assertEqual([element.attrib["name"] for element in triangleset_elements], ["Red", "Green"])
+        refs = [(element.tag, dict(element.attrib)) for element in triangleset_elements[0]]
+        self.assertListEqual(refs, [
+            (f"{{{TRIANGLESETS_NAMESPACE}}}refrange", {"startindex": "0", "endindex": "2"}),
+            (f"{{{TRIANGLESETS_NAMESPACE}}}ref", {"index": "4"}),
+            (f"{{{TRIANGLESETS_NAMESPACE}}}ref", {"index": "7"})
+        ], "The first three triangles form a range. The others are isolated.")
+        refs = [(element.tag, dict(element.attrib)) for element in triangleset_elements[1]]
+        self.assertListEqual(refs, [
+            (f"{{{TRIANGLESETS_NAMESPACE}}}ref", {"index": "3"}),
+            (f"{{{TRIANGLESETS_NAMESPACE}}}refrange", {"startindex": "5", "endindex": "6"})
+        ])
+
+    def test_write_trianglesets_single_material(self):
+        """
+        Tests that no triangle sets are written if all triangles have the same material.
+        """
+        red = unittest.mock.MagicMock()
+        red.material.name = "Red"
+        slot_indices = numpy.zeros(10, dtype=numpy.int32)
+
+        root, _ = self.write_document(self.exporter.write_trianglesets, slot_indices, [red])
+
+        self.assertIsNone(root.find("t:trianglesets", namespaces=MODEL_NAMESPACES))
+
+    def test_attribute_trianglesets(self):
+        """
+        Tests finding the triangle sets that are stored as boolean face attributes of a mesh.
+        """
+        mesh = unittest.mock.MagicMock()
+        mesh.polygons.__len__.return_value = 3
+        mesh.loop_triangles = self.mock_triangles([(0, 1, 2), (0, 2, 3), (4, 5, 6), (7, 8, 9)], [0, 0, 0, 0])
+        polygon_indices = [0, 0, 1, 2]  # The first face is a quad, split into two triangles.
+        triangle_attributes = mesh.loop_triangles.foreach_get.side_effect
+
+        def foreach_get(attribute, buffer):
+            if attribute == "polygon_index":
+                buffer[:] = polygon_indices
+            else:
+                triangle_attributes(attribute, buffer)
+        mesh.loop_triangles.foreach_get.side_effect = foreach_get
+
+        def mock_attribute(name, data_type, domain, values, is_internal=False):
+            attribute = unittest.mock.MagicMock(data_type=data_type, domain=domain, is_internal=is_internal)
+            attribute.name = name
+
+            def foreach_get_value(attribute_name, buffer):
+                self.assertEqual(attribute_name, "value")
+                buffer[:] = values
+            attribute.data.foreach_get.side_effect = foreach_get_value
+            return attribute
+        mesh.attributes = [
+            mock_attribute("Top", 'BOOLEAN', 'FACE', [True, False, True]),
+            mock_attribute("Empty", 'BOOLEAN', 'FACE', [False, False, False]),
+            mock_attribute("sharp_face", 'BOOLEAN', 'FACE', [True, True, True]),
+            mock_attribute(".select_poly", 'BOOLEAN', 'FACE', [True, True, True], is_internal=True),
+            mock_attribute("Weights", 'FLOAT', 'FACE', [1.0, 1.0, 1.0]),
+            mock_attribute("Pinned", 'BOOLEAN', 'POINT', [True, True, True])
+        ]
+
+        result = self.exporter.attribute_trianglesets(mesh)
+
+        self.assertEqual(len(result), 1, "Only user-made boolean face attributes with faces in them are sets.")
+        self.assertEqual(result[0][0], "Top")
+        self.assertListEqual(result[0][1].tolist(), [0, 1, 3], "Both triangles of the quad are in the set.")
+
+    def test_write_trianglesets_attributes(self):
+        """
+        Tests writing triangle sets that are stored as attributes, together with the sets by material.
+        """
+        red = unittest.mock.MagicMock()
+        red.material.name = "Red"
+        green = unittest.mock.MagicMock()
+        green.material.name = "Green"
+        slot_indices = numpy.array([0, 0, 1, 1], dtype=numpy.int32)
+        attribute_sets = [
+            ("ts_0", numpy.array([0, 1])),  # Imported from a set by material earlier. Same triangles as red.
+            ("Support", numpy.array([1, 2, 3]))
+        ]
+
+        root, _ = self.write_document(
+            self.exporter.write_trianglesets, slot_indices, [red, green], attribute_sets)
+
+        triangleset_elements = root.findall("t:trianglesets/t:triangleset", namespaces=MODEL_NAMESPACES)
+        self.assertListEqual(
+            [(element.attrib["name"], element.attrib["identifier"]) for element in triangleset_elements],
+            [("ts_0", "ts_0"), ("Support", "Support"), ("Green", "ts_1")],
+            "The red set is already stored as an attribute. The green set gets an identifier that is not taken yet.")
+        refs = [(element.tag, dict(element.attrib)) for element in triangleset_elements[1]]
+        self.assertListEqual(refs, [
+            (f"{{{TRIANGLESETS_NAMESPACE}}}refrange", {"startindex": "1", "endindex": "3"})
+        ], "The sets from attributes are written with ranges too.")
+
+        root, _ = self.write_document(self.exporter.write_trianglesets, slot_indices, [red], attribute_sets[1:])
+        triangleset_elements = root.findall("t:trianglesets/t:triangleset", namespaces=MODEL_NAMESPACES)
+        self.assertListEqual(
+            [element.attrib["name"] for element in triangleset_elements],
+            ["Support"],
+            "With a single material, only the sets from attributes are written.")
 
     def test_format_number(self):
         """
@@ -1004,7 +1778,10 @@ class TestExport3MF(unittest.TestCase):
             (30.12, 1, "30.1"),
             (3.14159, 10, "3.14159"),
             (0, 0, "0"),
-            (0.1, 0, "0")
+            (0.1, 0, "0"),
+            (30.0, 0, "30"),  # Zeros in the integer part are not stripped.
+            (100.0, 2, "100"),
+            (-1.5, 3, "-1.5")
         ]
         for number, precision, result in tests:
             with self.subTest(number=number, precision=precision, result=result):
@@ -12,8 +12,8 @@
 
 import io  # To simulate output streams to create input archives to test with.
 import mathutils  # To compare transformation matrices.
+import numpy  # To inspect the arrays that meshes are built from.
 import os.path  # To find the test resources.
-import re  # To test matching with content types.
 import unittest  # To run the tests.
 import unittest.mock  # To mock away the Blender API.
 import xml.etree.ElementTree  # To construct 3MF documents as input for the importer functions.
@@ -60,12 +60,22 @@ class TestImport3MF(unittest.TestCase):
         # Initialize instance variables that would normally be set in execute()
         self.importer.resource_objects = {}
         self.importer.resource_materials = {}
+        self.importer.resource_to_mesh = {}
+        self.importer.resource_to_collection = {}
+        self.importer.shared_resources = set()
+        self.importer.scanned_blocks = {}
         self.importer.num_loaded = 0
+        self.importer.object_names = {}
+        self.importer.mesh_names = {}
+        self.importer.collection_names = {}
+        self.importer.collection = unittest.mock.MagicMock()
+        self.importer.built_objects = []
 
         self.single_triangle = io_mesh_3mf.import_3mf.ResourceObject(  # A model with just a single triangle.
             vertices=[(0.0, 0.0, 0.0), (5.0, 0.0, 1.0), (0.0, 5.0, 1.0)],
             triangles=[(0, 1, 2)],
             materials=[None],
+            material_indices=[0],
             components=[],
             metadata=Metadata(),
             trianglesets=[]
@@ -83,46 +93,55 @@ class TestImport3MF(unittest.TestCase):
         """
         Tests reading an archive file that doesn't exist.
         """
-        self.assertEqual(
-            self.importer.read_archive("some/nonexistent_path"),
-            {},
-            "On an environment error, return an empty dictionary.")
+        with self.importer.read_archive("some/nonexistent_path") as result:
+            self.assertEqual(result, {}, "On an environment error, return an empty dictionary.")
 
     def test_read_archive_corrupt(self):
         """
         Tests reading a corrupt archive file.
         """
         archive_path = os.path.join(self.resources_path, "corrupt_archive.3mf")
-        self.assertEqual(self.importer.read_archive(archive_path), {}, "Corrupt files should return no files.")
+        with self.importer.read_archive(archive_path) as result:
+            self.assertEqual(result, {}, "Corrupt files should return no files.")
 
     def test_read_archive_empty(self):
         """
         Tests reading an archive file that doesn't have the default model file.
         """
         archive_path = os.path.join(self.resources_path, "empty_archive.zip")
-        self.assertEqual(
-            self.importer.read_archive(archive_path),
-            {},
-            "There are no files in this archive, so don't return any types.")
+        with self.importer.read_archive(archive_path) as result:
+            self.assertEqual(result, {}, "There are no files in this archive, so don't return any types.")
 
     def test_read_archive_default_position(self):
         """
         Tests reading an archive where the 3D model is in the default position.
         """
         archive_path = os.path.join(self.resources_path, "only_3dmodel_file.3mf")
-        result = self.importer.read_archive(archive_path)
-        self.assertIn(
-            MODEL_MIMETYPE,
-            result,
-            "There should be a listing for the MIME type of the model, since there was a model in this archive.")
-        model_files = result[MODEL_MIMETYPE]
-        self.assertEqual(len(model_files), 1, "There was just 1 model file.")
-
-        document = xml.etree.ElementTree.ElementTree(file=model_files[0])
-        self.assertEqual(
-            document.getroot().tag,
-            f"{{{MODEL_NAMESPACE}}}model",
-            "The file is an XML document with a <model> tag in the root.")
+        with self.importer.read_archive(archive_path) as result:
+            self.assertIn(
+                MODEL_MIMETYPE,
+                result,
+                "There should be a listing for the MIME type of the model, since there was a model in this archive.")
+            model_files = result[MODEL_MIMETYPE]
+            self.assertEqual(len(model_files), 1, "There was just 1 model file.")
+            self.assertEqual(model_files[0].name, MODEL_LOCATION, "The model file is in the default location.")
+
+            with model_files[0].archive.open(model_files[0].name) as f:
+                document = xml.etree.ElementTree.ElementTree(file=f)
+            self.assertEqual(
+                document.getroot().tag,
+                f"{{{MODEL_NAMESPACE}}}model",
+                "The file is an XML document with a <model> tag in the root.")
+
+    def test_read_archive_closed(self):
+        """
+        Tests that the archive is closed at the end of the context, and that its files are not kept open.
+        """
+        archive_path = os.path.join(self.resources_path, "only_3dmodel_file.3mf")
+        with self.importer.read_archive(archive_path) as result:
+            archive = result[MODEL_MIMETYPE][0].archive
+            self.assertIsNotNone(archive.fp, "The archive is open while in the context.")
+        self.assertIsNone(archive.fp, "The archive was closed at the end of the context.")
 
     def test_read_content_types_missing(self):
         """
@@ -131,16 +150,13 @@ class TestImport3MF(unittest.TestCase):
         archive = zipfile.ZipFile(self.black_hole, 'w')
         result = self.importer.read_content_types(archive)  # At this point the archive is completely empty.
 
-        # In order to verify if the regexes are correct, transform the output to list the regex pattern rather than the
-        # compiled unit.
-        result = [(regex.pattern, mimetype) for regex, mimetype in result]
-        self.assertIn(
-            (r".*\.rels", RELS_MIMETYPE),
-            result,
+        self.assertEqual(
+            result.extensions.get("rels"),
+            RELS_MIMETYPE,
             "The relationships MIME type must always be present for robustness, even if the file is broken.")
-        self.assertIn(
-            (r".*\.model", MODEL_MIMETYPE),
-            result,
+        self.assertEqual(
+            result.extensions.get("model"),
+            MODEL_MIMETYPE,
             "The model MIME type must always be present for robustness, even if the file is broken.")
 
     def test_read_content_types_invalid_xml(self):
@@ -154,16 +170,13 @@ class TestImport3MF(unittest.TestCase):
         # Not a valid XML document.
         result = self.importer.read_content_types(archive)
 
-        # In order to verify if the regexes are correct, transform the output to list the regex pattern rather than the
-        # compiled unit.
-        result = [(regex.pattern, mimetype) for regex, mimetype in result]
-        self.assertIn(
-            (r".*\.rels", RELS_MIMETYPE),
-            result,
+        self.assertEqual(
+            result.extensions.get("rels"),
+            RELS_MIMETYPE,
             "The relationships MIME type must always be present for robustness, even if the file is broken.")
-        self.assertIn(
-            (r".*\.model", MODEL_MIMETYPE),
-            result,
+        self.assertEqual(
+            result.extensions.get("model"),
+            MODEL_MIMETYPE,
             "The model MIME type must always be present for robustness, even if the file is broken.")
 
     def test_read_content_types_empty(self):
@@ -174,17 +187,14 @@ class TestImport3MF(unittest.TestCase):
         archive.writestr(CONTENT_TYPES_LOCATION, "")  # Completely empty file.
         result = self.importer.read_content_types(archive)
 
-        # In order to verify if the regexes are correct, transform the output to list the regex pattern rather than the
-        # compiled unit.
-        result = [(regex.pattern, mimetype) for regex, mimetype in result]
-        self.assertIn(
-            (r".*\.rels", RELS_MIMETYPE),
-            result,
+        self.assertEqual(
+            result.extensions.get("rels"),
+            RELS_MIMETYPE,
             "The relationships MIME type must always be present for robustness, "
             "even if they weren't present in the file.")
-        self.assertIn(
-            (r".*\.model", MODEL_MIMETYPE),
-            result,
+        self.assertEqual(
+            result.extensions.get("model"),
+            MODEL_MIMETYPE,
             "The model MIME type must always be present for robustness, even if they weren't present in the file.")
 
     def test_read_content_types_default(self):
@@ -199,19 +209,11 @@ class TestImport3MF(unittest.TestCase):
 </Types>""")  # The default contents of the [Content_Types].xml document, for just the core specification.
         result = self.importer.read_content_types(archive)
 
-        # In order to verify if the regexes are correct, transform the output to list the regex pattern rather than the
-        # compiled unit.
-        result = [(regex.pattern, mimetype) for regex, mimetype in result]
-        self.assertIn(
-            (r".*\.rels", RELS_MIMETYPE),
-            result,
-            "This is the relationships file type, which was specified in the file. "
-            "It doesn't matter that it's in the output twice.")
-        self.assertIn(
-            (r".*\.model", MODEL_MIMETYPE),
-            result,
-            "This is the model file type, which was specified in the file. "
-            "It doesn't matter that it's in the output twice.")
+        self.assertEqual(
+            result.extensions,
+            {"rels": RELS_MIMETYPE, "model": MODEL_MIMETYPE},
+            "These are the file types that were specified in the file.")
+        self.assertEqual(result.overrides, {}, "There were no overrides in the file.")
 
     def test_read_content_types_custom_defaults(self):
         """
@@ -221,27 +223,17 @@ class TestImport3MF(unittest.TestCase):
         archive.writestr(CONTENT_TYPES_LOCATION, """<?xml version="1.0" encoding="UTF-8"?>
 <Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">
     <Default Extension="txt" ContentType="text/plain" />
+    <Default Extension="rels" ContentType="text/relations" />
+    <Default Extension="txt" ContentType="text/ignored" />
     <Override PartName="/path/to/file.jpg" ContentType="image/thumbnail" />
-</Types>""")  # A customized content types specification, with one default and one override.
+</Types>""")  # A customized content types specification, with three defaults and one override.
         result = self.importer.read_content_types(archive)
 
-        # In order to verify if the regexes are correct, transform the output to list the regex pattern rather than the
-        # compiled unit.
-        result = [(regex.pattern, mimetype) for regex, mimetype in result]
-        # If this throws a ValueError, the custom default was not parsed properly.
-        custom_index = result.index((r".*\.txt", "text/plain"))
-        rels_index = result.index((r".*\.rels", RELS_MIMETYPE))
-        model_index = result.index((r".*\.model", MODEL_MIMETYPE))
-        self.assertLess(
-            custom_index,
-            rels_index,
-            "Customized defaults must have higher priority than the fallbacks that were added "
-            "in case of a corrupt [Content_Types].xml file.")
-        self.assertLess(
-            custom_index,
-            model_index,
-            "Customized defaults must have higher priority than the fallbacks that were added "
-            "in case of a corrupt [Content_Types].xml file.")
+        self.assertEqual(
+            list(result.extensions.items()),
+            [("txt", "text/plain"), ("rels", "text/relations"), ("model", MODEL_MIMETYPE)],
+            "Customized defaults must have higher priority than the fallbacks that were added in case of a corrupt "
+            "[Content_Types].xml file, and the first definition of each extension wins.")
 
     def test_read_content_types_custom_overrides(self):
         """
@@ -252,27 +244,21 @@ class TestImport3MF(unittest.TestCase):
 <Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">
     <Default Extension="txt" ContentType="text/plain" />
     <Override PartName="/path/to/file.jpg" ContentType="image/thumbnail" />
+    <Override PartName="/path/to/file.jpg" ContentType="image/ignored" />
 </Types>""")  # A customized content types specification, with one default and one override.
         result = self.importer.read_content_types(archive)
 
-        # In order to verify if the regexes are correct, transform the output to list the regex pattern rather than the
-        # compiled unit.
-        result = [(regex.pattern, mimetype) for regex, mimetype in result]
-        # If this throws a ValueError, the custom override was not parsed properly.
-        override_index = result.index((r"/path/to/file\.jpg", "image/thumbnail"))
-        default_index = result.index((r".*\.txt", "text/plain"))
-        rels_index = result.index((r".*\.rels", RELS_MIMETYPE))
-        model_index = result.index((r".*\.model", MODEL_MIMETYPE))
-        self.assertLess(override_index, default_index, "The overrides must have higher priority than the defaults.")
-        self.assertLess(override_index, rels_index, "The overrides must have higher priority than the fallbacks.")
-        self.assertLess(override_index, model_index, "The overrides must have higher priority than the fallbacks.")
+        self.assertEqual(
+            result.overrides,
+            {"path/to/file.jpg": "image/thumbnail"},
+            "The override is listed by its path in the archive, and the first override of a path wins.")
 
     def test_assign_content_types_empty(self):
         """
         Tests assigning content types to an empty archive.
         """
         archive = zipfile.ZipFile(self.black_hole, 'w')
-        content_types = [(re.compile(r".*\.txt"), "text/plain")]
+        content_types = io_mesh_3mf.import_3mf.ContentTypeTable(overrides={}, extensions={"txt": "text/plain"})
         result = self.importer.assign_content_types(archive, content_types)
 
         self.assertEqual(result, {}, "There are no files in the archive to assign a content type.")
@@ -283,7 +269,7 @@ class TestImport3MF(unittest.TestCase):
         """
         archive = zipfile.ZipFile(self.black_hole, 'w')
         archive.writestr(CONTENT_TYPES_LOCATION, "")  # Contents of the file don't matter for this test.
-        content_types = [(re.compile(r".*\.txt"), "text/plain")]
+        content_types = io_mesh_3mf.import_3mf.ContentTypeTable(overrides={}, extensions={"xml": "text/xml"})
         result = self.importer.assign_content_types(archive, content_types)
 
         self.assertEqual(
@@ -298,10 +284,12 @@ class TestImport3MF(unittest.TestCase):
         archive = zipfile.ZipFile(self.black_hole, "w")
         archive.writestr("some_directory/file.txt", "Those are 3 MF'ing nice models!")
         archive.writestr("other_directory/file.txt", "Are you suggesting that coconuts migrate?")
-        content_types = [
-            (re.compile(r"some_directory/file\.txt"), "text/plain"),
-            (re.compile(r"other_directory/file\.txt"), "plain/wrong")
-        ]
+        content_types = io_mesh_3mf.import_3mf.ContentTypeTable(
+            overrides={
+                "some_directory/file.txt": "text/plain",
+                "other_directory/file.txt": "plain/wrong"
+            },
+            extensions={})
 
         result = self.importer.assign_content_types(archive, content_types)
         expected_result = {
@@ -319,45 +307,309 @@ class TestImport3MF(unittest.TestCase):
         archive.writestr("some_directory/file.txt", "I fart in your general direction.")
         archive.writestr("insult.txt", "Your mother was a hamster and your father smelt of elderberries.")
         archive.writestr("what.md", "There's nothing wrong with you that an expensive operation can't prolong.")
-        content_types = [
-            (re.compile(r".*\.txt"), "text/plain"),
-            (re.compile(r".*\.md"), "text/markdown")
-        ]
+        archive.writestr("unknown.png", "I'm not dead yet!")
+        content_types = io_mesh_3mf.import_3mf.ContentTypeTable(
+            overrides={},
+            extensions={"txt": "text/plain", "md": "text/markdown"})
 
         result = self.importer.assign_content_types(archive, content_types)
         expected_result = {
             "some_directory/file.txt": "text/plain",
             "insult.txt": "text/plain",
-            "what.md": "text/markdown"
+            "what.md": "text/markdown",
+            "unknown.png": ""
         }
 
-        self.assertEqual(result, expected_result, "There are two .txt files and one .md file.")
+        self.assertEqual(result, expected_result, "There are two .txt files, one .md file and an unknown file.")
 
     def test_assign_content_types_priority(self):
         """
-        Tests whether the priority in the content types list is honoured.
+        Tests whether the priority in the content types table is honoured.
         """
         archive = zipfile.ZipFile(self.black_hole, "w")
         archive.writestr(
             "some_directory/file.txt",
             "As the plane lands in Glasgow, passengers are reminded to set their watches back 25 years.")
-        content_types = [
-            (re.compile(r".*\.txt"), "First type"),
-            (re.compile(r"some_directory/file.txt"), "Second type")
-        ]
+        archive.writestr("archive.tar.gz", "Nobody expects the Spanish Inquisition!")
+        content_types = io_mesh_3mf.import_3mf.ContentTypeTable(
+            overrides={"some_directory/file.txt": "Override type"},
+            extensions={"txt": "Extension type", "gz": "Compressed type", "tar.gz": "Tarball type"})
 
         result = self.importer.assign_content_types(archive, content_types)
         self.assertEqual(
             result,
-            {"some_directory/file.txt": "First type"},
-            "The first type was first in the list of content types, so that takes priority.")
+            {"some_directory/file.txt": "Override type", "archive.tar.gz": "Compressed type"},
+            "Overrides take priority over extensions, and earlier extensions over later ones.")
 
-        content_types.reverse()  # Reverse the priority. See if it's any different.
+        content_types = io_mesh_3mf.import_3mf.ContentTypeTable(
+            overrides={},
+            extensions={"tar.gz": "Tarball type", "gz": "Compressed type", "txt": "Extension type"})
         result = self.importer.assign_content_types(archive, content_types)
         self.assertEqual(
             result,
-            {"some_directory/file.txt": "Second type"},
-            "Now that the priority is reversed, the second type has highest priority.")
+            {"some_directory/file.txt": "Extension type", "archive.tar.gz": "Tarball type"},
+            "Now that the priority is reversed, the longer extension has highest priority.")
+
+    def test_read_model_resources(self):
+        """
+        Tests reading the resources of a document while streaming through it.
+        """
+        model_file = io.BytesIO(f"""<?xml version="1.0" encoding="UTF-8"?>
+            <model xmlns="{MODEL_NAMESPACE}" unit="centimeter">
+                <metadata name="Title">Streamed</metadata>
+                <resources>
+                    <basematerials id="1"><base name="Red" displaycolor="#FF0000" /></basematerials>
+                    <object id="2" pid="1" pindex="0">
+                        <mesh>
+                            <vertices>
+                                <vertex x="0" y="0" z="0" /><vertex x="1" y="0" z="0" /><vertex x="0" y="1" z="0" />
+                            </vertices>
+                            <triangles><triangle v1="0" v2="1" v3="2" /></triangles>
+                        </mesh>
+                    </object>
+                </resources>
+                <build><item objectid="2" /></build>
+            </model>""".encode("UTF-8"))
+
+        root = self.importer.read_model(model_file)
+
+        self.assertEqual(
+            self.importer.resource_materials,
+            {"1": {0: io_mesh_3mf.import_3mf.ResourceMaterial(name="Red", color=(1.0, 0.0, 0.0, 1.0))}},
+            "The material group was read from the document.")
+        self.assertIn("2", self.importer.resource_objects, "The object was read from the document.")
+        resource_object = self.importer.resource_objects["2"]
+        self.assertEqual(len(resource_object.vertices), 3, "The object has three vertices.")
+        self.assertEqual(len(resource_object.triangles), 1, "The object has one triangle.")
+        self.assertEqual(
+            resource_object.materials[0],
+            self.importer.resource_materials["1"][0],
+            "The object refers to the material group that was defined before it in the document.")
+
+        self.assertEqual(root.attrib["unit"], "centimeter", "The attributes of the root must still be available.")
+        self.assertEqual(
+            len(list(root.iterfind("./3mf:resources/*", MODEL_NAMESPACES))),
+            0,
+            "The resources must have been discarded from the tree after they were read.")
+        self.assertEqual(
+            len(list(root.iterfind("./3mf:build/3mf:item", MODEL_NAMESPACES))),
+            1,
+            "The build items must remain in the tree to be built later.")
+        self.assertEqual(
+            len(list(root.iterfind("./3mf:metadata", MODEL_NAMESPACES))),
+            1,
+            "The metadata must remain in the tree to be read later.")
+
+    def test_read_model_malformed(self):
+        """
+        Tests reading a document that is not well-formed XML.
+        """
+        model_file = io.BytesIO(f"<model xmlns='{MODEL_NAMESPACE}'><resources>".encode("UTF-8"))  # Never closed.
+
+        with self.assertRaises(xml.etree.ElementTree.ParseError):
+            self.importer.read_model(model_file)
+
+    def test_read_model_scanned(self):
+        """
+        Tests that the vertices and triangles of a mesh are scanned into arrays while reading the document.
+        """
+        model_file = io.BytesIO(f"""<?xml version="1.0" encoding="UTF-8"?>
+            <model xmlns="{MODEL_NAMESPACE}">
+                <resources>
+                    <object id="1">
+                        <mesh>
+                            <vertices>
+                                <vertex x="0" y="0" z="0" /><vertex x="1" y="0" z="0" /><vertex x="0" y="1" z="0" />
+                            </vertices>
+                            <triangles><triangle v1="0" v2="1" v3="2" /></triangles>
+                        </mesh>
+                    </object>
+                </resources>
+            </model>""".encode("UTF-8"))
+
+        self.importer.read_model(model_file)
+
+        resource_object = self.importer.resource_objects["1"]
+        self.assertIsInstance(resource_object.vertices, numpy.ndarray, "The vertices were scanned into an array.")
+        self.assertEqual(resource_object.vertices.dtype, numpy.float32, "Vertex coordinates are single-precision.")
+        self.assertEqual(resource_object.vertices.tolist(), [[0, 0, 0], [1, 0, 0], [0, 1, 0]])
+        self.assertIsInstance(resource_object.triangles, numpy.ndarray, "The triangles were scanned into an array.")
+        self.assertEqual(resource_object.triangles.dtype, numpy.int32, "Validated indices are stored as in Blender.")
+        self.assertEqual(resource_object.triangles.tolist(), [[0, 1, 2]])
+        self.assertEqual(self.importer.scanned_blocks, {}, "All scanned blocks were used up by the objects.")
+
+    def test_read_model_scan_fallback(self):
+        """
+        Tests that blocks which can't be scanned are still read element by element.
+        """
+        model_file = io.BytesIO(f"""<?xml version="1.0" encoding="UTF-8"?>
+            <model xmlns="{MODEL_NAMESPACE}">
+                <resources>
+                    <object id="1">
+                        <mesh>
+                            <vertices>
+                                <!-- Comments can't be scanned. -->
+                                <vertex x="0" y="0" z="0" /><vertex x="1" y="0" z="0" /><vertex x="0" y="1" z="0" />
+                            </vertices>
+                            <triangles><triangle v1="0" v2="1" v3="-2" /><triangle v1="0" v2="1" v3="2" /></triangles>
+                        </mesh>
+                    </object>
+                </resources>
+            </model>""".encode("UTF-8"))
+
+        self.importer.read_model(model_file)
+
+        resource_object = self.importer.resource_objects["1"]
+        self.assertEqual(resource_object.vertices.tolist(), [[0, 0, 0], [1, 0, 0], [0, 1, 0]])
+        self.assertEqual(
+            resource_object.triangles.tolist(),
+            [[0, 1, 2]],
+            "The triangle with a negative index is left out by the normal reading.")
+
+    def test_scan_vertices(self):
+        """
+        Tests scanning a block of vertices.
+        """
+        block = b'\n  <vertex x="1" y="2.5" z="-3e2"/>\n\t<vertex z="6" y="5" x="4" />\n'
+        self.assertEqual(
+            self.importer.scan_vertices(block).tolist(),
+            [[1, 2.5, -300], [4, 5, 6]],
+            "The order of the attributes doesn't matter.")
+
+    def test_scan_vertices_unsupported(self):
+        """
+        Tests scanning blocks of vertices that should be read element by element instead.
+        """
+        blocks = {
+            b'<vertex x="1" y="2"/>': "Missing coordinate.",
+            b'<vertex x="1" y="2" z="3" w="4"/>': "Unknown attribute.",
+            b'<vertex x="1" y="2" z="3" x="4"/>': "Duplicate attribute.",
+            b'<vertex x="1" y="2" z="three"/>': "Not a number.",
+            b'<vertex x="1" y="2" z=""/>': "Empty value.",
+            b"<vertex x='1' y='2' z='3'/>": "Single quotes.",
+            b'<vertex x="1" y="2" z="3"></vertex>': "Not an empty element.",
+            b'<vertexx x="1" y="2" z="3"/>': "Different element name.",
+            b'<vertex x="1" y="2" z="3"/> text': "Text between the elements.",
+            b'<vertex x="1" y="2" z="3"/><!-- Comment -->': "Comment.",
+            b'<vertex x="1" y="2" z="&#51;"/>': "Character reference.",
+            b'<vertex x="1"y="2" z="3"/>': "No whitespace between attributes.",
+            b'<vertex x = "1" y="2" z="3"/>': "Whitespace around the equals sign.",
+            b'': "No vertices.",
+        }
+        for block, reason in blocks.items():
+            with self.subTest(block=block):
+                self.assertIsNone(self.importer.scan_vertices(block), reason)
+
+    def test_scan_triangles(self):
+        """
+        Tests scanning a block of triangles with material properties.
+        """
+        block = b'<triangle v1="0" v2="1" v3="2"/><triangle v1="3" v2="4" v3="5" pid="7" p1="1" p2="2" p3="3"/>' \
+                b'<triangle p1="4" v3="8" v2="7" v1="6"/>'
+        scanned = self.importer.scan_triangles(block)
+
+        self.assertEqual(scanned.vertices.tolist(), [[0, 1, 2], [3, 4, 5], [6, 7, 8]])
+        self.assertEqual(scanned.p1.tolist(), [-1, 1, 4], "The first triangle doesn't specify a material index.")
+        self.assertEqual(scanned.pids, ["7"], "There is only one distinct material group.")
+        self.assertEqual(scanned.pid_index.tolist(), [-1, 0, -1], "Only the second triangle specifies a group.")
+
+    def test_scan_triangles_unsupported(self):
+        """
+        Tests scanning blocks of triangles that should be read element by element instead.
+        """
+        blocks = {
+            b'<triangle v1="0" v2="1"/>': "Missing vertex.",
+            b'<triangle v1="0" v2="1" v3="-2"/>': "Negative index.",
+            b'<triangle v1="0" v2="1" v3="+2"/>': "Sign.",
+            b'<triangle v1="0" v2="1" v3="2.0"/>': "Not an integer.",
+            b'<triangle v1="0" v2="1" v3="4294967296"/>': "Index too large.",
+            b'<triangle v1="0" v2="1" v3="2" p1="red"/>': "Material index not an integer.",
+            b'<triangle v1="0" v2="1" v3="2" p1="1" p1="2"/>': "Duplicate attribute.",
+            b'<triangle v1="0" v2="1" v3="2" color="red"/>': "Unknown attribute.",
+        }
+        for block, reason in blocks.items():
+            with self.subTest(block=block):
+                self.assertIsNone(self.importer.scan_triangles(block), reason)
+
+    def test_read_file(self):
+        """
+        Tests reading all documents of an archive at once, with a reader that is separate from the operator.
+        """
+        archive_path = os.path.join(self.resources_path, "only_3dmodel_file.3mf")
+        reader = io_mesh_3mf.import_3mf.ModelReader()
+        archive, files_by_content_type, documents = reader.read_file(archive_path)
+
+        with archive:
+            self.assertIsNotNone(
+                files_by_content_type[MODEL_MIMETYPE][0].archive.fp,
+                "The archive stays open, so that other files in it can still be read.")
+        self.assertIsNone(files_by_content_type[MODEL_MIMETYPE][0].archive.fp, "Closing the stack closes the archive.")
+        self.assertIn(MODEL_MIMETYPE, files_by_content_type, "The files in the archive are listed too.")
+        self.assertEqual(len(documents), 1, "There was just 1 model file.")
+        self.assertEqual(
+            documents[0].root.tag,
+            f"{{{MODEL_NAMESPACE}}}model",
+            "The root of the document is the <model> tag.")
+        self.assertIs(
+            documents[0].resource_objects,
+            reader.resource_objects,
+            "The resources of the last document read are the ones stored in the reader.")
+
+    def test_read_documents_malformed(self):
+        """
+        Tests reading an archive with a document that is not well-formed XML.
+        """
+        archive = zipfile.ZipFile(self.black_hole, "w")
+        archive.writestr(MODEL_LOCATION, f"<model xmlns='{MODEL_NAMESPACE}'><resources>")  # Never closed.
+        archive.close()
+        self.black_hole.seek(0)
+
+        with self.importer.read_archive(self.black_hole) as files_by_content_type:
+            documents = self.importer.read_documents(files_by_content_type, "malformed.3mf")
+        self.assertEqual(len(files_by_content_type[MODEL_MIMETYPE]), 1, "The file is still in the archive.")
+        self.assertEqual(documents, [], "The malformed document is skipped.")
+
+    def test_read_files_order(self):
+        """
+        Tests that the archives read in parallel are given back in the same order as they were requested.
+        """
+        paths = [f"file{index}.3mf" for index in range(10)]
+
+        def read_file(reader, path):  # Give back the path as the archive, to identify it.
+            return path, {}, []
+        with unittest.mock.patch("io_mesh_3mf.import_3mf.ModelReader.read_file", read_file):
+            results = list(self.importer.read_files(paths))
+
+        self.assertEqual(
+            results,
+            [(path, path, {}, []) for path in paths],
+            "Each path is given back together with its own results, in order.")
+
+    def test_read_files_aborted(self):
+        """
+        Tests that archives which were read ahead are closed if the import stops early.
+        """
+        paths = [f"file{index}.3mf" for index in range(10)]
+        archives = {path: unittest.mock.MagicMock() for path in paths}
+
+        read_paths = []
+
+        def read_file(reader, path):
+            read_paths.append(path)
+            return archives[path], {}, []
+        with unittest.mock.patch("io_mesh_3mf.import_3mf.ModelReader.read_file", read_file), \
+                unittest.mock.patch("os.cpu_count", return_value=2):  # Only read ahead a little bit.
+            results = self.importer.read_files(paths)
+            next(results)  # Take the first archive, which the consumer is then responsible for.
+            results.close()
+
+        self.assertLess(len(read_paths), len(paths), "Not all archives are read ahead.")
+        archives[paths[0]].close.assert_not_called()
+        for path in paths[1:]:
+            if path in read_paths:
+                archives[path].close.assert_called_once_with()
+            else:
+                archives[path].close.assert_not_called()
 
     def test_is_supported_true(self):
         """
@@ -699,7 +951,7 @@ class TestImport3MF(unittest.TestCase):
         """
         root = xml.etree.ElementTree.Element(f"{{{MODEL_NAMESPACE}}}model")
 
-        self.importer.read_materials(root)
+        self.importer.read_model(io.BytesIO(xml.etree.ElementTree.tostring(root)))
 
         self.assertDictEqual(
             self.importer.resource_materials,
@@ -717,7 +969,7 @@ class TestImport3MF(unittest.TestCase):
             f"{{{MODEL_NAMESPACE}}}basematerials",
             attrib={"id": "material-set"})
 
-        self.importer.read_materials(root)
+        self.importer.read_model(io.BytesIO(xml.etree.ElementTree.tostring(root)))
 
         self.assertDictEqual(
             self.importer.resource_materials,
@@ -738,7 +990,7 @@ class TestImport3MF(unittest.TestCase):
             attrib={"id": "material-set"})
         xml.etree.ElementTree.SubElement(basematerials, f"{{{MODEL_NAMESPACE}}}base")
 
-        self.importer.read_materials(root)
+        self.importer.read_model(io.BytesIO(xml.etree.ElementTree.tostring(root)))
 
         ground_truth = {
             "material-set": {
@@ -763,7 +1015,7 @@ class TestImport3MF(unittest.TestCase):
         xml.etree.ElementTree.SubElement(basematerials, f"{{{MODEL_NAMESPACE}}}base", attrib={"name": "PLA"})
         xml.etree.ElementTree.SubElement(basematerials, f"{{{MODEL_NAMESPACE}}}base", attrib={"name": "BLA"})
 
-        self.importer.read_materials(root)
+        self.importer.read_model(io.BytesIO(xml.etree.ElementTree.tostring(root)))
 
         ground_truth = {
             "material-set": {
@@ -802,12 +1054,12 @@ class TestImport3MF(unittest.TestCase):
                     resources,
                     f"{{{MODEL_NAMESPACE}}}basematerials",
                     attrib={"id": "material-set"})
-                xml.etree.ElementTree.SubElement(basematerials, f"{{{MODEL_NAMESPACE}}}base", attrib={
-                    "displaycolor": threemf_color
-                })
+                base = xml.etree.ElementTree.SubElement(basematerials, f"{{{MODEL_NAMESPACE}}}base")
+                if threemf_color is not None:  # Leave the attribute out entirely to test a missing color.
+                    base.attrib["displaycolor"] = threemf_color
 
                 self.importer.resource_materials = {}
-                self.importer.read_materials(root)
+                self.importer.read_model(io.BytesIO(xml.etree.ElementTree.tostring(root)))
 
                 ground_truth = {
                     "material-set": {
@@ -826,7 +1078,7 @@ class TestImport3MF(unittest.TestCase):
         # No ID in attrib!
         xml.etree.ElementTree.SubElement(basematerials, f"{{{MODEL_NAMESPACE}}}base")
 
-        self.importer.read_materials(root)
+        self.importer.read_model(io.BytesIO(xml.etree.ElementTree.tostring(root)))
 
         self.assertDictEqual(
             self.importer.resource_materials,
@@ -852,7 +1104,7 @@ class TestImport3MF(unittest.TestCase):
             attrib={"id": "set2"})
         xml.etree.ElementTree.SubElement(base2, f"{{{MODEL_NAMESPACE}}}base")
 
-        self.importer.read_materials(root)
+        self.importer.read_model(io.BytesIO(xml.etree.ElementTree.tostring(root)))
 
         ground_truth = {
             "set1": {
@@ -891,7 +1143,7 @@ class TestImport3MF(unittest.TestCase):
             f"{{{MODEL_NAMESPACE}}}base",
             attrib={"name": "Second material"})
 
-        self.importer.read_materials(root)
+        self.importer.read_model(io.BytesIO(xml.etree.ElementTree.tostring(root)))
 
         # The result may be either one of the materials. Both are valid results.
         ground_truth = [  # List of options which are allowed.
@@ -1003,7 +1255,7 @@ class TestImport3MF(unittest.TestCase):
         object_node = xml.etree.ElementTree.Element(f"{{{MODEL_NAMESPACE}}}object")
         xml.etree.ElementTree.SubElement(object_node, f"{{{MODEL_NAMESPACE}}}mesh")
 
-        triangles, _ = self.importer.read_triangles(object_node, None, "")
+        triangles, _, _ = self.importer.read_triangles(object_node, None, "")
         self.assertListEqual(
             triangles,
             [],
@@ -1017,7 +1269,7 @@ class TestImport3MF(unittest.TestCase):
         mesh_node = xml.etree.ElementTree.SubElement(object_node, f"{{{MODEL_NAMESPACE}}}mesh")
         xml.etree.ElementTree.SubElement(mesh_node, f"{{{MODEL_NAMESPACE}}}triangles")
 
-        triangles, _ = self.importer.read_triangles(object_node, None, "")
+        triangles, _, _ = self.importer.read_triangles(object_node, None, "")
         self.assertListEqual(
             triangles,
             [],
@@ -1040,7 +1292,7 @@ class TestImport3MF(unittest.TestCase):
             triangle_node.attrib["v2"] = str(triangle[1])
             triangle_node.attrib["v3"] = str(triangle[2])
 
-        reconstructed_triangles, _ = self.importer.read_triangles(object_node, None, "")
+        reconstructed_triangles, _, _ = self.importer.read_triangles(object_node, None, "")
         self.assertListEqual(
             reconstructed_triangles,
             triangles,
@@ -1060,7 +1312,7 @@ class TestImport3MF(unittest.TestCase):
         triangle_node.attrib["v2"] = "2"
         # Leave out v3. It's missing then.
 
-        triangles, _ = self.importer.read_triangles(object_node, None, "")
+        triangles, _, _ = self.importer.read_triangles(object_node, None, "")
         self.assertListEqual(triangles, [], "The only triangle was invalid, so the output should have no triangles.")
 
     def test_read_triangles_broken_vertex(self):
@@ -1092,7 +1344,7 @@ class TestImport3MF(unittest.TestCase):
         # Doesn't parse as integer! Should make the triangle go missing.
         invalid_index_triangle_node.attrib["v3"] = "doodie"
 
-        triangles, _ = self.importer.read_triangles(object_node, None, "")
+        triangles, _, _ = self.importer.read_triangles(object_node, None, "")
         self.assertListEqual(triangles, [], "All triangles are invalid, so the output should have no triangles.")
 
     def test_read_triangles_default_material(self):
@@ -1112,10 +1364,10 @@ class TestImport3MF(unittest.TestCase):
         default_material = io_mesh_3mf.import_3mf.ResourceMaterial(name="PLA", color=None)
         self.importer.resource_materials["material-set"] = {1: default_material}
 
-        _, materials = self.importer.read_triangles(object_node, default_material, "")
+        _, materials, material_indices = self.importer.read_triangles(object_node, default_material, "")
 
         self.assertListEqual(
-            materials,
+            [materials[index] for index in material_indices],
             [default_material],
             "Since the triangle doesn't specify any material or index, it should use the default material.")
 
@@ -1140,10 +1392,10 @@ class TestImport3MF(unittest.TestCase):
             1: default_material
         }
 
-        _, materials = self.importer.read_triangles(object_node, default_material, "")
+        _, materials, material_indices = self.importer.read_triangles(object_node, default_material, "")
 
         self.assertListEqual(
-            materials,
+            [materials[index] for index in material_indices],
             [default_material],
             "It specifies a PID but not an index, so it should still use the default material "
             "(even if that material is not in the specified group.")
@@ -1171,10 +1423,10 @@ class TestImport3MF(unittest.TestCase):
         }
 
         # Supply a default PID. It should use the indices from the triangles to reference to this PID.
-        _, materials = self.importer.read_triangles(object_node, default_material, "material-set")
+        _, materials, material_indices = self.importer.read_triangles(object_node, default_material, "material-set")
 
         self.assertListEqual(
-            materials,
+            [materials[index] for index in material_indices],
             [correct_material],
             "It specifies an index but not a PID, so it should use the PID from the object.")
 
@@ -1204,10 +1456,10 @@ class TestImport3MF(unittest.TestCase):
         }
 
         # Supply a default PID. It should use the indices from the triangles to reference to this PID.
-        _, materials = self.importer.read_triangles(object_node, default_material, "material-set")
+        _, materials, material_indices = self.importer.read_triangles(object_node, default_material, "material-set")
 
         self.assertListEqual(
-            materials,
+            [materials[index] for index in material_indices],
             [correct_material],
             "The material PID is overridden so it should use a different group of materials now.")
 
@@ -1232,10 +1484,10 @@ class TestImport3MF(unittest.TestCase):
         }
 
         # Supply a default PID. It should use the indices from the triangles to reference to this PID.
-        _, materials = self.importer.read_triangles(object_node, default_material, "material-set")
+        _, materials, material_indices = self.importer.read_triangles(object_node, default_material, "material-set")
 
         self.assertListEqual(
-            materials,
+            [materials[index] for index in material_indices],
             [default_material],
             "The material index in p1 was way out of range for the 'material-set' group of materials, "
             "so it should use the default instead.")
@@ -1261,13 +1513,126 @@ class TestImport3MF(unittest.TestCase):
         }
 
         # Supply a default PID. It should use the indices from the triangles to reference to this PID.
-        _, materials = self.importer.read_triangles(object_node, default_material, "material-set")
+        _, materials, material_indices = self.importer.read_triangles(object_node, default_material, "material-set")
 
         self.assertListEqual(
-            materials,
+            [materials[index] for index in material_indices],
             [default_material],
             "The material index in p1 was not integer, so it should revert to the default.")
 
+    def test_read_triangles_scanned(self):
+        """
+        Tests reading the materials of triangles that were scanned while parsing the document.
+        """
+        object_node = xml.etree.ElementTree.Element(f"{{{MODEL_NAMESPACE}}}object")
+        mesh_node = xml.etree.ElementTree.SubElement(object_node, f"{{{MODEL_NAMESPACE}}}mesh")
+        triangles_node = xml.etree.ElementTree.SubElement(mesh_node, f"{{{MODEL_NAMESPACE}}}triangles")
+        self.importer.scanned_blocks[triangles_node] = self.importer.scan_triangles(
+            b'<triangle v1="0" v2="1" v3="2" p1="1"/>'  # Index from the object's group.
+            b'<triangle v1="0" v2="1" v3="2"/>'  # Default material of the object.
+            b'<triangle v1="0" v2="1" v3="2" pid="alternative" p1="0"/>'  # Overrides the group.
+            b'<triangle v1="0" v2="1" v3="2" p1="999"/>'  # Out of range, so it gets the default material.
+            b'<triangle v1="0" v2="1" v3="2" p1="1"/>')
+        default_material = io_mesh_3mf.import_3mf.ResourceMaterial(name="PLA", color=None)
+        group_material = io_mesh_3mf.import_3mf.ResourceMaterial(name="BLA", color=None)
+        alternative_material = io_mesh_3mf.import_3mf.ResourceMaterial(name="CLA", color=None)
+        self.importer.resource_materials = {
+            "material-set": {0: default_material, 1: group_material},
+            "alternative": {0: alternative_material}
+        }
+
+        triangles, materials, material_indices = self.importer.read_triangles(
+            object_node, default_material, "material-set")
+
+        self.assertEqual(triangles.tolist(), [[0, 1, 2]] * 5, "The scanned triangles are used.")
+        self.assertListEqual(
+            materials,
+            [group_material, default_material, alternative_material],
+            "Each distinct material is listed once, in order of appearance.")
+        self.assertListEqual(material_indices.tolist(), [0, 1, 2, 1, 0])
+        self.assertEqual(self.importer.scanned_blocks, {}, "The scanned block is used up.")
+
+    def test_read_trianglesets(self):
+        """
+        Tests reading triangle sets, which keep their ranges as ranges.
+        """
+        object_node = xml.etree.ElementTree.Element(f"{{{MODEL_NAMESPACE}}}object")
+        mesh_node = xml.etree.ElementTree.SubElement(object_node, f"{{{MODEL_NAMESPACE}}}mesh")
+        trianglesets_node = xml.etree.ElementTree.SubElement(mesh_node, f"{{{TRIANGLESETS_NAMESPACE}}}trianglesets")
+        triangleset_node = xml.etree.ElementTree.SubElement(
+            trianglesets_node,
+            f"{{{TRIANGLESETS_NAMESPACE}}}triangleset",
+            {"name": "Red", "identifier": "ts_0"})
+        xml.etree.ElementTree.SubElement(triangleset_node, f"{{{TRIANGLESETS_NAMESPACE}}}ref", {"index": "7"})
+        xml.etree.ElementTree.SubElement(triangleset_node, f"{{{TRIANGLESETS_NAMESPACE}}}refrange",
+                                         {"startindex": "0", "endindex": "999999"})
+        xml.etree.ElementTree.SubElement(triangleset_node, f"{{{TRIANGLESETS_NAMESPACE}}}refrange",
+                                         {"startindex": "5", "endindex": "4"})  # Invalid, so skipped.
+        unnamed_node = xml.etree.ElementTree.SubElement(trianglesets_node, f"{{{TRIANGLESETS_NAMESPACE}}}triangleset")
+        xml.etree.ElementTree.SubElement(unnamed_node, f"{{{TRIANGLESETS_NAMESPACE}}}ref", {"index": "1"})
+
+        trianglesets = self.importer.read_trianglesets(object_node)
+
+        self.assertEqual(len(trianglesets), 1, "The triangle set without name and identifier must be skipped.")
+        self.assertEqual(trianglesets[0].name, "Red")
+        self.assertEqual(trianglesets[0].identifier, "ts_0")
+        self.assertListEqual(trianglesets[0].ranges.tolist(), [[0, 999999]], "The range must not be expanded.")
+        self.assertListEqual(trianglesets[0].refs.tolist(), [7])
+
+    def test_validate_mesh(self):
+        """
+        Tests removing triangles that can't be built, and the vertices that are no longer used.
+        """
+        vertices = [(0, 0, 0), (1, 0, 0), (0, 1, 0), (2, 0, 0), (9, 9, 9), (1, 1, 0)]  # Vertex 4 is never used.
+        triangles = [
+            (0, 1, 2),
+            (0, 1, 6),  # Vertex 6 doesn't exist.
+            (0, 1, 1),  # Uses the same vertex twice.
+            (0, 1, 3),  # All on one line.
+            (2, 0, 1),  # Same as the first, in different order.
+            (1, 5, 2)
+        ]
+        material_indices = [0, 1, 2, 3, 4, 5]
+        triangleset = io_mesh_3mf.import_3mf.TriangleSet(
+            name="Set", identifier="ts_0", ranges=numpy.array([[0, 2], [3, 5]]), refs=numpy.array([1, 5]))
+
+        vertices, triangles, material_indices, trianglesets = self.importer.validate_mesh(
+            "1", vertices, triangles, material_indices, [triangleset])
+
+        self.assertListEqual(vertices.tolist(), [[0, 0, 0], [1, 0, 0], [0, 1, 0], [1, 1, 0]])
+        self.assertListEqual(triangles.tolist(), [[0, 1, 2], [1, 3, 2]], "The vertices are renumbered.")
+        self.assertListEqual(material_indices.tolist(), [0, 5], "The materials of the removed triangles are removed.")
+        self.assertListEqual(trianglesets[0].ranges.tolist(), [[0, 0], [1, 1]], "Ranges shrink to what's left.")
+        self.assertListEqual(trianglesets[0].refs.tolist(), [1], "Removed triangles are removed from the set.")
+
+    def test_validate_mesh_valid(self):
+        """
+        Tests that a valid mesh stays the same.
+        """
+        vertices, triangles, material_indices, _ = self.importer.validate_mesh(
+            "1", [(0, 0, 0), (1, 0, 0), (0, 1, 0)], [(0, 1, 2), (0, 2, 1)], [0, 0], [])
+
+        self.assertListEqual(vertices.tolist(), [[0, 0, 0], [1, 0, 0], [0, 1, 0]])
+        self.assertListEqual(triangles.tolist(), [[0, 1, 2]], "The second triangle is the first one, flipped.")
+        self.assertListEqual(material_indices.tolist(), [0])
+
+    def test_validate_mesh_no_vertices(self):
+        """
+        Tests repairing a mesh that has triangles, but no vertices for them to refer to.
+        """
+        triangleset = io_mesh_3mf.import_3mf.TriangleSet(
+            name="Set", identifier="ts_0", ranges=numpy.array([[0, 1]]), refs=numpy.array([1]))
+
+        with self.assertLogs("io_mesh_3mf.import_3mf", level="WARNING"):
+            vertices, triangles, material_indices, trianglesets = self.importer.validate_mesh(
+                "1", [], [(0, 1, 2), (2, 1, 0)], [0, 0], [triangleset])
+
+        self.assertEqual(len(vertices), 0)
+        self.assertEqual(len(triangles), 0, "All triangles refer to vertices that don't exist.")
+        self.assertEqual(len(material_indices), 0)
+        self.assertListEqual(trianglesets[0].ranges.tolist(), [], "No triangles are left for the set.")
+        self.assertListEqual(trianglesets[0].refs.tolist(), [])
+
     def test_read_components_missing(self):
         """
         Tests reading components when the <components> element is missing.
@@ -1451,13 +1816,16 @@ class TestImport3MF(unittest.TestCase):
         self.importer.build_items(root, 1.0)
 
         expected_args_list = [
-            unittest.mock.call(self.importer.resource_objects["1"], mathutils.Matrix.Identity(4), Metadata(), ["1"]),
-            unittest.mock.call(self.importer.resource_objects["2"], mathutils.Matrix.Identity(4), Metadata(), ["2"]),
+            unittest.mock.call(
+                self.importer.resource_objects["1"], mathutils.Matrix.Identity(4), Metadata(), ["1"], item_index=1),
+            unittest.mock.call(
+                self.importer.resource_objects["2"], mathutils.Matrix.Identity(4), Metadata(), ["2"], item_index=2),
             unittest.mock.call(
                 self.importer.resource_objects["ananas"],
                 mathutils.Matrix.Identity(4),
                 Metadata(),
-                ["ananas"])
+                ["ananas"],
+                item_index=3)
         ]
         self.assertListEqual(
             self.importer.build_object.call_args_list,
@@ -1499,7 +1867,8 @@ class TestImport3MF(unittest.TestCase):
             self.single_triangle,
             mathutils.Matrix.Scale(2.5, 4),
             Metadata(),
-            ["1"])
+            ["1"],
+            item_index=1)
 
     def test_build_items_transformed(self):
         """
@@ -1524,7 +1893,8 @@ class TestImport3MF(unittest.TestCase):
             self.single_triangle,
             expected_transformation,
             Metadata(),
-            ["1"])
+            ["1"],
+            item_index=1)
 
     def test_build_items_metadata(self):
         """
@@ -1566,7 +1936,8 @@ class TestImport3MF(unittest.TestCase):
         self.importer.build_object.assert_called_once_with(
             self.single_triangle,
             mathutils.Matrix.Identity(4),
-            expected_metadata, ["1"])
+            expected_metadata, ["1"],
+            item_index=1)
 
     def test_build_object_mesh_data(self):
         """
@@ -1579,8 +1950,140 @@ class TestImport3MF(unittest.TestCase):
         # Now look whether the result is put correctly in the context.
         bpy.data.meshes.new.assert_called_once()  # Exactly one mesh must have been created.
         mesh_mock = bpy.data.meshes.new()  # This is the mock object that the code got back from the Blender API call.
-        # The mesh must be provided with correct vertex and triangle data.
-        mesh_mock.from_pydata.assert_called_once_with(self.single_triangle.vertices, [], self.single_triangle.triangles)
+        # The mesh must be provided with correct vertex and triangle data, in bulk.
+        mesh_mock.vertices.add.assert_called_once_with(3)
+        attribute, coordinates = mesh_mock.vertices.foreach_set.call_args[0]
+        self.assertEqual(attribute, "co", "The coordinates of the vertices must be set.")
+        self.assertEqual(coordinates.dtype, numpy.float32, "Coordinates must be provided as Blender stores them.")
+        self.assertListEqual(coordinates.tolist(), [0.0, 0.0, 0.0, 5.0, 0.0, 1.0, 0.0, 5.0, 1.0])
+        mesh_mock.loops.add.assert_called_once_with(3)
+        attribute, indices = mesh_mock.loops.foreach_set.call_args[0]
+        self.assertEqual(attribute, "vertex_index", "The loops must refer to the vertices of the triangle.")
+        self.assertEqual(indices.dtype, numpy.int32, "Indices must be provided as Blender stores them.")
+        self.assertListEqual(indices.tolist(), [0, 1, 2])
+        mesh_mock.polygons.add.assert_called_once_with(1)
+        attribute, loop_starts = mesh_mock.polygons.foreach_set.call_args[0]
+        self.assertEqual(attribute, "loop_start", "The faces must refer to the first loop of each triangle.")
+        self.assertListEqual(loop_starts.tolist(), [0])
+
+    def test_build_object_materials(self):
+        """
+        Tests assigning the materials of the triangles to the faces of the mesh.
+        """
+        self.importer.resource_to_material = {}
+        red = io_mesh_3mf.import_3mf.ResourceMaterial(name="Red", color=(1.0, 0.0, 0.0, 1.0))
+        blue = io_mesh_3mf.import_3mf.ResourceMaterial(name="Blue", color=(0.0, 0.0, 1.0, 1.0))
+        resource_object = io_mesh_3mf.import_3mf.ResourceObject(
+            vertices=[(0.0, 0.0, 0.0), (5.0, 0.0, 0.0), (0.0, 5.0, 0.0), (5.0, 5.0, 0.0)],
+            triangles=[(0, 1, 2), (1, 3, 2), (0, 3, 2), (0, 1, 3)],
+            materials=[blue, None, red],
+            material_indices=[0, 1, 2, 0],
+            components=[],
+            metadata=Metadata(),
+            trianglesets=[]
+        )
+        blue_material = unittest.mock.MagicMock()
+        red_material = unittest.mock.MagicMock()
+        bpy.data.materials.new.side_effect = [blue_material, red_material]
+
+        self.importer.build_object(resource_object, mathutils.Matrix.Identity(4), Metadata(), ["1"])
+
+        mesh_mock = bpy.data.meshes.new()
+        self.assertListEqual(
+            mesh_mock.materials.append.call_args_list,
+            [unittest.mock.call(blue_material), unittest.mock.call(red_material)],
+            "Each distinct material must be added to the mesh once, in order of appearance.")
+        material_index_calls = [call for call in mesh_mock.polygons.foreach_set.call_args_list
+                                if call[0][0] == "material_index"]
+        self.assertEqual(len(material_index_calls), 1, "The material indices must be set all at once.")
+        self.assertListEqual(
+            material_index_calls[0][0][1].tolist(),
+            [0, 0, 1, 0],
+            "Each face refers to the slot of its material. The face without material gets the first slot.")
+
+    def test_build_object_trianglesets(self):
+        """
+        Tests storing the triangle sets of a resource object as boolean face attributes.
+        """
+        resource_object = io_mesh_3mf.import_3mf.ResourceObject(
+            vertices=[(0.0, 0.0, 0.0), (5.0, 0.0, 0.0), (0.0, 5.0, 0.0), (5.0, 5.0, 0.0)],
+            triangles=[(0, 1, 2), (1, 3, 2), (0, 3, 2), (0, 1, 3), (1, 2, 3), (2, 1, 0)],
+            materials=[None],
+            material_indices=[0, 0, 0, 0, 0, 0],
+            components=[],
+            metadata=Metadata(),
+            trianglesets=[io_mesh_3mf.import_3mf.TriangleSet(
+                name="Top",
+                identifier="ts_0",
+                ranges=numpy.array([[1, 2], [4, 10]]),  # The second range extends beyond the mesh.
+                refs=numpy.array([0, 2, 20])
+            )]
+        )
+        mesh_mock = unittest.mock.MagicMock()
+        bpy.data.meshes.new.return_value = mesh_mock
+
+        self.importer.build_object(resource_object, mathutils.Matrix.Identity(4), Metadata(), ["1"])
+
+        mesh_mock.attributes.new.assert_called_once_with(name="ts_0", type="BOOLEAN", domain="FACE")
+        attribute_mock = mesh_mock.attributes.new.return_value
+        attribute_mock.data.foreach_set.assert_called_once()
+        name, values = attribute_mock.data.foreach_set.call_args[0]
+        self.assertEqual(name, "value")
+        self.assertListEqual(
+            values.tolist(),
+            [True, True, True, False, True, True],
+            "The faces in the ranges and the separate references are in the set. Other faces are not.")
+
+    def test_build_triangleset_long_identifier(self):
+        """
+        Tests storing a triangle set with an identifier that is longer than Blender allows for attribute names.
+        """
+        triangleset = io_mesh_3mf.import_3mf.TriangleSet(
+            name="Long", identifier="x" * 70, ranges=numpy.zeros((0, 2), dtype=numpy.int64), refs=numpy.array([0]))
+        mesh = unittest.mock.MagicMock()
+        mesh.attributes.__contains__.side_effect = lambda name: False
+
+        self.importer.build_triangleset(mesh, triangleset, 1)
+        mesh.attributes.new.assert_called_once_with(name="x" * 63, type="BOOLEAN", domain="FACE")
+
+        mesh.attributes.new.reset_mock()
+        mesh.attributes.__contains__.side_effect = lambda name: name == "x" * 63  # The attribute was created now.
+        self.importer.build_triangleset(mesh, triangleset, 1)
+        mesh.attributes.new.assert_not_called()  # The name is in use after cutting it off, so it must not be replaced.
+
+    def test_build_object_shared_mesh(self):
+        """
+        Tests building the same resource object multiple times, which must share a single mesh.
+        """
+        with_component = io_mesh_3mf.import_3mf.ResourceObject(  # Refers to the single triangle as component.
+            vertices=[],
+            triangles=[],
+            materials=[],
+            material_indices=[],
+            components=[io_mesh_3mf.import_3mf.Component(
+                resource_object="1",
+                transformation=mathutils.Matrix.Identity(4)
+            )],
+            metadata=Metadata(),
+            trianglesets=[]
+        )
+        self.importer.resource_objects["1"] = self.single_triangle
+        self.importer.resource_objects["2"] = with_component
+        shared_mesh = unittest.mock.MagicMock()
+        bpy.data.meshes.new.return_value = shared_mesh
+
+        # Build the triangle directly twice, and once more as a component of the other resource.
+        self.importer.build_object(self.single_triangle, mathutils.Matrix.Identity(4), Metadata(), ["1"])
+        self.importer.build_object(self.single_triangle, mathutils.Matrix.Scale(2.0, 4), Metadata(), ["1"])
+        self.importer.build_object(with_component, mathutils.Matrix.Identity(4), Metadata(), ["2"])
+
+        bpy.data.meshes.new.assert_called_once()  # Only one mesh must be created, for the only resource with a mesh.
+        self.assertEqual(bpy.data.objects.new.call_count, 4, "Each item and component gets its own object.")
+        meshes_used = [call[0][1] for call in bpy.data.objects.new.call_args_list]
+        self.assertListEqual(
+            meshes_used,
+            [shared_mesh, shared_mesh, None, shared_mesh],
+            "All objects built from the triangle resource must share the same mesh.")
 
     def test_build_object_blender_object(self):
         """
@@ -1598,10 +2101,185 @@ class TestImport3MF(unittest.TestCase):
             object_mock.matrix_world,
             transformation,
             "The transformation must be stored in the Blender object.")
-        # The object must be linked to the collection.
-        bpy.context.collection.objects.link.assert_called_with(object_mock)
-        self.assertEqual(bpy.context.view_layer.objects.active, object_mock, "The object must be made active.")
-        object_mock.select_set.assert_called_with(True)  # The object must be selected.
+        # The object must be linked to the collection of the file.
+        self.importer.collection.objects.link.assert_called_with(object_mock)
+        self.assertListEqual(self.importer.built_objects, [object_mock], "The object must be selected later.")
+        bpy.context.collection.objects.link.assert_not_called()  # Not linked to the scene one by one.
+
+    def test_link_collection(self):
+        """
+        Tests adding the collection of a file to the scene, selecting all of its objects.
+        """
+        collection = unittest.mock.MagicMock()
+        blender_objects = [unittest.mock.MagicMock(), unittest.mock.MagicMock()]
+
+        self.importer.link_collection(collection, blender_objects)
+
+        bpy.context.collection.children.link.assert_called_once_with(collection)
+        for blender_object in blender_objects:
+            blender_object.select_set.assert_called_once_with(True)
+        self.assertEqual(bpy.context.view_layer.objects.active, blender_objects[-1], "The last object becomes active.")
+
+    def test_link_collection_empty(self):
+        """
+        Tests that the collection of a file without objects is removed rather than added to the scene.
+        """
+        collection = unittest.mock.MagicMock()
+
+        self.importer.link_collection(collection, [])
+
+        bpy.context.collection.children.link.assert_not_called()
+        bpy.data.collections.remove.assert_called_once_with(collection)
+
+    def test_build_object_names(self):
+        """
+        Tests naming the objects and meshes after the name of the resource, or after the resource ID and build item.
+        """
+        named = self.single_triangle._replace(name="Bolt")
+        self.importer.object_names = {"Bolt": 1}  # Already exists in the scene.
+
+        self.importer.build_object(named, mathutils.Matrix.Identity(4), Metadata(), ["1"], item_index=1)
+        self.importer.build_object(named, mathutils.Matrix.Identity(4), Metadata(), ["1"], item_index=2)
+        self.importer.build_object(self.single_triangle, mathutils.Matrix.Identity(4), Metadata(), ["2"], item_index=3)
+
+        object_names = [call[0][0] for call in bpy.data.objects.new.call_args_list]
+        self.assertListEqual(object_names, ["Bolt 2", "Bolt 3", "3MF Object 2-3"])
+        mesh_names = [call[0][0] for call in bpy.data.meshes.new.call_args_list]
+        self.assertListEqual(mesh_names, ["Bolt", "3MF Mesh 2"], "The two items of resource 1 share the same mesh.")
+
+    def test_unique_name(self):
+        """
+        Tests finding unique names for data blocks.
+        """
+        used_names = {"Part": 1, "Part 2": 1, "Other": 1}
+
+        self.assertEqual(self.importer.unique_name("New", used_names), "New", "The name is not in use yet.")
+        self.assertEqual(self.importer.unique_name("New", used_names), "New 2")
+        self.assertEqual(self.importer.unique_name("Part", used_names), "Part 3", "Part 2 was already in use.")
+        self.assertEqual(self.importer.unique_name("Part", used_names), "Part 4", "Continues with the next number.")
+        self.assertEqual(self.importer.unique_name("Part 2", used_names), "Part 2 2")
+        long_name = self.importer.unique_name("é" * 100, used_names)
+        self.assertEqual(long_name, "é" * 31, "The name must fit in Blender, without cutting a character in half.")
+        long_name = self.importer.unique_name("é" * 100, used_names)
+        self.assertEqual(long_name, "é" * 27 + " 2", "Only cut off more to make room for a number.")
+        self.assertEqual(self.importer.unique_name("x" * 60, used_names), "x" * 60, "Unique names are left intact.")
+
+    def test_build_flattened(self):
+        """
+        Tests building all items and components of a document into a single mesh.
+        """
+        red = io_mesh_3mf.import_3mf.ResourceMaterial(name="Red", color=(1.0, 0.0, 0.0, 1.0))
+        blue = io_mesh_3mf.import_3mf.ResourceMaterial(name="Blue", color=(0.0, 0.0, 1.0, 1.0))
+        self.importer.resource_objects["1"] = self.single_triangle._replace(materials=[red])
+        self.importer.resource_objects["2"] = self.single_triangle._replace(  # Has a component, moved up by 10.
+            materials=[blue],
+            components=[io_mesh_3mf.import_3mf.Component(
+                resource_object="1",
+                transformation=mathutils.Matrix.Translation(mathutils.Vector([0, 0, 10])))])
+        root = xml.etree.ElementTree.Element(f"{{{MODEL_NAMESPACE}}}model")
+        build_element = xml.etree.ElementTree.SubElement(root, f"{{{MODEL_NAMESPACE}}}build")
+        xml.etree.ElementTree.SubElement(build_element, f"{{{MODEL_NAMESPACE}}}item", {"objectid": "2"})
+        xml.etree.ElementTree.SubElement(
+            build_element,
+            f"{{{MODEL_NAMESPACE}}}item",
+            {"objectid": "1", "transform": "1 0 0 0 1 0 0 0 1 100 0 0"})
+        self.importer.build_mesh = unittest.mock.MagicMock()
+        self.importer.assign_materials = unittest.mock.MagicMock()
+
+        self.importer.build_flattened(root, 2.0, "Plate")
+
+        self.importer.build_mesh.assert_called_once()
+        vertices, triangles, name = self.importer.build_mesh.call_args[0]
+        self.assertEqual(name, "Plate")
+        self.assertListEqual(vertices.tolist(), [
+            [0.0, 0.0, 0.0], [10.0, 0.0, 2.0], [0.0, 10.0, 2.0],  # Resource 2, scaled.
+            [0.0, 0.0, 20.0], [10.0, 0.0, 22.0], [0.0, 10.0, 22.0],  # Resource 1 as component of 2.
+            [200.0, 0.0, 0.0], [210.0, 0.0, 2.0], [200.0, 10.0, 2.0]  # Resource 1 as build item.
+        ])
+        self.assertListEqual(triangles.tolist(), [[0, 1, 2], [3, 4, 5], [6, 7, 8]], "Each refers to its own place.")
+        mesh, materials, material_indices = self.importer.assign_materials.call_args[0]
+        self.assertListEqual(materials, [blue, red])
+        self.assertListEqual(material_indices.tolist(), [0, 1, 1], "Each triangle keeps its own material.")
+        self.assertEqual(self.importer.built_objects, [bpy.data.objects.new.return_value], "A single object.")
+
+    def test_build_flattened_supports(self):
+        """
+        Tests that supports are kept out of the single mesh of the model, when building a document into a single mesh.
+        """
+        support_metadata = Metadata()
+        support_metadata["3mf:object_type"] = MetadataEntry(
+            name="3mf:object_type", preserve=True, datatype="xs:string", value="support")
+        self.importer.resource_objects["1"] = self.single_triangle
+        self.importer.resource_objects["2"] = self.single_triangle._replace(metadata=support_metadata)
+        root = xml.etree.ElementTree.Element(f"{{{MODEL_NAMESPACE}}}model")
+        build_element = xml.etree.ElementTree.SubElement(root, f"{{{MODEL_NAMESPACE}}}build")
+        for objectid in ["2", "1", "2"]:
+            xml.etree.ElementTree.SubElement(build_element, f"{{{MODEL_NAMESPACE}}}item", {"objectid": objectid})
+        self.importer.build_mesh = unittest.mock.MagicMock()
+        self.importer.assign_materials = unittest.mock.MagicMock()
+        bpy.data.objects.new.side_effect = lambda name, data: unittest.mock.MagicMock(name=name)
+
+        self.importer.build_flattened(root, 1.0, "Plate")
+
+        self.assertEqual(self.importer.build_mesh.call_count, 2, "The model and the supports each get their own mesh.")
+        (model_vertices, _, model_name), (support_vertices, _, support_name) = [
+            call[0] for call in self.importer.build_mesh.call_args_list]
+        self.assertEqual(model_name, "Plate")
+        self.assertEqual(len(model_vertices), 3, "Only the model itself is in the mesh of the model.")
+        self.assertEqual(support_name, "Plate support")
+        self.assertEqual(len(support_vertices), 6, "Both supports are combined into one mesh.")
+        model_object, support_object = self.importer.built_objects
+        self.assertNotEqual(model_object.hide_render, True)
+        self.assertTrue(support_object.hide_render, "Supports are not rendered.")
+        support_object.__setitem__.assert_called()  # The type of the support is stored, to export it again.
+
+    def test_find_shared_resources(self):
+        """
+        Tests finding the resource objects with components that are used in multiple places.
+        """
+        component = io_mesh_3mf.import_3mf.Component(resource_object="1", transformation=mathutils.Matrix.Identity(4))
+        self.importer.resource_objects["1"] = self.single_triangle  # Used twice, but has no components.
+        self.importer.resource_objects["2"] = self.single_triangle._replace(components=[component, component])
+        self.importer.resource_objects["3"] = self.single_triangle._replace(components=[component])
+        root = xml.etree.ElementTree.Element(f"{{{MODEL_NAMESPACE}}}model")
+        build_element = xml.etree.ElementTree.SubElement(root, f"{{{MODEL_NAMESPACE}}}build")
+        for objectid in ["2", "2", "3"]:
+            xml.etree.ElementTree.SubElement(build_element, f"{{{MODEL_NAMESPACE}}}item", {"objectid": objectid})
+
+        self.assertSetEqual(
+            self.importer.find_shared_resources(root),
+            {"2"},
+            "Only resource 2 has components and is used in multiple places.")
+
+    def test_build_object_shared_assembly(self):
+        """
+        Tests building a sub-assembly that is used in multiple places once, and instancing it in each place.
+        """
+        leaf = io_mesh_3mf.import_3mf.Component(resource_object="1", transformation=mathutils.Matrix.Identity(4))
+        assembly = io_mesh_3mf.import_3mf.Component(resource_object="2", transformation=mathutils.Matrix.Scale(2, 4))
+        self.importer.resource_objects["1"] = self.single_triangle
+        self.importer.resource_objects["2"] = self.single_triangle._replace(components=[leaf, leaf])
+        top = self.single_triangle._replace(components=[assembly, assembly, assembly])
+        self.importer.resource_objects["3"] = top
+        self.importer.shared_resources = {"2"}
+        file_collection = self.importer.collection
+        bpy.data.objects.new.side_effect = lambda name, data: unittest.mock.MagicMock(name=name)
+
+        self.importer.build_object(top, mathutils.Matrix.Identity(4), Metadata(), ["3"], item_index=1)
+
+        bpy.data.collections.new.assert_called_once()  # The sub-assembly is built only once.
+        assembly_collection = bpy.data.collections.new.return_value
+        self.assertEqual(bpy.data.objects.new.call_count, 7, "Top object, 3 instances, assembly with 2 components.")
+        instances = self.importer.built_objects[1:]
+        self.assertEqual(len(instances), 3, "Only the top object and the instances are in the collection of the file.")
+        for instance in instances:
+            self.assertEqual(instance.instance_type, 'COLLECTION')
+            self.assertEqual(instance.instance_collection, assembly_collection)
+            self.assertEqual(instance.parent, self.importer.built_objects[0])
+            self.assertEqual(instance.matrix_world, mathutils.Matrix.Scale(2, 4))
+        self.assertEqual(file_collection.objects.link.call_count, 4)
+        self.assertEqual(assembly_collection.objects.link.call_count, 3, "The assembly and its 2 components.")
+        self.assertIs(self.importer.collection, file_collection, "Building continues in the collection of the file.")
 
     def test_build_object_transformation(self):
         """
@@ -1642,6 +2320,7 @@ class TestImport3MF(unittest.TestCase):
             vertices=[(0.0, 0.0, 0.0), (10.0, 0.0, 2.0), (0.0, 10.0, 2.0)],
             triangles=[(0, 1, 2)],
             materials=[None],
+            material_indices=[0],
             components=[io_mesh_3mf.import_3mf.Component(
                 resource_object="1",
                 transformation=mathutils.Matrix.Identity(4)
@@ -1683,6 +2362,7 @@ class TestImport3MF(unittest.TestCase):
             vertices=[(0.0, 0.0, 0.0), (10.0, 0.0, 2.0), (0.0, 10.0, 2.0)],
             triangles=[(0, 1, 2)],
             materials=[None],
+            material_indices=[0],
             components=[io_mesh_3mf.import_3mf.Component(
                 resource_object="1",
                 transformation=mathutils.Matrix.Identity(4)
@@ -1708,6 +2388,7 @@ class TestImport3MF(unittest.TestCase):
             vertices=[(0.0, 0.0, 0.0), (10.0, 0.0, 2.0), (0.0, 10.0, 2.0)],
             triangles=[(0, 1, 2)],
             materials=[None],
+            material_indices=[0],
             components=[io_mesh_3mf.import_3mf.Component(
                 resource_object="2",  # This object ID doesn't exist!
                 transformation=mathutils.Matrix.Identity(4)
@@ -1736,6 +2417,7 @@ class TestImport3MF(unittest.TestCase):
             vertices=[(0.0, 0.0, 0.0), (10.0, 0.0, 2.0), (0.0, 10.0, 2.0)],
             triangles=[(0, 1, 2)],
             materials=[None],
+            material_indices=[0],
             components=[io_mesh_3mf.import_3mf.Component(
                 resource_object="1",
                 transformation=mathutils.Matrix.Scale(2.0, 4)
@@ -0,0 +1,56 @@
+# Blender add-on to import and export 3MF files.
+# Copyright (C) 2020 Ghostkeeper
+# This add-on is free software; you can redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation; either version 2 of the License, or (at your option) any later
+# version.
+# This add-on is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License along with this program; if not, write to the Free
+# Software Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# <pep8 compliant>
+
+import unittest  # To run the tests.
+import zlib  # To decompress the results.
+
+import io_mesh_3mf.parallel_deflate  # The unit under test.
+
+
+class TestParallelDeflate(unittest.TestCase):
+    """
+    Unit tests for compressing streams on multiple threads.
+    """
+
+    def test_empty(self):
+        """
+        Tests compressing a stream without any data.
+        """
+        compressor = io_mesh_3mf.parallel_deflate.ParallelDeflate(9)
+        compressed = compressor.compress(b"") + compressor.flush()
+        self.assertEqual(zlib.decompress(compressed, -zlib.MAX_WBITS), b"", "It must still be a valid deflate stream.")
+
+    def test_blocks(self):
+        """
+        Tests compressing a stream that spans many blocks, written in pieces that don't align with the blocks.
+        """
+        data = b"".join(b"<vertex x=\"%d\" y=\"%d\" z=\"0\" />" % (i, i * 7 % 13) for i in range(20000))
+        for level in range(10):
+            with self.subTest(level=level):
+                compressor = io_mesh_3mf.parallel_deflate.ParallelDeflate(level, block_size=10000, max_workers=4)
+                compressed = b""
+                for start in range(0, len(data), 777):
+                    compressed += compressor.compress(data[start:start + 777])
+                compressed += compressor.flush()
+
+                self.assertEqual(zlib.decompress(compressed, -zlib.MAX_WBITS), data, "The blocks form a single stream.")
+
+    def test_dictionary(self):
+        """
+        Tests that the blocks may refer to data of the previous blocks, so they compress as well as a single block.
+        """
+        data = bytes(range(256)) * 100  # Repeats within the dictionary size, but not within each block.
+        compressor = io_mesh_3mf.parallel_deflate.ParallelDeflate(9, block_size=256, max_workers=2)
+        compressed = compressor.compress(data) + compressor.flush()
+
+        self.assertEqual(zlib.decompress(compressed, -zlib.MAX_WBITS), data)
+        self.assertLess(len(compressed), len(data) // 10, "Blocks after the first refer back to the first.")
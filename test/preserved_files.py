@@ -0,0 +1,247 @@
+# Blender add-on to import and export 3MF files.
+# Copyright (C) 2020 Ghostkeeper
+# This add-on is free software; you can redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation; either version 2 of the License, or (at your option) any later
+# version.
+# This add-on is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License along with this program; if not, write to the Free
+# Software Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# <pep8 compliant>
+
+import base64  # To create files preserved by older versions of the add-on.
+import hashlib  # To verify the names of the stored files.
+import io  # To create archives in memory.
+import os  # To inspect the storage directory.
+import struct  # To read the compressed data in archives.
+import tempfile  # To store the preserved files in a temporary directory.
+import time  # To pretend that stored files were used long ago.
+import unittest.mock  # To mock away the Blender API.
+import zipfile  # To write preserved files to archives.
+
+import bpy  # To mock the Text blocks in the Blender scene.
+import io_mesh_3mf.preserved_files  # The unit under test.
+from io_mesh_3mf.constants import *
+
+
+class MockText:
+    """
+    A Text block in the Blender scene, which just keeps its contents in a string.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.contents = ""
+
+    def as_string(self):
+        return self.contents
+
+    def clear(self):
+        self.contents = ""
+
+    def write(self, contents):
+        self.contents += contents
+
+
+class MockTexts(dict):
+    """
+    The collection of Text blocks in the Blender scene.
+    """
+
+    def new(self, name):
+        self[name] = MockText(name)
+        return self[name]
+
+    def __iter__(self):
+        return iter(list(self.values()))
+
+
+class TestPreservedFiles(unittest.TestCase):
+    """
+    Unit tests for the storage of files that must be preserved.
+    """
+
+    def setUp(self):
+        """
+        Creates some fixtures to use for the tests.
+        """
+        self.directory = tempfile.TemporaryDirectory()
+        bpy.utils.extension_path_user = unittest.mock.MagicMock(return_value=self.directory.name)
+        bpy.data.texts = MockTexts()
+        # The package of this module when it's installed as an extension, which is in a subpackage of the extension.
+        with unittest.mock.patch.object(
+                io_mesh_3mf.preserved_files, "__package__", "bl_ext.user_default.io_mesh_3mf.io_mesh_3mf"):
+            self.preserved_files = io_mesh_3mf.preserved_files.PreservedFiles()
+        bpy.utils.extension_path_user.assert_called_once_with(
+            "bl_ext.user_default.io_mesh_3mf",
+            path=io_mesh_3mf.preserved_files.STORE_PATH,
+            create=True)
+
+    def tearDown(self):
+        """
+        Removes the stored files.
+        """
+        self.directory.cleanup()
+
+    def archive(self, files, compression=zipfile.ZIP_DEFLATED, compresslevel=None):
+        """
+        Create a 3MF archive in memory, to preserve files from.
+        :param files: A dictionary of file paths to their contents.
+        :param compression: The compression method to use for the files.
+        :param compresslevel: The compression level to use for the files.
+        :return: The archive, opened for reading.
+        """
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w", compression=compression, compresslevel=compresslevel) as archive:
+            for filename, contents in files.items():
+                archive.writestr(filename, contents)
+        return zipfile.ZipFile(buffer)
+
+    def compressed_data(self, archive, filename):
+        """
+        Read the compressed data of a file in an archive, without decompressing it.
+        :param archive: The archive to read from.
+        :param filename: The path of the file in the archive.
+        :return: The compressed data.
+        """
+        info = archive.getinfo(filename)
+        archive.fp.seek(info.header_offset + 26)
+        name_length, extra_length = struct.unpack("<HH", archive.fp.read(4))
+        archive.fp.seek(name_length + extra_length, os.SEEK_CUR)
+        return archive.fp.read(info.compress_size)
+
+    def test_add(self):
+        """
+        Tests preserving a file.
+        """
+        contents = b"\x00\x01 Binary G-code \xff"
+        archive = self.archive({"Metadata/plate_1.gcode": contents})
+        self.preserved_files.add(archive, "Metadata/plate_1.gcode")
+
+        file_hash = hashlib.sha256(contents).hexdigest()
+        self.assertEqual(
+            bpy.data.texts[".3mf_preserved/Metadata/plate_1.gcode"].as_string(),
+            "sha256:" + file_hash,
+            "The Blender scene refers to the contents by their hash.")
+        with zipfile.ZipFile(os.path.join(self.directory.name, file_hash)) as stored:
+            self.assertEqual(stored.read(file_hash), contents, "The contents are stored, named by hash.")
+            self.assertEqual(
+                self.compressed_data(stored, file_hash),
+                self.compressed_data(archive, "Metadata/plate_1.gcode"),
+                "The compressed data is stored as it was in the archive.")
+        self.assertEqual(os.listdir(self.directory.name), [file_hash], "No temporary files are left behind.")
+
+    def test_add_same_contents(self):
+        """
+        Tests preserving the same file twice, from different archives.
+        """
+        self.preserved_files.add(self.archive({"config.ini": b"layer_height = 0.2"}), "config.ini")
+        self.preserved_files.add(
+            self.archive({"config.ini": b"layer_height = 0.2"}, compression=zipfile.ZIP_STORED), "config.ini")
+        self.preserved_files.add(self.archive({"other.ini": b"layer_height = 0.2"}), "other.ini")
+
+        self.assertEqual(
+            bpy.data.texts[".3mf_preserved/config.ini"].as_string(),
+            bpy.data.texts[".3mf_preserved/other.ini"].as_string(),
+            "All files refer to the same contents, even if they were compressed differently.")
+        self.assertEqual(len(os.listdir(self.directory.name)), 1, "The same contents are stored only once.")
+
+    def test_add_conflict(self):
+        """
+        Tests preserving files with the same path but different contents.
+        """
+        self.preserved_files.add(self.archive({"config.ini": b"layer_height = 0.2"}), "config.ini")
+        self.preserved_files.add(self.archive({"config.ini": b"layer_height = 0.1"}), "config.ini")
+        self.assertEqual(
+            bpy.data.texts[".3mf_preserved/config.ini"].as_string(),
+            conflicting_mustpreserve_contents,
+            "The contents are different, so the file is in conflict.")
+
+        self.preserved_files.add(self.archive({"config.ini": b"layer_height = 0.2"}), "config.ini")
+        self.assertEqual(
+            bpy.data.texts[".3mf_preserved/config.ini"].as_string(),
+            conflicting_mustpreserve_contents,
+            "Once in conflict, the file stays in conflict.")
+
+    def test_add_legacy(self):
+        """
+        Tests preserving a file that was already preserved by an older version, which stored it as Base85.
+        """
+        contents = b"layer_height = 0.2"
+        bpy.data.texts.new(".3mf_preserved/config.ini").write(base64.b85encode(contents).decode("UTF-8"))
+
+        self.preserved_files.add(self.archive({"config.ini": contents}), "config.ini")
+
+        self.assertEqual(
+            bpy.data.texts[".3mf_preserved/config.ini"].as_string(),
+            "sha256:" + hashlib.sha256(contents).hexdigest(),
+            "The contents are the same, so it is not in conflict. The old Text block now refers to the stored file.")
+
+    def test_write(self):
+        """
+        Tests writing the preserved files to an archive.
+        """
+        source = self.archive({"Metadata/plate_1.gcode": b"G28 ; Home\n" * 1000}, compresslevel=1)
+        self.preserved_files.add(source, "Metadata/plate_1.gcode")
+        bpy.data.texts.new(".3mf_preserved/legacy.txt").write(base64.b85encode(b"Base85").decode("UTF-8"))
+        bpy.data.texts.new(".3mf_preserved/conflict.txt").write(conflicting_mustpreserve_contents)
+        bpy.data.texts.new(".3mf_preserved/missing.txt").write("sha256:" + "0" * 64)
+        bpy.data.texts.new(".3mf_preserved/malicious.txt").write("sha256:../../etc/passwd")
+        bpy.data.texts.new("Unrelated text").write("Hello")
+
+        archive_stream = io.BytesIO()
+        with zipfile.ZipFile(archive_stream, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=9) as archive:
+            archive.writestr("3D/3dmodel.model", b"<model />")
+            missing = self.preserved_files.write(archive)
+            archive.writestr("[Content_Types].xml", b"<Types />")
+
+        with zipfile.ZipFile(archive_stream) as archive:
+            self.assertEqual(
+                set(archive.namelist()),
+                {"3D/3dmodel.model", "Metadata/plate_1.gcode", "legacy.txt", "[Content_Types].xml"},
+                "Conflicting, missing and invalid files are not written, nor are unrelated Text blocks.")
+            self.assertIsNone(archive.testzip(), "All files in the archive are intact.")
+            self.assertEqual(archive.read("Metadata/plate_1.gcode"), b"G28 ; Home\n" * 1000)
+            self.assertEqual(
+                self.compressed_data(archive, "Metadata/plate_1.gcode"),
+                self.compressed_data(source, "Metadata/plate_1.gcode"),
+                "The compressed data is copied from the original archive, not compressed again.")
+            self.assertEqual(archive.read("legacy.txt"), b"Base85", "Files from older versions are decoded.")
+        self.assertEqual(
+            set(missing),
+            {"missing.txt", "malicious.txt"},
+            "The files whose contents are not available are returned, so that the user can be warned about them.")
+
+    def test_cleanup(self):
+        """
+        Tests removing stored contents that are no longer used.
+        """
+        self.preserved_files.add(self.archive({"used.ini": b"Used"}), "used.ini")
+        self.preserved_files.add(self.archive({"unused.ini": b"Unused"}), "unused.ini")
+        self.preserved_files.add(self.archive({"recent.ini": b"Recently used"}), "recent.ini")
+        used_path = self.preserved_files.path(bpy.data.texts[".3mf_preserved/used.ini"].as_string())
+        unused_path = self.preserved_files.path(bpy.data.texts[".3mf_preserved/unused.ini"].as_string())
+        recent_path = self.preserved_files.path(bpy.data.texts[".3mf_preserved/recent.ini"].as_string())
+        long_ago = time.time() - io_mesh_3mf.preserved_files.MAX_UNUSED_AGE - 60
+        os.utime(used_path, (long_ago, long_ago))
+        os.utime(unused_path, (long_ago, long_ago))
+        bpy.data.texts = MockTexts()  # Open a different .blend file, which refers to only one of the stored files.
+        bpy.data.texts.new(".3mf_preserved/used.ini").write("sha256:" + os.path.basename(used_path))
+        bpy.data.texts.new(".3mf_preserved/conflict.ini").write(conflicting_mustpreserve_contents)
+
+        self.preserved_files.cleanup()
+
+        self.assertTrue(os.path.exists(used_path), "Contents that the open .blend file refers to are kept.")
+        self.assertGreater(os.path.getmtime(used_path), long_ago, "The contents are marked as used.")
+        self.assertTrue(
+            os.path.exists(recent_path),
+            "Contents that were used recently are kept, since a .blend file that is not open may refer to them.")
+        self.assertFalse(os.path.exists(unused_path), "Contents that were not used for a long time are removed.")
+
+    def test_cleanup_not_an_extension(self):
+        """
+        Tests that cleaning up after loading a .blend file doesn't fail if there is no user data directory to clean.
+        """
+        bpy.utils.extension_path_user.side_effect = ValueError("The package is not an extension.")
+        io_mesh_3mf.preserved_files.cleanup_preserved_files(None)  # Must not raise.
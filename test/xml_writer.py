@@ -0,0 +1,214 @@
+# Blender add-on to import and export 3MF files.
+# Copyright (C) 2020 Ghostkeeper
+# This add-on is free software; you can redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation; either version 2 of the License, or (at your option) any later
+# version.
+# This add-on is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License along with this program; if not, write to the Free
+# Software Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# <pep8 compliant>
+
+import concurrent.futures  # To serialize parts of documents on other threads.
+import io  # To write documents to memory.
+import threading  # To control the order in which the threads finish.
+import unittest  # To run the tests.
+import xml.etree.ElementTree  # To parse the documents that were written.
+
+import io_mesh_3mf.xml_writer  # The unit under test.
+from io_mesh_3mf.constants import *
+
+
+class TestXMLWriter(unittest.TestCase):
+    """
+    Unit tests for writing XML documents as a stream.
+    """
+
+    def setUp(self):
+        """
+        Creates a writer to test with, writing to memory.
+        """
+        self.stream = io.BytesIO()
+        self.writer = io_mesh_3mf.xml_writer.XMLWriter(self.stream, {"": MODEL_NAMESPACE, "t": TRIANGLESETS_NAMESPACE})
+
+    def test_empty_document(self):
+        """
+        Tests writing a document with only a root element.
+        """
+        self.writer.element(f"{{{MODEL_NAMESPACE}}}model")
+        self.writer.close()
+
+        self.assertEqual(
+            self.stream.getvalue(),
+            b"<?xml version='1.0' encoding='UTF-8'?>\n"
+            b"<model xmlns=\"http://schemas.microsoft.com/3dmanufacturing/core/2015/02\" "
+            b"xmlns:t=\"http://schemas.microsoft.com/3dmanufacturing/trianglesets/2021/07\" />",
+            "The namespaces are declared on the root element.")
+
+    def test_close_keeps_stream(self):
+        """
+        Tests that closing the writer writes everything to the stream, but leaves the stream open.
+        """
+        with self.writer:
+            self.writer.element(f"{{{MODEL_NAMESPACE}}}model")
+
+        self.assertFalse(self.stream.closed, "The stream must stay open, so that it can be closed by its owner.")
+        self.assertTrue(self.stream.getvalue().endswith(b" />"), "The root element has been written to the stream.")
+
+    def test_nested_elements(self):
+        """
+        Tests writing elements inside other elements.
+        """
+        self.writer.start(f"{{{MODEL_NAMESPACE}}}model")
+        self.writer.start(f"{{{MODEL_NAMESPACE}}}resources")
+        self.writer.start(f"{{{MODEL_NAMESPACE}}}object", {f"{{{MODEL_NAMESPACE}}}id": "1"})
+        self.writer.element(f"{{{MODEL_NAMESPACE}}}mesh")
+        self.writer.end(f"{{{MODEL_NAMESPACE}}}object")
+        self.writer.element(f"{{{MODEL_NAMESPACE}}}object", {f"{{{MODEL_NAMESPACE}}}id": "2"})
+        self.writer.end(f"{{{MODEL_NAMESPACE}}}resources")
+        self.writer.element(f"{{{MODEL_NAMESPACE}}}build")
+        self.writer.end(f"{{{MODEL_NAMESPACE}}}model")
+        self.writer.close()
+
+        root = xml.etree.ElementTree.fromstring(self.stream.getvalue())
+        self.assertEqual(root.tag, f"{{{MODEL_NAMESPACE}}}model")
+        self.assertEqual(
+            [child.tag for child in root],
+            [f"{{{MODEL_NAMESPACE}}}resources", f"{{{MODEL_NAMESPACE}}}build"])
+        object_elements = root.findall("3mf:resources/3mf:object", MODEL_NAMESPACES)
+        self.assertEqual([element.attrib["id"] for element in object_elements], ["1", "2"])
+        self.assertEqual(len(object_elements[0].findall("3mf:mesh", MODEL_NAMESPACES)), 1)
+        self.assertEqual(len(object_elements[1]), 0, "The second object was written without children.")
+
+    def test_namespaces(self):
+        """
+        Tests writing elements in a namespace other than the default namespace.
+        """
+        self.writer.start(f"{{{MODEL_NAMESPACE}}}model")
+        self.writer.start(f"{{{TRIANGLESETS_NAMESPACE}}}trianglesets")
+        self.writer.element(f"{{{TRIANGLESETS_NAMESPACE}}}triangleset", {"name": "Set", "identifier": "ts_0"})
+        self.writer.end(f"{{{TRIANGLESETS_NAMESPACE}}}trianglesets")
+        self.writer.end(f"{{{MODEL_NAMESPACE}}}model")
+        self.writer.close()
+
+        self.assertIn(b"<t:triangleset name=\"Set\" identifier=\"ts_0\" />", self.stream.getvalue())
+        root = xml.etree.ElementTree.fromstring(self.stream.getvalue())
+        triangleset_elements = root.findall("t:trianglesets/t:triangleset", MODEL_NAMESPACES)
+        self.assertEqual(len(triangleset_elements), 1, "The prefix of the namespace must resolve to the namespace.")
+
+    def test_undeclared_namespace(self):
+        """
+        Tests writing an element in a namespace that wasn't declared.
+        """
+        with self.assertRaises(KeyError):
+            self.writer.element("{http://example.com/not-declared}model")
+
+    def test_escape(self):
+        """
+        Tests writing text and attributes with characters that have special meaning in XML.
+        """
+        text = "Tom & Jerry's <\"cartoon\">\nEpisode\t1\r"
+        self.writer.start(f"{{{MODEL_NAMESPACE}}}model")
+        self.writer.element(f"{{{MODEL_NAMESPACE}}}metadata", {f"{{{MODEL_NAMESPACE}}}name": text}, text)
+        self.writer.end(f"{{{MODEL_NAMESPACE}}}model")
+        self.writer.close()
+
+        root = xml.etree.ElementTree.fromstring(self.stream.getvalue())
+        metadata_element = root.find("3mf:metadata", MODEL_NAMESPACES)
+        self.assertEqual(metadata_element.attrib["name"], text, "All characters must survive in attributes.")
+        self.assertEqual(metadata_element.text, text.replace("\r", "\n"), "XML parsers normalize line endings.")
+
+    def test_encoding(self):
+        """
+        Tests writing characters outside of ASCII.
+        """
+        self.writer.element(f"{{{MODEL_NAMESPACE}}}model", {"name": "Kärcher"}, "日本語")
+        self.writer.close()
+
+        self.assertIn("Kärcher".encode("UTF-8"), self.stream.getvalue(), "The document is encoded as UTF-8.")
+        root = xml.etree.ElementTree.fromstring(self.stream.getvalue())
+        self.assertEqual(root.attrib["name"], "Kärcher")
+        self.assertEqual(root.text, "日本語")
+
+    def test_defer(self):
+        """
+        Tests serializing parts of the document on other threads, which finish in a different order.
+        """
+        first_may_finish = threading.Event()
+
+        def serialize(text, event=None):
+            if event is not None:
+                event.wait(10)
+            return f"<{text} />"
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            writer = io_mesh_3mf.xml_writer.XMLWriter(self.stream, {"": MODEL_NAMESPACE}, executor)
+            writer.start(f"{{{MODEL_NAMESPACE}}}model")
+            writer.defer(serialize, "first", first_may_finish)
+            writer.element(f"{{{MODEL_NAMESPACE}}}second")
+            writer.defer(serialize, "third")
+            writer.end(f"{{{MODEL_NAMESPACE}}}model")
+            first_may_finish.set()
+            writer.close()
+
+        root = xml.etree.ElementTree.fromstring(self.stream.getvalue())
+        self.assertEqual(
+            [child.tag for child in root],
+            [f"{{{MODEL_NAMESPACE}}}first", f"{{{MODEL_NAMESPACE}}}second", f"{{{MODEL_NAMESPACE}}}third"],
+            "Everything is written in the order in which it was given, even if the first part takes the longest.")
+
+    def test_defer_without_executor(self):
+        """
+        Tests serializing parts of the document when there is no executor to serialize them with.
+        """
+        self.writer.start(f"{{{MODEL_NAMESPACE}}}model")
+        self.writer.defer(str.upper, "<deferred />")
+        self.writer.end(f"{{{MODEL_NAMESPACE}}}model")
+        self.writer.close()
+
+        self.assertIn(b"<DEFERRED />", self.stream.getvalue(), "Without executor, it's serialized right away.")
+
+    def test_defer_exception(self):
+        """
+        Tests serializing a part of the document with a function that fails.
+        """
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            writer = io_mesh_3mf.xml_writer.XMLWriter(self.stream, {"": MODEL_NAMESPACE}, executor)
+            writer.start(f"{{{MODEL_NAMESPACE}}}model")
+            with self.assertRaises(ValueError, msg="The error of the function is raised while writing."):
+                writer.defer(int, "not a number")
+                writer.close()
+
+    def test_buffered(self):
+        """
+        Tests collecting a document to write it later, on a different thread.
+        """
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            writer = io_mesh_3mf.xml_writer.XMLWriter(self.stream, {"": MODEL_NAMESPACE}, executor, buffered=True)
+            writer.start(f"{{{MODEL_NAMESPACE}}}model")
+            for i in range(10):
+                writer.defer(str, f"<part{i} />")
+            writer.end(f"{{{MODEL_NAMESPACE}}}model")
+            self.assertEqual(self.stream.getvalue(), b"", "Nothing is written until the writer is closed.")
+            self.assertEqual(writer.progress(), 0.0, "None of the deferred parts were written yet.")
+
+            thread = threading.Thread(target=writer.close)
+            thread.start()
+            thread.join()
+
+        self.assertEqual(writer.progress(), 1.0, "All deferred parts were written.")
+        root = xml.etree.ElementTree.fromstring(self.stream.getvalue())
+        self.assertEqual([child.tag for child in root], [f"{{{MODEL_NAMESPACE}}}part{i}" for i in range(10)])
+
+    def test_cancel(self):
+        """
+        Tests cancelling writing a document.
+        """
+        writer = io_mesh_3mf.xml_writer.XMLWriter(self.stream, {"": MODEL_NAMESPACE}, buffered=True)
+        writer.start(f"{{{MODEL_NAMESPACE}}}model")
+        writer.defer(str, "<part />")
+        writer.cancel()
+
+        with self.assertRaises(concurrent.futures.CancelledError):
+            writer.close()
@@ -0,0 +1,136 @@
+# Blender add-on to import and export 3MF files.
+# Copyright (C) 2020 Ghostkeeper
+# This add-on is free software; you can redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation; either version 2 of the License, or (at your option) any later
+# version.
+# This add-on is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License along with this program; if not, write to the Free
+# Software Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# <pep8 compliant>
+
+import io  # To create archives in memory.
+import os  # To read the compressed data in archives.
+import struct  # To read the compressed data in archives.
+import unittest.mock  # To force the fallbacks.
+import zipfile  # To create archives to copy files between.
+import zlib  # To compress files with a different compressor.
+
+import io_mesh_3mf.zipfile_compat  # The unit under test.
+
+
+class TestZipfileCompat(unittest.TestCase):
+    """
+    Unit tests for the access to the internals of the `zipfile` module.
+    """
+
+    def archive(self, files, compresslevel=1):
+        """
+        Create an archive in memory, to copy files from.
+        :param files: A dictionary of file paths to their contents.
+        :param compresslevel: The compression level to use for the files.
+        :return: The archive, opened for reading.
+        """
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=compresslevel) as archive:
+            for filename, contents in files.items():
+                archive.writestr(filename, contents)
+        return zipfile.ZipFile(buffer)
+
+    def compressed_data(self, archive, filename):
+        """
+        Read the compressed data of a file in an archive, without decompressing it.
+        :param archive: The archive to read from.
+        :param filename: The path of the file in the archive.
+        :return: The compressed data.
+        """
+        info = archive.getinfo(filename)
+        archive.fp.seek(info.header_offset + 26)
+        name_length, extra_length = struct.unpack("<HH", archive.fp.read(4))
+        archive.fp.seek(name_length + extra_length, os.SEEK_CUR)
+        return archive.fp.read(info.compress_size)
+
+    def copy(self, source, filename):
+        """
+        Copy a file from an archive to a new archive, after another file.
+        :param source: The archive to copy the file from.
+        :param filename: The path of the file in the archive.
+        :return: The new archive, opened for reading.
+        """
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=9) as target:
+            target.writestr("3D/3dmodel.model", b"<model />")
+            io_mesh_3mf.zipfile_compat.copy_compressed(source, source.getinfo(filename), target, "copy.gcode")
+        return zipfile.ZipFile(buffer)
+
+    def test_copy_compressed(self):
+        """
+        Tests copying the compressed data of a file from one archive to another.
+        """
+        contents = b"G28 ; Home\n" * 1000
+        source = self.archive({"plate_1.gcode": contents})
+
+        with self.copy(source, "plate_1.gcode") as target:
+            self.assertIsNone(target.testzip(), "All files in the archive are intact.")
+            self.assertEqual(target.read("copy.gcode"), contents)
+            self.assertEqual(
+                self.compressed_data(target, "copy.gcode"),
+                self.compressed_data(source, "plate_1.gcode"),
+                "The compressed data is copied as it is, not compressed again at the level of the target archive.")
+
+    def test_copy_compressed_fallback(self):
+        """
+        Tests copying a file between archives if the `zipfile` module lacks the attributes to copy compressed data.
+        """
+        contents = b"G28 ; Home\n" * 1000
+        source = self.archive({"plate_1.gcode": contents})
+        attributes = io_mesh_3mf.zipfile_compat.ARCHIVE_ATTRIBUTES + ("_removed_in_a_later_version",)
+
+        with unittest.mock.patch("io_mesh_3mf.zipfile_compat.ARCHIVE_ATTRIBUTES", attributes):
+            self.assertFalse(io_mesh_3mf.zipfile_compat.can_copy_compressed(source))
+            target = self.copy(source, "plate_1.gcode")
+
+        with target:
+            self.assertIsNone(target.testzip(), "All files in the archive are intact.")
+            self.assertEqual(target.read("copy.gcode"), contents, "The file was decompressed and compressed again.")
+            self.assertEqual(target.getinfo("copy.gcode").compress_type, zipfile.ZIP_DEFLATED)
+
+    def test_replace_compressor(self):
+        """
+        Tests compressing a file in an archive with a different compressor.
+        """
+        contents = b"<vertex x=\"1\" y=\"2\" z=\"3\" />" * 1000
+        compressor = unittest.mock.MagicMock(wraps=zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS))
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+            with archive.open("3D/3dmodel.model", "w") as stream:
+                self.assertTrue(io_mesh_3mf.zipfile_compat.replace_compressor(stream, lambda: compressor))
+                stream.write(contents)
+
+        compressor.compress.assert_called()
+        with zipfile.ZipFile(buffer) as archive:
+            self.assertIsNone(archive.testzip(), "All files in the archive are intact.")
+            self.assertEqual(archive.read("3D/3dmodel.model"), contents)
+
+    def test_replace_compressor_fallback(self):
+        """
+        Tests compressing a file if the `zipfile` module doesn't keep the compressor where it's expected.
+        """
+        contents = b"<vertex x=\"1\" y=\"2\" z=\"3\" />" * 1000
+        create_compressor = unittest.mock.MagicMock()
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+            with archive.open("3D/3dmodel.model", "w") as stream:
+                with unittest.mock.patch("io_mesh_3mf.zipfile_compat.COMPRESSOR_ATTRIBUTE", "_renamed_compressor"):
+                    self.assertFalse(io_mesh_3mf.zipfile_compat.replace_compressor(stream, create_compressor))
+                stream.write(contents)
+
+        create_compressor.assert_not_called()
+        with zipfile.ZipFile(buffer) as archive:
+            self.assertIsNone(archive.testzip(), "All files in the archive are intact.")
+            self.assertEqual(archive.read("3D/3dmodel.model"), contents)
+            self.assertEqual(
+                archive.getinfo("3D/3dmodel.model").compress_type,
+                zipfile.ZIP_DEFLATED,
+                "The file is still compressed, with the compressor of the zipfile module.")